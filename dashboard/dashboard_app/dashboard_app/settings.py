@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'monitor.middleware.DecompressRequestMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -79,6 +80,15 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # WAL lets dashboard reads proceed while a batch is being ingested,
+        # and with it synchronous=NORMAL only syncs at checkpoints.
+        # IMMEDIATE takes the write lock up front, so concurrent ingest
+        # transactions queue on busy_timeout instead of failing to upgrade.
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
@@ -123,3 +133,27 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Monitor ingest limits. The daemon posts compressed batches of packets, so
+# allow larger bodies than Django's 2.5 MB default and cap what a compressed
+# body may expand to.
+DATA_UPLOAD_MAX_MEMORY_SIZE = 16 * 1024 * 1024
+MONITOR_MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
+# Seconds each tier is kept before prune_monitor deletes it: raw PacketInfo /
+# PacketCount / Cookie rows, cookie analytics snapshots, flow records, then
+# the 1 s, 60 s and 3600 s rollups.
+MONITOR_RETENTION = {
+    'raw': 3600,
+    'sketches': 7 * 24 * 3600,
+    'flows': 7 * 24 * 3600,
+    1: 6 * 3600,
+    60: 7 * 24 * 3600,
+    3600: 90 * 24 * 3600,
+}
+MONITOR_PRUNE_INTERVAL = 60
+
+# Seconds read API results are cached. Ingest and pruning invalidate them
+# early. The default cache is per process; with several server processes
+# configure a shared CACHES backend so invalidation reaches all of them.
+MONITOR_QUERY_CACHE_TTL = 10
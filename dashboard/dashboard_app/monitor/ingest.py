@@ -0,0 +1,348 @@
+import hashlib
+import re
+import socket
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import queries, rollups
+from .models import Blob, Cookie, CookieSketch, Flow, PacketCount, PacketInfo, int_to_ip
+
+UINT16_MAX = 2 ** 16 - 1
+UINT32_MAX = 2 ** 32 - 1
+
+# Column name -> (kind, maximum) for every PacketInfo field the daemon sends.
+# 'ipv4' columns take dotted quads or integers and 'protocol' columns names
+# or IP protocol numbers; both are stored as integers.
+PACKET_COLUMNS = {
+    'src_ip': ('ipv4', UINT32_MAX),
+    'dst_ip': ('ipv4', UINT32_MAX),
+    'src_port': ('int', UINT16_MAX),
+    'dst_port': ('int', UINT16_MAX),
+    'protocol': ('protocol', 255),
+    'packet_type': ('int', 255),
+    'packet_len': ('int', UINT32_MAX),
+    'seq_num': ('int', UINT32_MAX),
+    'ack_num': ('int', UINT32_MAX),
+    'tcp_flags': ('int', 255),
+}
+
+# Column name -> (kind, maximum) for the cookie rows; `value` is stored in
+# Cookie.cookie
+COOKIE_COLUMNS = {
+    'src_ip': ('str', 100),
+    'src_port': ('int', UINT16_MAX),
+    'dst_ip': ('str', 100),
+    'dst_port': ('int', UINT16_MAX),
+    'method': ('str', 10),
+    'name_hash': ('int', UINT32_MAX),
+    'value_hash': ('int', UINT32_MAX),
+    'value': ('str', 100),
+    'value_len': ('int', UINT16_MAX),
+}
+
+# Column name -> (kind, maximum) for the daemon's flow records. 'time'
+# columns are Unix timestamps, stored as datetimes.
+FLOW_COLUMNS = {
+    'src_ip': ('ipv4', UINT32_MAX),
+    'dst_ip': ('ipv4', UINT32_MAX),
+    'src_port': ('int', UINT16_MAX),
+    'dst_port': ('int', UINT16_MAX),
+    'protocol': ('protocol', 255),
+    'packets': ('int', 2 ** 63 - 1),
+    'bytes': ('int', 2 ** 63 - 1),
+    'first_seen': ('time', None),
+    'last_seen': ('time', None),
+    'tcp_flags': ('int', 255),
+    'end_reason': ('str', 10),
+}
+
+# Payload references are hex BLAKE2b-128 digests of the UTF-8 body, and the
+# bodies the daemon's captured payloads, at most 2048 bytes
+DIGEST_SIZE = 16
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{32}')
+MAX_BLOB_SIZE = 2048
+
+PROTOCOL_NUMBERS = {label: value for value, label in PacketInfo.Protocol.choices}
+PROTOCOL_LABELS = dict(PacketInfo.Protocol.choices)
+
+BULK_BATCH_SIZE = 2000
+# SQLite limits the number of parameters per query
+LOOKUP_CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 20
+
+
+class IngestError(ValueError):
+    pass
+
+
+def rows_to_columns(rows):
+    """
+    Turn a list of packet dicts into the columnar layout used by ingest.
+    """
+    if not isinstance(rows, list):
+        raise IngestError("packets must be a list")
+    columns = {name: [] for name in PACKET_COLUMNS}
+    for row in rows:
+        if not isinstance(row, dict):
+            row = {}
+        for name, values in columns.items():
+            values.append(row.get(name))
+    return columns
+
+
+def validate_columns(columns, spec=PACKET_COLUMNS):
+    """
+    Validate a whole batch column by column against `spec`.
+
+    Returns the number of rows, a list of per-row flags (True if the row is
+    valid) and a sample of error messages for the rejected rows. 'ipv4' and
+    'protocol' columns are converted to integers and 'time' columns to
+    datetimes in place.
+    """
+    if not isinstance(columns, dict):
+        raise IngestError("columns must be an object")
+    missing = [name for name in spec if name not in columns]
+    if missing:
+        raise IngestError(f"missing columns: {', '.join(missing)}")
+    lengths = {len(columns[name]) if isinstance(columns[name], list) else -1 for name in spec}
+    if len(lengths) != 1 or -1 in lengths:
+        raise IngestError("columns must be lists of equal length")
+
+    size = lengths.pop()
+    valid = [True] * size
+    errors = []
+    for name, (kind, maximum) in spec.items():
+        values = columns[name]
+        for i, value in enumerate(values):
+            if kind == 'ipv4' and type(value) is str:
+                try:
+                    values[i] = int.from_bytes(socket.inet_pton(socket.AF_INET, value), 'big')
+                    ok = True
+                except OSError:
+                    ok = False
+            elif kind == 'protocol' and type(value) is str:
+                values[i] = PROTOCOL_NUMBERS.get(value)
+                ok = values[i] is not None
+            elif kind == 'time':
+                ok = type(value) in (int, float) and value >= 0
+                if ok:
+                    values[i] = datetime.fromtimestamp(value, tz=dt_timezone.utc)
+            elif kind == 'str':
+                ok = type(value) is str and len(value) <= maximum
+            else:
+                ok = type(value) is int and 0 <= value <= maximum
+            if not ok and valid[i]:
+                valid[i] = False
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append(f"row {i}: invalid {name} {value!r}")
+    return size, valid, errors
+
+
+def blob_digest(body):
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=DIGEST_SIZE).hexdigest()
+
+
+def validate_refs(refs, size, valid, errors):
+    """
+    Validate the optional http_data_ref column: a payload digest or null per
+    row. Rows with a malformed reference are flagged invalid.
+    """
+    if not isinstance(refs, list) or len(refs) != size:
+        raise IngestError("http_data_ref must be a list as long as the other columns")
+    for i, ref in enumerate(refs):
+        if ref is None or (type(ref) is str and DIGEST_PATTERN.fullmatch(ref)):
+            continue
+        if valid[i]:
+            valid[i] = False
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(f"row {i}: invalid http_data_ref {ref!r}")
+
+
+def validate_blobs(blobs):
+    """
+    Return the bodies of {digest: body} whose digest matches, and the number
+    of entries that did not.
+    """
+    if not isinstance(blobs, dict):
+        raise IngestError("blobs must be an object")
+    bodies = {
+        digest: body for digest, body in blobs.items()
+        if type(body) is str and len(body) <= MAX_BLOB_SIZE and blob_digest(body) == digest
+    }
+    return bodies, len(blobs) - len(bodies)
+
+
+def store_blobs(references, bodies):
+    """
+    Add `references` (digest -> number of new rows referencing it) to the
+    reference counts, creating the blobs first sent with this batch from
+    `bodies`. Must be called inside the ingest transaction. Returns the
+    blobs by digest and the number created; referenced digests with neither
+    a stored blob nor a body are left out.
+    """
+    digests = list(references)
+    existing = {}
+    for i in range(0, len(digests), LOOKUP_CHUNK_SIZE):
+        existing.update(Blob.objects.in_bulk(digests[i:i + LOOKUP_CHUNK_SIZE], field_name='digest'))
+    for digest, blob in existing.items():
+        blob.refcount += references[digest]
+    Blob.objects.bulk_update(existing.values(), ['refcount'], batch_size=LOOKUP_CHUNK_SIZE)
+    created = [
+        Blob(digest=digest, body=bodies[digest], size=len(bodies[digest]), refcount=count)
+        for digest, count in references.items()
+        if digest not in existing and digest in bodies
+    ]
+    Blob.objects.bulk_create(created, batch_size=BULK_BATCH_SIZE)
+    existing.update((blob.digest, blob) for blob in created)
+    return existing, len(created)
+
+
+def ingest_packets(columns, count=None, sample_rate=1, blobs=None):
+    """
+    Validate a columnar batch of packets and store the valid rows with one
+    bulk INSERT per BULK_BATCH_SIZE rows inside a single transaction. The
+    rollups are updated in the same transaction. sample_rate is the 1-in-N
+    rate the daemon sampled the packets at.
+
+    Payloads arrive as digests in an optional http_data_ref column, with the
+    bodies not stored yet in `blobs` ({digest: body}). Each distinct body is
+    stored once as a Blob and the packets reference it. Rows referencing a
+    digest the dashboard has no body for are rejected rather than stored
+    without their payload, and the digests reported under 'blobs' as
+    'missing', for the daemon to send those rows again with their bodies.
+    """
+    if count is not None and not (type(count) is int and count >= 0):
+        raise IngestError("count must be a non-negative integer")
+    if not (type(sample_rate) is int and sample_rate >= 1):
+        raise IngestError("sample_rate must be a positive integer")
+    size, valid, errors = validate_columns(columns)
+    refs = columns.get('http_data_ref')
+    if refs is not None:
+        validate_refs(refs, size, valid, errors)
+    bodies, invalid_blobs = validate_blobs(blobs) if blobs is not None else ({}, 0)
+    names = list(PACKET_COLUMNS)
+    packets = [
+        PacketInfo(**dict(zip(names, row)))
+        for row, ok in zip(zip(*(columns[name] for name in names)), valid)
+        if ok
+    ]
+    refs = [ref for ref, ok in zip(refs, valid) if ok] if refs is not None else []
+    now = timezone.now()
+    with transaction.atomic():
+        if count is not None:
+            PacketCount.objects.create(count=count, sample_rate=sample_rate)
+            rollups.record_count(count, now)
+        stored, created = store_blobs(Counter(ref for ref in refs if ref is not None), bodies)
+        missing = {ref for ref in refs if ref is not None and ref not in stored}
+        if missing:
+            packets = [packet for packet, ref in zip(packets, refs) if ref not in missing]
+            refs = [ref for ref in refs if ref not in missing]
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append(f"{len(missing)} payload digests without a stored body")
+        for packet, ref in zip(packets, refs):
+            if ref is not None:
+                packet.payload = stored[ref]
+        PacketInfo.objects.bulk_create(packets, batch_size=BULK_BATCH_SIZE)
+        # Rollups are keyed by address and protocol name
+        addresses = {ip: int_to_ip(ip) for ip in {packet.src_ip for packet in packets}}
+        rollups.record_packets(
+            [addresses[packet.src_ip] for packet in packets],
+            [PROTOCOL_LABELS.get(packet.protocol, str(packet.protocol)) for packet in packets],
+            [packet.packet_len for packet in packets],
+            now,
+            sample_rate,
+        )
+    queries.invalidate()
+    rollups.maybe_prune(now)
+    result = {
+        'accepted': len(packets),
+        'rejected': size - len(packets),
+        'errors': errors,
+    }
+    if refs or blobs is not None:
+        result['blobs'] = {
+            'created': created,
+            'rejected': invalid_blobs,
+            'missing': sorted(missing),
+        }
+    return result
+
+
+def ingest_cookies(columns):
+    """
+    Validate a columnar batch of cookie rows and bulk insert the valid ones.
+    """
+    size, valid, errors = validate_columns(columns, COOKIE_COLUMNS)
+    names = ['cookie' if name == 'value' else name for name in COOKIE_COLUMNS]
+    cookies = [
+        Cookie(**dict(zip(names, row)))
+        for row, ok in zip(zip(*(columns[name] for name in COOKIE_COLUMNS)), valid)
+        if ok
+    ]
+    Cookie.objects.bulk_create(cookies, batch_size=BULK_BATCH_SIZE)
+    return {
+        'accepted': len(cookies),
+        'rejected': size - len(cookies),
+        'errors': errors,
+    }
+
+
+def ingest_flows(columns):
+    """
+    Validate a columnar batch of flow records and bulk insert the valid ones.
+    """
+    size, valid, errors = validate_columns(columns, FLOW_COLUMNS)
+    names = list(FLOW_COLUMNS)
+    flows = [
+        Flow(**dict(zip(names, row)))
+        for row, ok in zip(zip(*(columns[name] for name in names)), valid)
+        if ok
+    ]
+    Flow.objects.bulk_create(flows, batch_size=BULK_BATCH_SIZE)
+    queries.invalidate()
+    return {
+        'accepted': len(flows),
+        'rejected': size - len(flows),
+        'errors': errors,
+    }
+
+
+def _timestamp(value):
+    if type(value) not in (int, float):
+        raise IngestError(f"invalid timestamp {value!r}")
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+
+
+def _entries(value, keys):
+    if not isinstance(value, list) or not all(isinstance(entry, dict) and keys <= entry.keys() for entry in value):
+        raise IngestError(f"expected a list of objects with {', '.join(sorted(keys))}")
+    return value
+
+
+def ingest_sketches(snapshots):
+    """
+    Store the daemon's cookie analytics snapshots.
+    """
+    if not isinstance(snapshots, list):
+        raise IngestError("sketches must be a list")
+    rows = []
+    for snapshot in snapshots:
+        if not isinstance(snapshot, dict):
+            raise IngestError("sketches must be a list of objects")
+        totals = {name: snapshot.get(name) for name in ('requests', 'cookies', 'distinct_cookies')}
+        for name, value in totals.items():
+            if not (type(value) is int and value >= 0):
+                raise IngestError(f"invalid {name} {value!r}")
+        rows.append(CookieSketch(
+            window_start=_timestamp(snapshot.get('window_start')),
+            window_end=_timestamp(snapshot.get('window_end')),
+            sources=_entries(snapshot.get('sources', []), {'src_ip', 'requests', 'distinct_cookies'}),
+            top_names=_entries(snapshot.get('top_names', []), {'name', 'count'}),
+            top_values=_entries(snapshot.get('top_values', []), {'value', 'count'}),
+            **totals,
+        ))
+    CookieSketch.objects.bulk_create(rows)
+    return len(rows)
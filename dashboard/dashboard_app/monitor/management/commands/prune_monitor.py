@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from monitor import rollups
+
+
+class Command(BaseCommand):
+    help = "Delete raw packets and rollups older than the MONITOR_RETENTION policy"
+
+    def handle(self, *args, **options):
+        for model, deleted in rollups.prune().items():
+            self.stdout.write(f"{model}: {deleted} rows deleted")
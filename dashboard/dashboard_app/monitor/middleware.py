@@ -0,0 +1,59 @@
+import gzip
+import io
+import zlib
+
+from django.conf import settings
+from django.http import HttpResponse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class DecompressRequestMiddleware:
+    """
+    Transparently decompress gzip and zstd encoded request bodies sent by the
+    user daemon's exporter, so views and DRF parsers see plain JSON.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.max_size = getattr(settings, 'MONITOR_MAX_DECOMPRESSED_SIZE', 64 * 1024 * 1024)
+
+    def __call__(self, request):
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('gzip', 'zstd'):
+            try:
+                body = self.decompress(request.body, encoding)
+            except (OSError, EOFError, zlib.error, ValueError) as e:
+                return HttpResponse(f"Invalid {encoding} body: {e}", status=400)
+            if body is None:
+                return HttpResponse("Decompressed body too large", status=413)
+            request._body = body
+            request.META['CONTENT_LENGTH'] = str(len(body))
+            del request.META['HTTP_CONTENT_ENCODING']
+        return self.get_response(request)
+
+    def decompress(self, body, encoding):
+        """
+        Decompress a request body, returning None if it exceeds max_size.
+        """
+        if encoding == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd support is not installed")
+            reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body))
+        else:
+            reader = gzip.GzipFile(fileobj=io.BytesIO(body))
+        chunks = []
+        size = 0
+        with reader:
+            while True:
+                chunk = reader.read(1024 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > self.max_size:
+                    return None
+                chunks.append(chunk)
+        return b''.join(chunks)
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0003_alter_packetinfo_dst_ip_alter_packetinfo_packet_type_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProtocolRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('protocol', models.CharField(max_length=100)),
+                ('packets', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('resolution', 'bucket', 'protocol'), name='protocol_rollup_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='SourceRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('src_ip', models.CharField(max_length=100)),
+                ('packets', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('resolution', 'bucket', 'src_ip'), name='source_rollup_bucket')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TrafficRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveIntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('packets', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('distinct_sources', models.IntegerField(default=0)),
+                ('packet_count', models.BigIntegerField(null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('resolution', 'bucket'), name='traffic_rollup_bucket')],
+            },
+        ),
+    ]
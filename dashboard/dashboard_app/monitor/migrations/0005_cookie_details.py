@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0004_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cookie',
+            name='dst_ip',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='dst_port',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='method',
+            field=models.CharField(default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='name_hash',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='src_ip',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='src_port',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='value_hash',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cookie',
+            name='value_len',
+            field=models.IntegerField(default=0),
+        ),
+    ]
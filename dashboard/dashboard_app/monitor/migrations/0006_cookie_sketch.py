@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0005_cookie_details'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CookieSketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('window_start', models.DateTimeField()),
+                ('window_end', models.DateTimeField()),
+                ('requests', models.BigIntegerField()),
+                ('cookies', models.BigIntegerField()),
+                ('distinct_cookies', models.BigIntegerField()),
+                ('sources', models.JSONField(default=list)),
+                ('top_names', models.JSONField(default=list)),
+                ('top_values', models.JSONField(default=list)),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0006_cookie_sketch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packetcount',
+            name='sample_rate',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='trafficrollup',
+            name='estimated_packets',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,144 @@
+import ipaddress
+
+from django.db import migrations, models
+
+# Rows converted per query
+BATCH_SIZE = 5000
+
+PROTOCOL_NUMBERS = {'ICMP': 1, 'TCP': 6, 'UDP': 17}
+PROTOCOL_NAMES = {number: name for name, number in PROTOCOL_NUMBERS.items()}
+
+
+def _ip_to_int(value):
+    try:
+        return int(ipaddress.IPv4Address(value))
+    except ValueError:
+        return 0
+
+
+def _int_to_ip(value):
+    return str(ipaddress.IPv4Address(value))
+
+
+def _convert(apps, schema_editor, fields, convert, sql):
+    """
+    Rewrite every PacketInfo row. On SQLite that is a single UPDATE calling
+    the converters as SQL functions, elsewhere batches of BATCH_SIZE rows.
+    """
+    PacketInfo = apps.get_model('monitor', 'PacketInfo')
+    if schema_editor.connection.vendor == 'sqlite':
+        connection = schema_editor.connection.connection
+        connection.create_function('ip_to_int', 1, _ip_to_int, deterministic=True)
+        connection.create_function('int_to_ip', 1, _int_to_ip, deterministic=True)
+        schema_editor.execute(f"UPDATE {PacketInfo._meta.db_table} SET {sql}")
+        return
+    last_id = 0
+    while True:
+        rows = list(PacketInfo.objects.filter(id__gt=last_id).order_by('id')[:BATCH_SIZE])
+        if not rows:
+            break
+        for row in rows:
+            convert(row)
+        PacketInfo.objects.bulk_update(rows, fields, batch_size=BATCH_SIZE)
+        last_id = rows[-1].id
+
+
+def forwards(apps, schema_editor):
+    def convert(row):
+        row.src_ip = _ip_to_int(row.src_ip_text)
+        row.dst_ip = _ip_to_int(row.dst_ip_text)
+        row.protocol = PROTOCOL_NUMBERS.get(row.protocol_text, 255)
+        row.packet_type = int(row.packet_type_text) if row.packet_type_text.isdigit() else 0
+    protocol = " ".join(f"WHEN '{name}' THEN {number}" for name, number in PROTOCOL_NUMBERS.items())
+    _convert(apps, schema_editor, ['src_ip', 'dst_ip', 'protocol', 'packet_type'], convert,
+             "src_ip = ip_to_int(src_ip_text), dst_ip = ip_to_int(dst_ip_text), "
+             f"protocol = CASE protocol_text {protocol} ELSE 255 END, "
+             "packet_type = CAST(packet_type_text AS INTEGER)")
+
+
+def backwards(apps, schema_editor):
+    def convert(row):
+        row.src_ip_text = _int_to_ip(row.src_ip)
+        row.dst_ip_text = _int_to_ip(row.dst_ip)
+        row.protocol_text = PROTOCOL_NAMES.get(row.protocol, 'Unknown')
+        row.packet_type_text = str(row.packet_type)
+    protocol = " ".join(f"WHEN {number} THEN '{name}'" for number, name in PROTOCOL_NAMES.items())
+    _convert(apps, schema_editor, ['src_ip_text', 'dst_ip_text', 'protocol_text', 'packet_type_text'], convert,
+             "src_ip_text = int_to_ip(src_ip), dst_ip_text = int_to_ip(dst_ip), "
+             f"protocol_text = CASE protocol {protocol} ELSE 'Unknown' END, "
+             "packet_type_text = CAST(packet_type AS TEXT)")
+
+
+class Migration(migrations.Migration):
+    """
+    Store PacketInfo addresses as integers and protocol and packet type as
+    small integers, converting the existing rows, and index the
+    columns the dashboard sorts and filters by.
+    """
+
+    dependencies = [
+        ('monitor', '0007_sample_rate'),
+    ]
+
+    operations = [
+        migrations.RenameField(model_name='packetinfo', old_name='src_ip', new_name='src_ip_text'),
+        migrations.RenameField(model_name='packetinfo', old_name='dst_ip', new_name='dst_ip_text'),
+        migrations.RenameField(model_name='packetinfo', old_name='protocol', new_name='protocol_text'),
+        migrations.RenameField(model_name='packetinfo', old_name='packet_type', new_name='packet_type_text'),
+        migrations.AddField(
+            model_name='packetinfo',
+            name='src_ip',
+            field=models.PositiveBigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='packetinfo',
+            name='dst_ip',
+            field=models.PositiveBigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='packetinfo',
+            name='protocol',
+            field=models.PositiveSmallIntegerField(
+                choices=[(1, 'ICMP'), (6, 'TCP'), (17, 'UDP'), (255, 'Unknown')], default=255),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='packetinfo',
+            name='packet_type',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'TCP'), (1, 'UDP'), (2, 'ICMP')], default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(forwards, backwards),
+        # Defaults only so that unapplying can re-add the columns
+        *(migrations.AlterField(model_name='packetinfo', name=name,
+                                field=models.CharField(max_length=100, default=''))
+          for name in ('src_ip_text', 'dst_ip_text', 'protocol_text', 'packet_type_text')),
+        migrations.RemoveField(model_name='packetinfo', name='src_ip_text'),
+        migrations.RemoveField(model_name='packetinfo', name='dst_ip_text'),
+        migrations.RemoveField(model_name='packetinfo', name='protocol_text'),
+        migrations.RemoveField(model_name='packetinfo', name='packet_type_text'),
+        migrations.AlterField(
+            model_name='packetinfo',
+            name='seq_num',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AlterField(
+            model_name='packetinfo',
+            name='ack_num',
+            field=models.BigIntegerField(),
+        ),
+        migrations.AddIndex(
+            model_name='packetinfo',
+            index=models.Index(fields=['timestamp'], name='packetinfo_timestamp'),
+        ),
+        migrations.AddIndex(
+            model_name='packetinfo',
+            index=models.Index(fields=['src_ip', 'timestamp'], name='packetinfo_src_ip'),
+        ),
+        migrations.AddIndex(
+            model_name='packetinfo',
+            index=models.Index(fields=['dst_port', 'timestamp'], name='packetinfo_dst_port'),
+        ),
+    ]
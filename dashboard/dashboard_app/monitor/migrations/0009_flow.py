@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitor', '0008_compact_packetinfo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Flow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('src_ip', models.PositiveBigIntegerField()),
+                ('dst_ip', models.PositiveBigIntegerField()),
+                ('src_port', models.IntegerField()),
+                ('dst_port', models.IntegerField()),
+                ('protocol', models.PositiveSmallIntegerField(choices=[(1, 'ICMP'), (6, 'TCP'), (17, 'UDP'), (255, 'Unknown')])),
+                ('packets', models.BigIntegerField()),
+                ('bytes', models.BigIntegerField()),
+                ('first_seen', models.DateTimeField()),
+                ('last_seen', models.DateTimeField()),
+                ('tcp_flags', models.IntegerField()),
+                ('end_reason', models.CharField(choices=[('fin', 'FIN'), ('rst', 'RST'), ('idle', 'Idle timeout'), ('active', 'Active timeout'), ('evicted', 'Evicted'), ('shutdown', 'Daemon shutdown')], max_length=10)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['timestamp'], name='flow_timestamp'), models.Index(fields=['src_ip', 'timestamp'], name='flow_src_ip')],
+            },
+        ),
+    ]
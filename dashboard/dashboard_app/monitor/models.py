@@ -1,36 +1,224 @@
+import ipaddress
+
 from django.db import models
 
 
 
 
+def int_to_ip(value):
+    return str(ipaddress.IPv4Address(value))
+
+
 class PacketInfo(models.Model):
-    src_ip = models.CharField(max_length=100)
-    dst_ip = models.CharField(max_length=100)
+    """
+    One captured packet. Addresses are stored as IPv4 integers and the
+    protocol as its IP protocol number, which keeps rows small; use
+    src_address/dst_address and get_protocol_display() to show them.
+    """
+    class Protocol(models.IntegerChoices):
+        ICMP = 1, 'ICMP'
+        TCP = 6, 'TCP'
+        UDP = 17, 'UDP'
+        UNKNOWN = 255, 'Unknown'
+
+    class PacketType(models.IntegerChoices):
+        TCP = 0, 'TCP'
+        UDP = 1, 'UDP'
+        ICMP = 2, 'ICMP'
+
+    src_ip = models.PositiveBigIntegerField()
+    dst_ip = models.PositiveBigIntegerField()
     src_port = models.IntegerField()
     dst_port = models.IntegerField()
-    protocol = models.CharField(max_length=100)
-    packet_type = models.CharField(max_length=100)
+    protocol = models.PositiveSmallIntegerField(choices=Protocol.choices)
+    packet_type = models.PositiveSmallIntegerField(choices=PacketType.choices)
     packet_len = models.IntegerField()
-    seq_num = models.IntegerField()
-    ack_num = models.IntegerField()
+    seq_num = models.BigIntegerField()
+    ack_num = models.BigIntegerField()
     tcp_flags = models.IntegerField()
+    payload = models.ForeignKey('Blob', null=True, blank=True, on_delete=models.SET_NULL, related_name='packets')
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'], name='packetinfo_timestamp'),
+            models.Index(fields=['src_ip', 'timestamp'], name='packetinfo_src_ip'),
+            models.Index(fields=['dst_port', 'timestamp'], name='packetinfo_dst_port'),
+        ]
+
+    @property
+    def src_address(self):
+        return int_to_ip(self.src_ip)
+
+    @property
+    def dst_address(self):
+        return int_to_ip(self.dst_ip)
+
+    def __str__(self):
+        return f"{self.src_address} -> {self.dst_address} ({self.get_protocol_display()})"
+
+class Blob(models.Model):
+    """
+    One distinct HTTP payload, stored once however many packets carried it.
+    `digest` is the hex BLAKE2b-128 digest of the UTF-8 body, which the
+    daemon sends in place of bodies the dashboard already has. `refcount`
+    counts the packets referencing the blob; retention deletes it once that
+    drops to zero.
+    """
+    digest = models.CharField(max_length=32, unique=True)
+    body = models.TextField()
+    size = models.IntegerField()
+    refcount = models.BigIntegerField(default=0)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.digest} ({self.size} characters, {self.refcount} references)"
+
+
+class Flow(models.Model):
+    """
+    One unidirectional flow aggregated by the daemon: the packets and bytes
+    of a 5-tuple between first_seen and last_seen. A flow seen for longer
+    than the daemon's active timeout arrives as several records.
+    """
+    class EndReason(models.TextChoices):
+        FIN = 'fin', 'FIN'
+        RST = 'rst', 'RST'
+        IDLE = 'idle', 'Idle timeout'
+        ACTIVE = 'active', 'Active timeout'
+        EVICTED = 'evicted', 'Evicted'
+        SHUTDOWN = 'shutdown', 'Daemon shutdown'
+
+    src_ip = models.PositiveBigIntegerField()
+    dst_ip = models.PositiveBigIntegerField()
+    src_port = models.IntegerField()
+    dst_port = models.IntegerField()
+    protocol = models.PositiveSmallIntegerField(choices=PacketInfo.Protocol.choices)
+    packets = models.BigIntegerField()
+    bytes = models.BigIntegerField()
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField()
+    tcp_flags = models.IntegerField()  # OR of the packets' flags
+    end_reason = models.CharField(max_length=10, choices=EndReason.choices)
     timestamp = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['timestamp'], name='flow_timestamp'),
+            models.Index(fields=['src_ip', 'timestamp'], name='flow_src_ip'),
+        ]
+
+    @property
+    def src_address(self):
+        return int_to_ip(self.src_ip)
+
+    @property
+    def dst_address(self):
+        return int_to_ip(self.dst_ip)
+
     def __str__(self):
-        return f"{self.src_ip} -> {self.dst_ip} ({self.protocol})"
+        return f"{self.src_address}:{self.src_port} -> {self.dst_address}:{self.dst_port}: {self.packets} packets"
+
 
 class PacketCount(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     count = models.BigIntegerField()
+    sample_rate = models.PositiveIntegerField(default=1)  # 1-in-N sampling of the packets shipped with it
 
     def __str__(self):
         return f"{self.timestamp}: {self.count}"
     
 
 class Cookie(models.Model):
+    """
+    One cookie seen in an HTTP request. The daemon only ships hashes of the
+    name and value and the first bytes of the value, which go in `cookie`.
+    """
     cookie = models.CharField(max_length=100)
     timestamp = models.DateTimeField(auto_now_add=True)
+    src_ip = models.CharField(max_length=100, default='')
+    src_port = models.IntegerField(default=0)
+    dst_ip = models.CharField(max_length=100, default='')
+    dst_port = models.IntegerField(default=0)
+    method = models.CharField(max_length=10, default='')
+    name_hash = models.BigIntegerField(default=0)   # FNV-1a, 32 bit
+    value_hash = models.BigIntegerField(default=0)  # FNV-1a, 32 bit
+    value_len = models.IntegerField(default=0)      # Length of the whole value
 
     def __str__(self):
         return f"{self.cookie} - {self.timestamp}"
 
+
+
+class TrafficRollup(models.Model):
+    """
+    Packets, bytes and distinct sources per time bucket. `resolution` is the
+    bucket width in seconds.
+    """
+    resolution = models.PositiveIntegerField()
+    bucket = models.DateTimeField()
+    packets = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    distinct_sources = models.IntegerField(default=0)
+    packet_count = models.BigIntegerField(null=True)  # last PacketCount reading in the bucket
+    estimated_packets = models.BigIntegerField(default=0)  # packets scaled by their sample rate
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['resolution', 'bucket'], name='traffic_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket} ({self.resolution}s): {self.packets} packets"
+
+
+class ProtocolRollup(models.Model):
+    resolution = models.PositiveIntegerField()
+    bucket = models.DateTimeField()
+    protocol = models.CharField(max_length=100)
+    packets = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['resolution', 'bucket', 'protocol'], name='protocol_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket} ({self.resolution}s) {self.protocol}: {self.packets} packets"
+
+
+class SourceRollup(models.Model):
+    resolution = models.PositiveIntegerField()
+    bucket = models.DateTimeField()
+    src_ip = models.CharField(max_length=100)
+    packets = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['resolution', 'bucket', 'src_ip'], name='source_rollup_bucket'),
+        ]
+
+    def __str__(self):
+        return f"{self.bucket} ({self.resolution}s) {self.src_ip}: {self.packets} packets"
+
+
+class CookieSketch(models.Model):
+    """
+    Cookie analytics for one window of the daemon's streaming sketches:
+    totals, distinct cookies (HyperLogLog estimates) and the heaviest
+    sources, cookie names and name=value pairs.
+    """
+    timestamp = models.DateTimeField(auto_now_add=True)
+    window_start = models.DateTimeField()
+    window_end = models.DateTimeField()
+    requests = models.BigIntegerField()
+    cookies = models.BigIntegerField()
+    distinct_cookies = models.BigIntegerField()
+    sources = models.JSONField(default=list)     # [{"src_ip", "requests", "distinct_cookies"}]
+    top_names = models.JSONField(default=list)   # [{"name", "count"}]
+    top_values = models.JSONField(default=list)  # [{"value", "count"}]
+
+    def __str__(self):
+        return f"{self.window_start} - {self.window_end}: {self.distinct_cookies} distinct cookies"
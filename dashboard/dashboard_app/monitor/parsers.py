@@ -0,0 +1,29 @@
+import json
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    """
+    Parses newline-delimited JSON. The first line may be a header object of
+    the form {"header": {...}}; every other line is one packet.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        header = {}
+        rows = []
+        try:
+            for number, line in enumerate(stream):
+                line = line.strip()
+                if not line:
+                    continue
+                row = json.loads(line)
+                if number == 0 and isinstance(row, dict) and 'header' in row:
+                    header = row['header']
+                else:
+                    rows.append(row)
+        except ValueError as e:
+            raise ParseError(f"NDJSON parse error - {e}")
+        return {'header': header, 'packets': rows}
@@ -0,0 +1,248 @@
+import hashlib
+import ipaddress
+import json
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncHour, TruncMinute, TruncSecond
+from django.utils.dateparse import parse_datetime
+
+from .models import Flow, PacketCount, PacketInfo, TrafficRollup, int_to_ip
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_TOP = 10
+MAX_TOP = 1000
+
+# Interval widths in seconds the timeline can group by
+INTERVALS = {1: TruncSecond, 60: TruncMinute, 3600: TruncHour}
+
+PACKET_FIELDS = ('id', 'timestamp', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'protocol',
+                 'packet_type', 'packet_len', 'seq_num', 'ack_num', 'tcp_flags', 'payload__digest')
+FLOW_FIELDS = ('id', 'timestamp', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'protocol', 'packets', 'bytes',
+               'first_seen', 'last_seen', 'tcp_flags', 'end_reason')
+
+# Bumped on every ingest and prune; part of every cache key, so cached
+# results are dropped as soon as the data behind them changes
+GENERATION_KEY = 'monitor:query-generation'
+
+PROTOCOLS = dict(PacketInfo.Protocol.choices)
+PROTOCOL_NUMBERS = {label.lower(): value for value, label in PacketInfo.Protocol.choices}
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _int(params, name, default, maximum=None):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise QueryError(f"{name} must be an integer")
+    if value < 0 or (maximum is not None and value > maximum):
+        raise QueryError(f"{name} must be between 0 and {maximum}")
+    return value
+
+
+def _time(params, name):
+    """
+    A datetime from an ISO 8601 string or a Unix timestamp.
+    """
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return datetime.fromtimestamp(float(value), tz=dt_timezone.utc)
+    except ValueError:
+        pass
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise QueryError(f"{name} must be an ISO 8601 time or a Unix timestamp")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=dt_timezone.utc)
+
+
+def _address_range(params, name):
+    """
+    (first, last) integer addresses of an IPv4 address or CIDR.
+    """
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        network = ipaddress.IPv4Network(value, strict=False)
+    except ValueError:
+        raise QueryError(f"{name} must be an IPv4 address or network")
+    return int(network.network_address), int(network.broadcast_address)
+
+
+def packet_filters(params):
+    """
+    Q object for the packet filters in `params`: since/until (ISO 8601 or
+    Unix time), src_ip/dst_ip (address or CIDR), port (either end),
+    src_port/dst_port and protocol (name or number).
+    """
+    q = Q()
+    since, until = _time(params, 'since'), _time(params, 'until')
+    if since:
+        q &= Q(timestamp__gte=since)
+    if until:
+        q &= Q(timestamp__lt=until)
+    for name in ('src_ip', 'dst_ip'):
+        addresses = _address_range(params, name)
+        if addresses:
+            first, last = addresses
+            q &= Q(**{name: first}) if first == last else Q(**{f'{name}__range': addresses})
+    port = _int(params, 'port', None, 65535)
+    if port is not None:
+        q &= Q(src_port=port) | Q(dst_port=port)
+    for name in ('src_port', 'dst_port'):
+        value = _int(params, name, None, 65535)
+        if value is not None:
+            q &= Q(**{name: value})
+    protocol = params.get('protocol')
+    if protocol not in (None, ''):
+        number = PROTOCOL_NUMBERS.get(protocol.lower())
+        if number is None:
+            number = _int(params, 'protocol', None, 255)
+        q &= Q(protocol=number)
+    return q
+
+
+def _page(queryset, params, fields, convert=None):
+    """
+    Keyset pagination, newest first: `cursor` is the id of the last row of
+    the previous page, so each page is an index range scan whatever its
+    depth.
+    """
+    limit = _int(params, 'limit', DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE) or DEFAULT_PAGE_SIZE
+    cursor = _int(params, 'cursor', None)
+    if cursor is not None:
+        queryset = queryset.filter(id__lt=cursor)
+    rows = list(queryset.order_by('-id').values(*fields)[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        if convert:
+            convert(row)
+    return {'results': rows, 'next_cursor': rows[-1]['id'] if more else None}
+
+
+def _packet_row(row):
+    row['src_ip'] = int_to_ip(row['src_ip'])
+    row['dst_ip'] = int_to_ip(row['dst_ip'])
+    row['protocol'] = PROTOCOLS.get(row['protocol'], str(row['protocol']))
+
+
+def _packet_page_row(row):
+    _packet_row(row)
+    row['payload'] = row.pop('payload__digest')  # See GET /api/blobs/<digest>/
+
+
+def packets(params):
+    return _page(PacketInfo.objects.filter(packet_filters(params)), params, PACKET_FIELDS, _packet_page_row)
+
+
+def _flow_row(row):
+    _packet_row(row)
+    row['first_seen'] = row['first_seen'].isoformat()
+    row['last_seen'] = row['last_seen'].isoformat()
+
+
+def flows(params):
+    """
+    Flow records, with the packet filters; since/until apply to the time
+    the record was stored.
+    """
+    return _page(Flow.objects.filter(packet_filters(params)), params, FLOW_FIELDS, _flow_row)
+
+
+def counts(params):
+    q = Q()
+    since, until = _time(params, 'since'), _time(params, 'until')
+    if since:
+        q &= Q(timestamp__gte=since)
+    if until:
+        q &= Q(timestamp__lt=until)
+    return _page(PacketCount.objects.filter(q), params, ('id', 'timestamp', 'count', 'sample_rate'))
+
+
+def top_talkers(params):
+    """
+    Sources with the most packets matching the filters.
+    """
+    top = _int(params, 'top', DEFAULT_TOP, MAX_TOP)
+    rows = (PacketInfo.objects.filter(packet_filters(params)).values('src_ip')
+            .annotate(packets=Count('id'), bytes=Sum('packet_len')).order_by('-packets', 'src_ip')[:top])
+    return {'results': [{**row, 'src_ip': int_to_ip(row['src_ip'])} for row in rows]}
+
+
+def port_bytes(params):
+    """
+    Bytes and packets per destination port for packets matching the filters.
+    """
+    top = _int(params, 'top', DEFAULT_TOP, MAX_TOP)
+    rows = (PacketInfo.objects.filter(packet_filters(params)).values('dst_port')
+            .annotate(bytes=Sum('packet_len'), packets=Count('id')).order_by('-bytes', 'dst_port')[:top])
+    return {'results': list(rows)}
+
+
+def timeline(params):
+    """
+    Packets and bytes per `interval` seconds (1, 60 or 3600). Unfiltered
+    queries read the rollups, which also cover history older than the raw
+    rows; any packet filter switches to grouping raw rows.
+    """
+    interval = _int(params, 'interval', 60)
+    if interval not in INTERVALS:
+        raise QueryError(f"interval must be one of {', '.join(map(str, INTERVALS))}")
+    limit = _int(params, 'limit', DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE) or DEFAULT_PAGE_SIZE
+    since, until = _time(params, 'since'), _time(params, 'until')
+    time_only = not any(params.get(name) for name in ('src_ip', 'dst_ip', 'port', 'src_port', 'dst_port', 'protocol'))
+
+    if time_only:
+        rows = TrafficRollup.objects.filter(resolution=interval)
+        if since:
+            rows = rows.filter(bucket__gte=since)
+        if until:
+            rows = rows.filter(bucket__lt=until)
+        rows = rows.order_by('-bucket').values('bucket', 'packets', 'bytes', 'estimated_packets')[:limit]
+    else:
+        rows = (PacketInfo.objects.filter(packet_filters(params))
+                .annotate(bucket=INTERVALS[interval]('timestamp')).values('bucket')
+                .annotate(packets=Count('id'), bytes=Sum('packet_len')).order_by('-bucket')[:limit])
+    results = [{**row, 'bucket': row['bucket'].isoformat()} for row in rows]
+    results.reverse()
+    return {'interval': interval, 'source': 'rollups' if time_only else 'packets', 'results': results}
+
+
+def invalidate():
+    """
+    Drop every cached query result. Called after ingest and pruning.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, 1, None)
+
+
+def cached(name, query, params):
+    """
+    Run query(params) through the cache for MONITOR_QUERY_CACHE_TTL seconds.
+    """
+    ttl = getattr(settings, 'MONITOR_QUERY_CACHE_TTL', 10)
+    if not ttl:
+        return query(params)
+    generation = cache.get_or_set(GENERATION_KEY, 0, None)
+    digest = hashlib.sha1(json.dumps(sorted(params.items())).encode()).hexdigest()
+    key = f'monitor:query:{generation}:{name}:{digest}'
+    result = cache.get(key)
+    if result is None:
+        result = query(params)
+        cache.set(key, result, ttl)
+    return result
@@ -0,0 +1,182 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from . import queries
+from .models import Blob, Cookie, CookieSketch, Flow, PacketCount, PacketInfo, ProtocolRollup, SourceRollup, TrafficRollup
+
+# Bucket widths in seconds
+RESOLUTIONS = (1, 60, 3600)
+
+# How long each tier is kept, in seconds. 'raw' covers PacketInfo,
+# PacketCount and Cookie rows, and payload Blobs go with the last packet
+# referencing them; the rollups keep the long-term history, 'sketches' the
+# cookie analytics snapshots and 'flows' the flow records.
+DEFAULT_RETENTION = {
+    'raw': 3600,
+    'sketches': 7 * 24 * 3600,
+    'flows': 7 * 24 * 3600,
+    1: 6 * 3600,
+    60: 7 * 24 * 3600,
+    3600: 90 * 24 * 3600,
+}
+
+# SQLite limits the number of parameters per query
+LOOKUP_CHUNK_SIZE = 500
+
+_last_prune = None
+
+
+def bucket_start(timestamp, resolution):
+    seconds = int(timestamp.timestamp()) // resolution * resolution
+    return datetime.fromtimestamp(seconds, tz=dt_timezone.utc)
+
+
+def retention():
+    return {**DEFAULT_RETENTION, **getattr(settings, 'MONITOR_RETENTION', {})}
+
+
+def _chunks(items, size=LOOKUP_CHUNK_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _upsert(model, key_field, resolution, bucket, totals):
+    """
+    Add packet/byte totals to the rollup rows of one bucket, keyed by
+    `key_field`. Returns the number of rows created.
+    """
+    existing = {}
+    for keys in _chunks(totals):
+        rows = model.objects.filter(resolution=resolution, bucket=bucket, **{f'{key_field}__in': keys})
+        existing.update((getattr(row, key_field), row) for row in rows)
+
+    updated = []
+    created = []
+    for key, (packets, size) in totals.items():
+        row = existing.get(key)
+        if row is None:
+            created.append(model(resolution=resolution, bucket=bucket, packets=packets, bytes=size,
+                                 **{key_field: key}))
+        else:
+            row.packets += packets
+            row.bytes += size
+            updated.append(row)
+    model.objects.bulk_update(updated, ['packets', 'bytes'], batch_size=LOOKUP_CHUNK_SIZE)
+    model.objects.bulk_create(created, batch_size=LOOKUP_CHUNK_SIZE)
+    return len(created)
+
+
+def record_packets(src_ips, protocols, lengths, timestamp=None, sample_rate=1):
+    """
+    Fold a batch of ingested packets into every rollup resolution. Must be
+    called inside the ingest transaction. Packets sampled 1 in `sample_rate`
+    count that many times towards estimated_packets.
+    """
+    if not src_ips:
+        return
+    timestamp = timestamp or timezone.now()
+
+    by_protocol = defaultdict(lambda: [0, 0])
+    by_source = defaultdict(lambda: [0, 0])
+    for src_ip, protocol, length in zip(src_ips, protocols, lengths):
+        totals = by_protocol[protocol]
+        totals[0] += 1
+        totals[1] += length
+        totals = by_source[src_ip]
+        totals[0] += 1
+        totals[1] += length
+    packets = len(src_ips)
+    size = sum(lengths)
+
+    for resolution in RESOLUTIONS:
+        bucket = bucket_start(timestamp, resolution)
+        _upsert(ProtocolRollup, 'protocol', resolution, bucket, by_protocol)
+        new_sources = _upsert(SourceRollup, 'src_ip', resolution, bucket, by_source)
+
+        traffic, _ = TrafficRollup.objects.get_or_create(resolution=resolution, bucket=bucket)
+        traffic.packets += packets
+        traffic.bytes += size
+        traffic.distinct_sources += new_sources
+        traffic.estimated_packets += packets * sample_rate
+        traffic.save(update_fields=['packets', 'bytes', 'distinct_sources', 'estimated_packets'])
+
+
+def record_count(count, timestamp=None):
+    """
+    Store the latest cumulative PacketCount reading on every resolution.
+    """
+    timestamp = timestamp or timezone.now()
+    for resolution in RESOLUTIONS:
+        TrafficRollup.objects.update_or_create(
+            resolution=resolution,
+            bucket=bucket_start(timestamp, resolution),
+            defaults={'packet_count': count},
+        )
+
+
+def release_blobs(packets):
+    """
+    Take the references held by the `packets` queryset off their payload
+    blobs, before the packets are deleted. Must be called inside the
+    deleting transaction.
+    """
+    references = dict(packets.exclude(payload=None).values_list('payload').annotate(count=Count('id')))
+    blobs = []
+    for ids in _chunks(references):
+        for blob in Blob.objects.filter(id__in=ids):
+            blob.refcount -= references[blob.id]
+            blobs.append(blob)
+    Blob.objects.bulk_update(blobs, ['refcount'], batch_size=LOOKUP_CHUNK_SIZE)
+
+
+def prune(now=None):
+    """
+    Delete raw rows and rollups that are older than their retention period.
+    Returns the number of deleted rows per model.
+    """
+    now = now or timezone.now()
+    policy = retention()
+    raw_cutoff = now - timedelta(seconds=policy['raw'])
+    with transaction.atomic():
+        expired = PacketInfo.objects.filter(timestamp__lt=raw_cutoff)
+        release_blobs(expired)
+        expired_packets = expired.delete()[0]
+        expired_blobs = Blob.objects.filter(refcount__lte=0).delete()[0]
+    deleted = {
+        'PacketInfo': expired_packets,
+        'Blob': expired_blobs,
+        'PacketCount': PacketCount.objects.filter(timestamp__lt=raw_cutoff).delete()[0],
+        'Cookie': Cookie.objects.filter(timestamp__lt=raw_cutoff).delete()[0],
+        'CookieSketch': CookieSketch.objects.filter(
+            timestamp__lt=now - timedelta(seconds=policy['sketches'])).delete()[0],
+        'Flow': Flow.objects.filter(timestamp__lt=now - timedelta(seconds=policy['flows'])).delete()[0],
+    }
+    for model in (TrafficRollup, ProtocolRollup, SourceRollup):
+        total = 0
+        for resolution in RESOLUTIONS:
+            cutoff = now - timedelta(seconds=policy[resolution])
+            total += model.objects.filter(resolution=resolution, bucket__lt=cutoff).delete()[0]
+        deleted[model.__name__] = total
+    if any(deleted.values()):
+        queries.invalidate()
+    return deleted
+
+
+def maybe_prune(now=None):
+    """
+    Prune at most once every MONITOR_PRUNE_INTERVAL seconds. Called from the
+    ingest path so retention is enforced without a separate scheduler.
+    """
+    global _last_prune
+    now = now or timezone.now()
+    interval = getattr(settings, 'MONITOR_PRUNE_INTERVAL', 60)
+    if _last_prune is not None and (now - _last_prune).total_seconds() < interval:
+        return None
+    _last_prune = now
+    return prune(now)
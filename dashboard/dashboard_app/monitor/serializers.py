@@ -4,9 +4,14 @@ from .models import PacketCount, PacketInfo
 class PacketCountSerializer(serializers.ModelSerializer):
     class Meta:
         model = PacketCount
-        fields = ['timestamp', 'count']
+        fields = ['timestamp', 'count', 'sample_rate']
+        extra_kwargs = {'sample_rate': {'min_value': 1}}
 
 class PacketInfoSerializer(serializers.ModelSerializer):
+    src_ip = serializers.CharField(source='src_address', read_only=True)
+    dst_ip = serializers.CharField(source='dst_address', read_only=True)
+    protocol = serializers.CharField(source='get_protocol_display', read_only=True)
+
     class Meta:
         model = PacketInfo
         fields = '__all__'
@@ -0,0 +1,144 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .models import PacketInfo, TrafficRollup, int_to_ip
+
+PACKET_FIELDS = ('id', 'timestamp', 'src_ip', 'dst_ip', 'protocol', 'packet_len')
+ROLLUP_FIELDS = ('bucket', 'packets', 'estimated_packets', 'bytes', 'distinct_sources', 'packet_count')
+
+# Upper bound on rows sent in a single event
+MAX_EVENT_PACKETS = 500
+# Recent per-second buckets re-read every tick to detect rollup changes
+ROLLUP_WINDOW = 5
+KEEPALIVE_SECONDS = 15
+
+
+def _packet_rows(queryset):
+    rows = list(queryset.values(*PACKET_FIELDS)[:MAX_EVENT_PACKETS])
+    protocols = dict(PacketInfo.Protocol.choices)
+    for row in rows:
+        row['timestamp'] = row['timestamp'].isoformat()
+        row['src_ip'] = int_to_ip(row['src_ip'])
+        row['dst_ip'] = int_to_ip(row['dst_ip'])
+        row['protocol'] = protocols.get(row['protocol'], str(row['protocol']))
+    return rows
+
+
+def format_event(event):
+    return f"id: {event['cursor']}\ndata: {json.dumps(event)}\n\n"
+
+
+class Broadcaster:
+    """
+    Single server-side producer for the live dashboard.
+
+    While at least one client is subscribed, one task queries the database
+    once per tick for packets newer than its cursor and for changed
+    per-second rollups, and fans the result out to every subscriber's queue.
+    N open dashboards therefore cost one query per tick instead of N.
+
+    The producer task lives on the server's event loop, so the stream must be
+    served by an ASGI server (see dashboard_app/asgi.py).
+    """
+
+    def __init__(self, interval=1.0, queue_size=32):
+        self.interval = interval
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.cursor = None
+        self.rollups = {}
+        self._task = None
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    async def _run(self):
+        while self.subscribers:
+            event = await sync_to_async(self.poll)()
+            if event['packets'] or event['rollups']:
+                for queue in list(self.subscribers):
+                    if queue.full():
+                        # Slow client: drop its oldest event rather than stall the rest
+                        queue.get_nowait()
+                    queue.put_nowait(event)
+            await asyncio.sleep(self.interval)
+
+    def poll(self):
+        """
+        Return the newest packets after the producer cursor and the
+        per-second rollups that changed since the previous tick. When more
+        than MAX_EVENT_PACKETS arrived, the older ones are skipped and the
+        cursor moves to the newest, so the feed never falls behind ingest.
+        """
+        self._ensure_cursor()
+        packets = _packet_rows(PacketInfo.objects.filter(id__gt=self.cursor).order_by('-id'))
+        packets.reverse()
+        if packets:
+            self.cursor = packets[-1]['id']
+
+        recent = list(TrafficRollup.objects.filter(resolution=1)
+                      .order_by('-bucket').values(*ROLLUP_FIELDS)[:ROLLUP_WINDOW])
+        for row in recent:
+            row['bucket'] = row['bucket'].isoformat()
+        changed = [row for row in reversed(recent) if self.rollups.get(row['bucket']) != row]
+        self.rollups = {row['bucket']: row for row in recent}
+        return {'cursor': self.cursor, 'packets': packets, 'rollups': changed}
+
+    def backlog(self, cursor):
+        """
+        The newest packets a reconnecting client missed, from its cursor up
+        to the producer's.
+        """
+        self._ensure_cursor()
+        if cursor >= self.cursor:
+            return None
+        packets = _packet_rows(
+            PacketInfo.objects.filter(id__gt=cursor, id__lte=self.cursor).order_by('-id'))
+        packets.reverse()
+        return {'cursor': self.cursor, 'packets': packets, 'rollups': []}
+
+    def _ensure_cursor(self):
+        if self.cursor is None:
+            latest = PacketInfo.objects.order_by('-id').values_list('id', flat=True).first()
+            self.cursor = latest or 0
+
+
+broadcaster = Broadcaster(getattr(settings, 'MONITOR_STREAM_INTERVAL', 1.0))
+
+
+async def event_stream(cursor=None):
+    """
+    Server-Sent Events for one client, starting after `cursor` (a PacketInfo
+    id) when given.
+    """
+    queue = broadcaster.subscribe()
+    try:
+        if cursor is not None:
+            missed = await sync_to_async(broadcaster.backlog)(cursor)
+            if missed:
+                cursor = missed['cursor']
+                yield format_event(missed)
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if cursor is not None:
+                event = {**event, 'packets': [p for p in event['packets'] if p['id'] > cursor]}
+                if not event['packets'] and not event['rollups']:
+                    continue
+            cursor = event['cursor']
+            yield format_event(event)
+    finally:
+        broadcaster.unsubscribe(queue)
@@ -1,3 +1,215 @@
+import json
+from datetime import timedelta
+from unittest import mock
+
+from django.db.models import Sum
 from django.test import TestCase
+from django.utils import timezone
+
+from . import rollups
+from .ingest import IngestError, blob_digest, ingest_packets, rows_to_columns, store_blobs
+from .models import Blob, PacketCount, PacketInfo, ProtocolRollup, TrafficRollup
+
+BODY = "GET / HTTP/1.1\r\nHost: example.com\r\nCookie: sid=1\r\n\r\n"
+OTHER_BODY = "GET /other HTTP/1.1\r\nHost: example.com\r\n\r\n"
+
+
+def packet(**fields):
+    row = {
+        'src_ip': '10.0.0.1',
+        'dst_ip': '192.168.1.1',
+        'src_port': 40000,
+        'dst_port': 80,
+        'protocol': 'TCP',
+        'packet_type': 0,
+        'packet_len': 100,
+        'seq_num': 1,
+        'ack_num': 0,
+        'tcp_flags': 24,
+    }
+    row.update(fields)
+    return row
+
+
+def columns(rows, refs=None):
+    batch = rows_to_columns(rows)
+    if refs is not None:
+        batch['http_data_ref'] = refs
+    return batch
+
+
+def rollup_total(model, field, **filters):
+    return model.objects.filter(resolution=3600, **filters).aggregate(total=Sum(field))['total'] or 0
+
+
+class IngestPacketsTest(TestCase):
+
+    def test_columnar_rows_are_converted_and_stored(self):
+        result = ingest_packets(columns([packet(), packet(src_ip=167772162, protocol=17)]))
+        self.assertEqual((result['accepted'], result['rejected'], result['errors']), (2, 0, []))
+        stored = list(PacketInfo.objects.order_by('id').values_list('src_ip', 'protocol'))
+        self.assertEqual(stored, [(0x0a000001, 6), (0x0a000002, 17)])
+        self.assertNotIn('blobs', result)
+
+    def test_bad_rows_are_rejected(self):
+        result = ingest_packets(columns([
+            packet(),
+            packet(dst_port=70000),
+            packet(src_ip='10.0.0.300'),
+            packet(protocol='SCTP'),
+            packet(packet_len='100'),
+            packet(),
+        ]))
+        self.assertEqual((result['accepted'], result['rejected']), (2, 4))
+        self.assertEqual(len(result['errors']), 4)
+        self.assertIn("row 1: invalid dst_port 70000", result['errors'])
+        self.assertEqual(PacketInfo.objects.count(), 2)
+
+    def test_malformed_batches_raise(self):
+        batch = columns([packet()])
+        del batch['tcp_flags']
+        with self.assertRaisesMessage(IngestError, "missing columns: tcp_flags"):
+            ingest_packets(batch)
+        batch = columns([packet(), packet()])
+        batch['seq_num'].pop()
+        with self.assertRaises(IngestError):
+            ingest_packets(batch)
+        with self.assertRaises(IngestError):
+            rows_to_columns({'src_ip': '10.0.0.1'})
+
+    def test_count_and_sample_rate_are_checked(self):
+        for count, sample_rate in ((-1, 1), ('5', 1), (5, 0), (5, 2.5)):
+            with self.assertRaises(IngestError):
+                ingest_packets(columns([packet()]), count, sample_rate)
+        self.assertEqual(PacketInfo.objects.count(), 0)
+        ingest_packets(columns([packet()]), 42, 8)
+        self.assertEqual(list(PacketCount.objects.values_list('count', 'sample_rate')), [(42, 8)])
+
+    def test_rollups_are_updated(self):
+        ingest_packets(columns([packet(packet_len=100), packet(packet_len=50, protocol='UDP')]), 10, 4)
+        self.assertEqual(rollup_total(TrafficRollup, 'packets'), 2)
+        self.assertEqual(rollup_total(TrafficRollup, 'bytes'), 150)
+        self.assertEqual(rollup_total(TrafficRollup, 'estimated_packets'), 8)
+        self.assertEqual(rollup_total(ProtocolRollup, 'packets', protocol='UDP'), 1)
+        self.assertEqual(TrafficRollup.objects.filter(resolution=1).latest('bucket').packet_count, 10)
+
+    def test_rollup_failure_rolls_back_the_batch(self):
+        with mock.patch.object(rollups, 'record_packets', side_effect=RuntimeError("rollup failed")):
+            with self.assertRaises(RuntimeError):
+                ingest_packets(columns([packet()]), 10)
+        self.assertEqual(PacketInfo.objects.count(), 0)
+        self.assertEqual(PacketCount.objects.count(), 0)
+        self.assertFalse(TrafficRollup.objects.exists())
+
+
+class IngestEndpointTest(TestCase):
+
+    def test_columnar_body(self):
+        body = {'count': 3, 'sample_rate': 2, 'cursor': 17, 'columns': columns([packet(), packet(dst_port=-1)])}
+        response = self.client.post('/api/ingest/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        result = response.json()
+        self.assertEqual((result['accepted'], result['rejected'], result['cursor']), (1, 1, 17))
+        self.assertEqual(PacketCount.objects.get().sample_rate, 2)
+
+    def test_ndjson_body(self):
+        lines = [{'header': {'count': 2}}, packet(), packet(dst_port=443)]
+        body = "\n".join(json.dumps(line) for line in lines) + "\n"
+        response = self.client.post('/api/ingest/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['accepted'], 2)
+        self.assertEqual(sorted(PacketInfo.objects.values_list('dst_port', flat=True)), [80, 443])
+        self.assertEqual(PacketCount.objects.get().count, 2)
+
+    def test_invalid_bodies_are_rejected(self):
+        response = self.client.post('/api/ingest/', "{not json\n", content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        body = {'count': -1, 'columns': columns([packet()])}
+        response = self.client.post('/api/ingest/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PacketInfo.objects.count(), 0)
+
+    def test_add_packet_count(self):
+        body = {'count': 5, 'sample_rate': 8, 'packets': [packet(), packet()]}
+        response = self.client.post('/api/add_packet_count/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(PacketCount.objects.values_list('count', 'sample_rate')), [(5, 8)])
+        self.assertEqual(rollup_total(TrafficRollup, 'estimated_packets'), 16)
+
+    def test_add_packet_count_stores_nothing_on_error(self):
+        body = {'count': 5, 'packets': {'src_ip': '10.0.0.1'}}
+        response = self.client.post('/api/add_packet_count/', json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PacketCount.objects.count(), 0)
+        self.assertFalse(TrafficRollup.objects.exists())
+
+
+class BlobReferenceTest(TestCase):
+
+    def setUp(self):
+        self.digest = blob_digest(BODY)
+        self.other = blob_digest(OTHER_BODY)
+
+    def ingest(self, refs, blobs=None):
+        return ingest_packets(columns([packet(seq_num=i) for i in range(len(refs))], refs), blobs=blobs)
+
+    def test_ingest_counts_references(self):
+        result = self.ingest([self.digest, self.digest, None], {self.digest: BODY})
+        self.assertEqual(result['blobs'], {'created': 1, 'rejected': 0, 'missing': []})
+        blob = Blob.objects.get()
+        self.assertEqual((blob.body, blob.size, blob.refcount), (BODY, len(BODY), 2))
+        self.assertEqual(PacketInfo.objects.filter(payload=blob).count(), 2)
+
+        result = self.ingest([self.digest])
+        self.assertEqual(result['blobs'], {'created': 0, 'rejected': 0, 'missing': []})
+        self.assertEqual(Blob.objects.get().refcount, 3)
+
+    def test_store_blobs(self):
+        Blob.objects.create(digest=self.digest, body=BODY, size=len(BODY), refcount=1)
+        stored, created = store_blobs({self.digest: 2, self.other: 3}, {self.other: OTHER_BODY})
+        self.assertEqual((sorted(stored), created), (sorted([self.digest, self.other]), 1))
+        self.assertEqual(dict(Blob.objects.values_list('digest', 'refcount')), {self.digest: 3, self.other: 3})
+        stored, created = store_blobs({'0' * 32: 1}, {})
+        self.assertEqual((stored, created), ({}, 0))
+
+    def test_missing_digest_rejects_the_row(self):
+        result = self.ingest([self.digest, None, self.other], {self.other: OTHER_BODY})
+        self.assertEqual((result['accepted'], result['rejected']), (2, 1))
+        self.assertEqual(result['blobs']['missing'], [self.digest])
+        stored = dict(PacketInfo.objects.values_list('seq_num', 'payload__digest'))
+        self.assertEqual(stored, {1: None, 2: self.other})
+        self.assertEqual(list(Blob.objects.values_list('digest', 'refcount')), [(self.other, 1)])
+
+    def test_body_not_matching_its_digest_is_rejected(self):
+        result = self.ingest([self.digest], {self.digest: OTHER_BODY})
+        self.assertEqual(result['blobs'], {'created': 0, 'rejected': 1, 'missing': [self.digest]})
+        self.assertEqual(result['rejected'], 1)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(PacketInfo.objects.exists())
+
+    def test_malformed_reference_rejects_the_row(self):
+        result = self.ingest(['not-a-digest', None])
+        self.assertEqual((result['accepted'], result['rejected']), (1, 1))
+        with self.assertRaises(IngestError):
+            ingest_packets(columns([packet()], [None, None]))
+
+    def test_prune_releases_references(self):
+        self.ingest([self.digest, self.digest, self.other], {self.digest: BODY, self.other: OTHER_BODY})
+        old = timezone.now() - timedelta(seconds=rollups.retention()['raw'] + 60)
+        expired = PacketInfo.objects.filter(payload__digest=self.other) | PacketInfo.objects.filter(
+            id=PacketInfo.objects.filter(payload__digest=self.digest).values('id')[:1])
+        PacketInfo.objects.filter(id__in=expired.values('id')).update(timestamp=old)
+
+        deleted = rollups.prune()
+        self.assertEqual((deleted['PacketInfo'], deleted['Blob']), (2, 1))
+        self.assertEqual(list(Blob.objects.values_list('digest', 'refcount')), [(self.digest, 1)])
+
+        PacketInfo.objects.update(timestamp=old)
+        deleted = rollups.prune()
+        self.assertEqual((deleted['PacketInfo'], deleted['Blob']), (1, 1))
+        self.assertFalse(Blob.objects.exists())
 
-# Create your tests here.
+    def test_release_blobs(self):
+        self.ingest([self.digest, self.digest, self.other], {self.digest: BODY, self.other: OTHER_BODY})
+        rollups.release_blobs(PacketInfo.objects.filter(payload__digest=self.digest))
+        self.assertEqual(dict(Blob.objects.values_list('digest', 'refcount')), {self.digest: 0, self.other: 1})
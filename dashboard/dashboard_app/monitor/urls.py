@@ -4,4 +4,13 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('api/add_packet_count/', views.add_packet_count, name='add_packet_count'),
+    path('api/ingest/', views.ingest, name='ingest'),
+    path('api/stream/', views.stream, name='stream'),
+    path('api/packets/', views.packets, name='packets'),
+    path('api/blobs/<str:digest>/', views.blob, name='blob'),
+    path('api/flows/', views.flows, name='flows'),
+    path('api/counts/', views.counts, name='counts'),
+    path('api/aggregates/top-talkers/', views.top_talkers, name='top_talkers'),
+    path('api/aggregates/ports/', views.port_bytes, name='port_bytes'),
+    path('api/aggregates/timeline/', views.timeline, name='timeline'),
 ]
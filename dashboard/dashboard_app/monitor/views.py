@@ -1,9 +1,16 @@
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, parser_classes
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 import ctypes
-from .models import PacketCount, PacketInfo
-from .serializers import PacketCountSerializer, PacketInfoSerializer
+from . import queries, rollups
+from .ingest import IngestError, ingest_cookies, ingest_flows, ingest_packets, ingest_sketches, rows_to_columns
+from .models import Blob, CookieSketch, PacketInfo, ProtocolRollup, TrafficRollup
+from .parsers import NDJSONParser
+from .serializers import PacketCountSerializer
+from .streaming import event_stream
 
 # class PacketInfo(ctypes.Structure):
 #             _fields_ = [
@@ -33,25 +40,160 @@ from .serializers import PacketCountSerializer, PacketInfoSerializer
 #         self.tcp_flags = tcp_flags
 
 def index(request):
-    data = PacketCount.objects.order_by('-timestamp')[:10]
-    # auto reload every 2 seconds
-    packets = PacketInfo.objects.order_by('-timestamp')[:10]
+    data = TrafficRollup.objects.filter(resolution=1).order_by('-bucket')[:10]
+    minutes = TrafficRollup.objects.filter(resolution=60).order_by('-bucket')[:10]
+    latest_hour = TrafficRollup.objects.filter(resolution=3600).order_by('-bucket').first()
+    protocols = []
+    if latest_hour:
+        protocols = ProtocolRollup.objects.filter(
+            resolution=3600, bucket=latest_hour.bucket).order_by('-packets')
+    packets = list(PacketInfo.objects.order_by('-id')[:10])
+    sketch = CookieSketch.objects.order_by('-id').first()
     return render(request, 'monitor/index.html', {
         'data': data,
-        'packets': packets
+        'minutes': minutes,
+        'protocols': protocols,
+        'packets': packets,
+        'sketch': sketch,
+        'cursor': packets[0].id if packets else 0,
         })
 
+async def stream(request):
+    """
+    Server-Sent Events feed of new packets and per-second rollup changes.
+    Clients resume from ?cursor= or the Last-Event-ID header.
+    """
+    cursor = request.headers.get('Last-Event-ID') or request.GET.get('cursor')
+    try:
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        cursor = None
+    response = StreamingHttpResponse(event_stream(cursor), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @api_view(['POST'])
 def add_packet_count(request):
     serializer = PacketCountSerializer(data=request.data)
     packets_received = request.data['packets']
     if serializer.is_valid():
-        serializer.save()
-        for packet in packets_received:
-            packet_serializer = PacketInfoSerializer(data=packet)
-            if packet_serializer.is_valid():
-                packet_serializer.save()
-            else:
-                print(packet_serializer.errors)
+        # The count and its rollup are only kept if the packets are
+        try:
+            with transaction.atomic():
+                packet_count = serializer.save()
+                rollups.record_count(packet_count.count, packet_count.timestamp)
+                ingest_packets(rows_to_columns(packets_received), sample_rate=packet_count.sample_rate)
+        except IngestError as e:
+            return Response({'error': str(e)}, status=400)
         return Response("Success", status=201)
     return Response(serializer.errors, status=400)
+
+@api_view(['POST'])
+@parser_classes([JSONParser, NDJSONParser])
+def ingest(request):
+    """
+    Bulk ingest a batch of packets.
+
+    Accepts either a columnar JSON body, {"count": ..., "columns": {field: [...]}},
+    or NDJSON with an optional {"header": {"count": ...}} first line and one
+    packet per line. Responds with the number of accepted and rejected rows.
+    A columnar body may also carry {"cookies": {field: [...]}}, cookie
+    analytics snapshots as {"sketches": [...]} and flow records as
+    {"flows": {field: [...]}}, reported under the same keys in the response.
+    Payloads are sent as digests in an http_data_ref column, with the bodies
+    the dashboard has not stored yet in {"blobs": {digest: body}}.
+    """
+    data = request.data
+    header = data.get('header', data)
+    try:
+        if 'columns' in data:
+            columns = data['columns']
+        else:
+            columns = rows_to_columns(data.get('packets', []))
+        result = ingest_packets(columns, header.get('count'), header.get('sample_rate', 1), data.get('blobs'))
+    except IngestError as e:
+        return Response({'error': str(e)}, status=400)
+    if 'cookies' in data:
+        # The packets are stored by now, so a bad cookie batch is reported
+        # without failing the request
+        try:
+            result['cookies'] = ingest_cookies(data['cookies'])
+        except IngestError as e:
+            result['cookies'] = {'error': str(e)}
+    if 'sketches' in data:
+        try:
+            result['sketches'] = ingest_sketches(data['sketches'])
+        except IngestError as e:
+            result['sketches'] = {'error': str(e)}
+    if 'flows' in data:
+        try:
+            result['flows'] = ingest_flows(data['flows'])
+        except IngestError as e:
+            result['flows'] = {'error': str(e)}
+    result['cursor'] = header.get('cursor')
+    return Response(result, status=201)
+
+
+def _query(request, name, query):
+    try:
+        return Response(queries.cached(name, query, request.query_params.dict()))
+    except queries.QueryError as e:
+        return Response({'error': str(e)}, status=400)
+
+@api_view(['GET'])
+def packets(request):
+    """
+    Packets newest first, filtered by ?since=, ?until=, ?src_ip=, ?dst_ip=
+    (address or CIDR), ?port=, ?src_port=, ?dst_port= and ?protocol=.
+    Pages of ?limit= rows continue from ?cursor=, the next_cursor of the
+    previous page.
+    """
+    return _query(request, 'packets', queries.packets)
+
+@api_view(['GET'])
+def blob(request, digest):
+    """
+    The payload stored under a digest, as referenced by the packets'
+    `payload` field.
+    """
+    row = Blob.objects.filter(digest=digest).values('digest', 'body', 'size', 'refcount').first()
+    if row is None:
+        return Response({'error': 'unknown payload digest'}, status=404)
+    return Response(row)
+
+@api_view(['GET'])
+def flows(request):
+    """
+    Flow records newest first, with the packet filters, ?limit= and ?cursor=.
+    """
+    return _query(request, 'flows', queries.flows)
+
+@api_view(['GET'])
+def counts(request):
+    """
+    PacketCount readings newest first, with ?since=, ?until=, ?limit= and
+    ?cursor= as for packets.
+    """
+    return _query(request, 'counts', queries.counts)
+
+@api_view(['GET'])
+def top_talkers(request):
+    """
+    The ?top= sources with the most packets, with the packet filters.
+    """
+    return _query(request, 'top_talkers', queries.top_talkers)
+
+@api_view(['GET'])
+def port_bytes(request):
+    """
+    Bytes and packets per destination port, with the packet filters.
+    """
+    return _query(request, 'port_bytes', queries.port_bytes)
+
+@api_view(['GET'])
+def timeline(request):
+    """
+    Packets and bytes per ?interval= seconds (1, 60 or 3600).
+    """
+    return _query(request, 'timeline', queries.timeline)
@@ -18,22 +18,411 @@ struct packet_info {
     __u32 packet_len; // Total packet length
     __u32 seq_num;    // Sequence number
     __u32 ack_num;    // Acknowledgment number
-    __u8 tcp_flags;   // TCP flags
-    char http_data[MAX_HTTP_DATA];  
+    __u8 tcp_flags;   // TCP flags, and TCP_FLAG_UNSAMPLED
     __u32 http_data_len;
+    char http_data[MAX_HTTP_DATA];  // Must stay last, records are cut after the captured bytes
 };
 
-// Hash map to count packets (up to 1024 unique keys)
-BPF_HASH(packet_count, __u32, __u64, 1024);
+// Not a TCP flag: set in tcp_flags on events sent past payload sampling,
+// which the daemon counts once rather than sample_rate times
+#define TCP_FLAG_UNSAMPLED 0x80
 
-// Per-CPU array for sampling counter
+// Size of a record without payload. Events carry this header followed by
+// http_data_len payload bytes rather than the whole struct.
+#define PACKET_HEADER_LEN __builtin_offsetof(struct packet_info, http_data)
+
+#ifdef EXTRACT_COOKIES
+#define MAX_COOKIES 16          // Power of two, used as an index mask
+#define COOKIE_VALUE_PREFIX 16  // Power of two, used as an index mask
+#ifndef COOKIE_SCAN_LEN
+#define COOKIE_SCAN_LEN 1024    // Payload bytes searched for the Cookie header
+#endif
+
+struct cookie_pair {
+    __u32 name_hash;   // FNV-1a of the cookie name
+    __u32 value_hash;  // FNV-1a of the whole value
+    __u16 value_len;   // Length of the whole value
+    char value[COOKIE_VALUE_PREFIX];  // First bytes of the value
+};
+
+// Cookies of one HTTP request. Records are cut after cookie_count pairs.
+struct cookie_info {
+    __u32 src_ip;
+    __u32 dst_ip;
+    __u16 src_port;
+    __u16 dst_port;
+    __u32 seq_num;
+    __u8 method;        // 1: GET, 2: POST, 3: PUT, 4: HEAD, 5: DELETE, 6: PATCH, 7: OPTIONS
+    __u8 cookie_count;
+    struct cookie_pair cookies[MAX_COOKIES];
+};
+
+#define COOKIE_HEADER_LEN __builtin_offsetof(struct cookie_info, cookies)
+#endif
+
+#ifndef PACKET_COUNT_MAX_ENTRIES
+#define PACKET_COUNT_MAX_ENTRIES 262144
+#endif
+
+// BPF_MAPS_ONLY builds declare the maps but no programs. The daemon's build
+// cache uses them on warm starts to get table objects for maps it has pinned,
+// so the real sizes would only allocate memory that is never used.
+#ifndef RINGBUF_PAGES
+#define RINGBUF_PAGES 256
+#endif
+
+#ifdef BPF_MAPS_ONLY
+#undef PACKET_COUNT_MAX_ENTRIES
+#define PACKET_COUNT_MAX_ENTRIES 1
+#undef RINGBUF_PAGES
+#define RINGBUF_PAGES 1
+#endif
+
+// Per-source packet counts. LRU so that new sources evict the coldest ones
+// instead of going uncounted once the map is full, and per-CPU so increments
+// need no atomics. Userspace sums the per-CPU values.
+BPF_TABLE("lru_percpu_hash", __u32, __u64, packet_count, PACKET_COUNT_MAX_ENTRIES);
+
+// Sampling: only one in N payload-carrying packets is sent to userspace,
+// with N in sample_control (0 or 1 sends all). The daemon adjusts N to its
+// event budget. sample_counter counts down to the next sampled packet on
+// each CPU, so it needs no atomics.
+BPF_ARRAY(sample_control, __u32, 1);
 BPF_PERCPU_ARRAY(sample_counter, __u64, 1);
 
-// Perf buffer to send packet details to userspace
+// Program counters, one slot per STAT_* index on each CPU so increments need
+// no atomics. The daemon sums the CPUs and serves them as metrics; keep the
+// order in step with KERNEL_STATS in user_daemon/counters.py.
+enum {
+    STAT_PACKETS,          // Packets seen by the program
+    STAT_COUNTED,          // TCP packets counted in packet_count
+    STAT_SKIPPED_ACKS,     // Pure ACKs, neither counted nor captured
+    STAT_FILTERED,         // Packets or payloads rejected by the capture filters
+    STAT_SAMPLED_OUT,      // Payload packets skipped by sampling
+    STAT_PACKET_EVENTS,    // Packet events submitted, flow boundaries with FLOW_EVENTS included
+    STAT_COOKIE_EVENTS,    // Cookie records submitted
+    STAT_TRUNCATED,        // Payloads cut at MAX_HTTP_DATA bytes
+    STAT_SUBMIT_FAILURES,  // Events dropped because the perf or ring buffer was full
+    STAT_LOOKUP_FAILURES,  // Failed map lookups and packet_count insertions
+    STAT_MAX,
+};
+
+BPF_PERCPU_ARRAY(stats, __u64, STAT_MAX);
+
+// Capture filters, written by the daemon from the `filters` config section
+// and rewritten in place when it changes. Address and port rules decide
+// whether a packet is counted and captured at all and are checked as soon
+// as the headers are parsed. HTTP method and Host rules decide whether its
+// payload is captured and are checked before any of it is copied.
+#define FILTER_SRC_CIDRS     0x01
+#define FILTER_DST_CIDRS     0x02
+#define FILTER_PORTS         0x04  // Source or destination port in port_filter
+#define FILTER_METHODS       0x08
+#define FILTER_HOST_PREFIXES 0x10
+
+#define MAX_FILTER_CIDRS 1024
+#define MAX_HOST_PREFIXES 8     // Power of two, used as an index mask
+#define HOST_PREFIX_LEN 32      // Power of two, used as an index mask
+#ifndef HOST_SCAN_LEN
+#define HOST_SCAN_LEN 512       // Payload bytes searched for the Host header
+#endif
+
+struct filter_config {
+    __u32 flags;         // FILTER_* bits of the enabled rules
+    __u32 methods;       // Bit n set: method n of http_method() is captured
+    __u32 host_count;    // Entries used in host_filter
+};
+
+struct cidr_key {
+    __u32 prefixlen;
+    __u32 addr;          // Network byte order
+};
+
+struct host_prefix {
+    __u32 len;
+    char prefix[HOST_PREFIX_LEN];  // Lowercase
+};
+
+BPF_ARRAY(filter_config, struct filter_config, 1);
+BPF_LPM_TRIE(src_filter, struct cidr_key, __u8, MAX_FILTER_CIDRS);
+BPF_LPM_TRIE(dst_filter, struct cidr_key, __u8, MAX_FILTER_CIDRS);
+BPF_ARRAY(port_filter, __u64, 1024);  // One bit per port
+BPF_ARRAY(host_filter, struct host_prefix, MAX_HOST_PREFIXES);
+
+// Channel to send packet details to userspace: a BPF ring buffer shared by
+// all CPUs when built with USE_RINGBUF (kernel 5.8+), per-CPU perf buffers
+// otherwise
+#ifdef USE_RINGBUF
+BPF_RINGBUF_OUTPUT(packet_events, RINGBUF_PAGES);
+#else
 BPF_PERF_OUTPUT(packet_events);
+#endif
 
 BPF_PERCPU_ARRAY(tmp_packet, struct packet_info, 1);
 
+#ifdef EXTRACT_COOKIES
+// Cookie records, on the same kind of channel as packet_events
+#ifdef USE_RINGBUF
+BPF_RINGBUF_OUTPUT(cookie_events, RINGBUF_PAGES);
+#else
+BPF_PERF_OUTPUT(cookie_events);
+#endif
+
+BPF_PERCPU_ARRAY(tmp_cookies, struct cookie_info, 1);
+#endif
+
+
+#ifndef BPF_MAPS_ONLY
+static __always_inline void stat_inc(__u32 index) {
+    __u64 *value = stats.lookup(&index);
+    if (value)
+        (*value)++;
+}
+
+static __always_inline int addresses_allowed(struct filter_config *filter, __u32 saddr, __u32 daddr) {
+    // Longest-prefix lookups of the full address
+    struct cidr_key key = {32, saddr};
+    if ((filter->flags & FILTER_SRC_CIDRS) && !src_filter.lookup(&key))
+        return 0;
+    key.addr = daddr;
+    if ((filter->flags & FILTER_DST_CIDRS) && !dst_filter.lookup(&key))
+        return 0;
+    return 1;
+}
+
+// Request method from the first four payload bytes, 0 if not a request
+static __always_inline __u8 http_method(char *p, void *data_end) {
+    if ((void *)(p + 4) > data_end)
+        return 0;
+    if (p[0] == 'G' && p[1] == 'E' && p[2] == 'T' && p[3] == ' ')
+        return 1;
+    if (p[0] == 'P' && p[1] == 'O' && p[2] == 'S' && p[3] == 'T')
+        return 2;
+    if (p[0] == 'P' && p[1] == 'U' && p[2] == 'T' && p[3] == ' ')
+        return 3;
+    if (p[0] == 'H' && p[1] == 'E' && p[2] == 'A' && p[3] == 'D')
+        return 4;
+    if (p[0] == 'D' && p[1] == 'E' && p[2] == 'L' && p[3] == 'E')
+        return 5;
+    if (p[0] == 'P' && p[1] == 'A' && p[2] == 'T' && p[3] == 'C')
+        return 6;
+    if (p[0] == 'O' && p[1] == 'P' && p[2] == 'T' && p[3] == 'I')
+        return 7;
+    return 0;
+}
+
+static __always_inline int port_allowed(__u16 port) {
+    __u32 slot = port >> 6;
+    __u64 *bits = port_filter.lookup(&slot);
+    return bits && ((*bits >> (port & 63)) & 1);
+}
+
+// Lowercase ASCII letters, hostnames compare case-insensitively
+static __always_inline char lower(char c) {
+    return (c >= 'A' && c <= 'Z') ? c + ('a' - 'A') : c;
+}
+
+// i-th character of "host:", the header name matched case-insensitively
+static __always_inline char host_header_char(__u32 i) {
+    switch (i) {
+    case 0: return 'h';
+    case 1: return 'o';
+    case 2: return 's';
+    case 3: return 't';
+    default: return ':';
+    }
+}
+
+// Offset of the Host header value in an HTTP request, -1 if there is none
+// within HOST_SCAN_LEN bytes
+static __always_inline int find_host(void *http_data, void *data_end) {
+    __u32 match = 6;     // Characters of "host:" matched on this line, > 4 after a mismatch
+    __u32 line_len = 1;  // The request line is never empty
+    __u32 found = 0;
+    for (int i = 0; i < HOST_SCAN_LEN; i++) {
+        char *p = (char *)http_data + i;
+        if ((void *)(p + 1) > data_end)
+            break;
+        char c = *p;
+        if (found) {
+            if (c != ' ')
+                return i;
+        } else if (c == '\n') {
+            if (line_len == 0)
+                break;  // End of headers
+            line_len = 0;
+            match = 0;
+        } else if (c != '\r') {
+            if (match < 5 && (c | 0x20) == host_header_char(match)) {
+                match++;
+                found = match == 5;
+            } else {
+                match = 6;
+            }
+            line_len++;
+        }
+    }
+    return -1;
+}
+
+// Whether an HTTP payload passes the method and Host prefix rules. Packets
+// that are not requests (responses, continuation segments) fail both.
+static __always_inline int http_allowed(struct filter_config *filter, void *http_data, void *data_end) {
+    __u8 method = http_method(http_data, data_end);
+    if (!method)
+        return 0;
+    if ((filter->flags & FILTER_METHODS) && !((filter->methods >> method) & 1))
+        return 0;
+    if (!(filter->flags & FILTER_HOST_PREFIXES))
+        return 1;
+
+    int host = find_host(http_data, data_end);
+    if (host < 0)
+        return 0;
+    char *value = (char *)http_data + (host & (HOST_SCAN_LEN - 1));
+    for (__u32 k = 0; k < MAX_HOST_PREFIXES; k++) {
+        if (k >= filter->host_count)
+            break;
+        struct host_prefix *rule = host_filter.lookup(&k);
+        if (!rule)
+            break;
+        __u32 j = 0;
+        for (; j < HOST_PREFIX_LEN; j++) {
+            if (j >= rule->len)
+                break;
+            char *p = value + j;
+            if ((void *)(p + 1) > data_end || lower(*p) != rule->prefix[j])
+                break;
+        }
+        if (j >= rule->len)
+            return 1;
+    }
+    return 0;
+}
+
+#ifdef EXTRACT_COOKIES
+#define FNV_OFFSET 2166136261U
+#define FNV_PRIME 16777619U
+
+enum { SCAN_LINE, SCAN_NAME, SCAN_VALUE };
+
+// i-th character of "cookie:", the header name matched case-insensitively
+static __always_inline char cookie_header_char(__u32 i) {
+    switch (i) {
+    case 0: return 'c';
+    case 1: return 'o';
+    case 2: return 'o';
+    case 3: return 'k';
+    case 4: return 'i';
+    case 5: return 'e';
+    default: return ':';
+    }
+}
+
+// Find the Cookie header of an HTTP request and submit one record with a
+// hash pair and value prefix per cookie. Mirrored by cookies.py in the
+// daemon for replayed traffic; keep the two in step.
+static __always_inline void extract_cookies(struct xdp_md *ctx, struct packet_info *info,
+                                            void *http_data, void *data_end) {
+    __u8 method = http_method(http_data, data_end);
+    if (!method)
+        return;
+    int zero = 0;
+    struct cookie_info *record = tmp_cookies.lookup(&zero);
+    if (!record) {
+        stat_inc(STAT_LOOKUP_FAILURES);
+        return;
+    }
+
+    __u32 count = 0;
+    __u32 state = SCAN_LINE;
+    __u32 match = 7;     // Characters of "cookie:" matched on this line, > 6 after a mismatch
+    __u32 line_len = 1;  // The request line is never empty
+    __u32 name_len = 0;
+    __u32 name_hash = FNV_OFFSET;
+    __u32 value_hash = FNV_OFFSET;
+    __u32 value_len = 0;
+
+    for (int i = 0; i < COOKIE_SCAN_LEN; i++) {
+        char *p = (char *)http_data + i;
+        if ((void *)(p + 1) > data_end)
+            break;
+        char c = *p;
+        struct cookie_pair *pair = &record->cookies[count & (MAX_COOKIES - 1)];
+
+        if (state == SCAN_LINE) {
+            if (c == '\n') {
+                if (line_len == 0)
+                    break;  // End of headers
+                line_len = 0;
+                match = 0;
+            } else if (c != '\r') {
+                if (match < 7 && (c | 0x20) == cookie_header_char(match)) {
+                    match++;
+                    if (match == 7) {
+                        state = SCAN_NAME;
+                        name_len = 0;
+                        name_hash = FNV_OFFSET;
+                    }
+                } else {
+                    match = 8;
+                }
+                line_len++;
+            }
+        } else if (state == SCAN_NAME) {
+            if (c == '\r' || c == '\n') {
+                break;
+            } else if (c == '=') {
+                state = SCAN_VALUE;
+                value_len = 0;
+                value_hash = FNV_OFFSET;
+            } else if (c == ';') {
+                name_len = 0;  // Cookie without a value
+                name_hash = FNV_OFFSET;
+            } else if (c != ' ' || name_len) {
+                name_hash = (name_hash ^ (__u8)c) * FNV_PRIME;
+                name_len++;
+            }
+        } else {
+            if (c == ';' || c == '\r' || c == '\n') {
+                pair->name_hash = name_hash;
+                pair->value_hash = value_hash;
+                pair->value_len = value_len > 0xFFFF ? 0xFFFF : value_len;
+                count++;
+                if (c != ';' || count == MAX_COOKIES)
+                    break;
+                state = SCAN_NAME;
+                name_len = 0;
+                name_hash = FNV_OFFSET;
+            } else {
+                value_hash = (value_hash ^ (__u8)c) * FNV_PRIME;
+                if (value_len < COOKIE_VALUE_PREFIX)
+                    pair->value[value_len & (COOKIE_VALUE_PREFIX - 1)] = c;
+                value_len++;
+            }
+        }
+    }
+    if (count == 0)
+        return;
+
+    record->src_ip = info->src_ip;
+    record->dst_ip = info->dst_ip;
+    record->src_port = info->src_port;
+    record->dst_port = info->dst_port;
+    record->seq_num = info->seq_num;
+    record->method = method;
+    record->cookie_count = count;
+    __u32 record_len = COOKIE_HEADER_LEN + count * sizeof(struct cookie_pair);
+    if (record_len > sizeof(*record))
+        return;
+#ifdef USE_RINGBUF
+    int ret = cookie_events.ringbuf_output(record, record_len, 0);
+#else
+    int ret = cookie_events.perf_submit(ctx, record, record_len);
+#endif
+    stat_inc(ret < 0 ? STAT_SUBMIT_FAILURES : STAT_COOKIE_EVENTS);
+}
+#endif // EXTRACT_COOKIES
 
 int count_tcp_packets(struct xdp_md *ctx) {
     // Data pointers
@@ -42,9 +431,12 @@ int count_tcp_packets(struct xdp_md *ctx) {
 
     // Packet info structure (stack memory)
     int zero = 0;
+    stat_inc(STAT_PACKETS);
     struct packet_info *info = tmp_packet.lookup(&zero);
-    if (!info)
+    if (!info) {
+        stat_inc(STAT_LOOKUP_FAILURES);
         return XDP_PASS;
+    }
     info->packet_len = data_end - data;
 
     // Ethernet header
@@ -66,6 +458,12 @@ int count_tcp_packets(struct xdp_md *ctx) {
     info->dst_ip = ip->daddr;
     info->protocol = ip->protocol;
 
+    struct filter_config *filter = filter_config.lookup(&zero);
+    if (filter && !addresses_allowed(filter, ip->saddr, ip->daddr)) {
+        stat_inc(STAT_FILTERED);
+        return XDP_PASS;
+    }
+
     // Handle TCP packets
     if (ip->protocol == IPPROTO_TCP) {
         // TCP header
@@ -76,6 +474,11 @@ int count_tcp_packets(struct xdp_md *ctx) {
         info->src_port = bpf_ntohs(tcp->source);
         info->dst_port = bpf_ntohs(tcp->dest);
         info->packet_type = 0; // TCP
+        if (filter && (filter->flags & FILTER_PORTS) &&
+            !port_allowed(info->src_port) && !port_allowed(info->dst_port)) {
+            stat_inc(STAT_FILTERED);
+            return XDP_PASS;
+        }
 
         // Extract TCP-specific fields
         info->seq_num = bpf_ntohl(tcp->seq);
@@ -90,6 +493,7 @@ int count_tcp_packets(struct xdp_md *ctx) {
         if (tcp->ack == 1 && tcp->syn == 0 && tcp->fin == 0 &&
             tcp->psh == 0 && tcp->rst == 0 && tcp->urg == 0 &&
             data_end - http_data == 0) {
+            stat_inc(STAT_SKIPPED_ACKS);
             return XDP_PASS;
         }
 
@@ -99,74 +503,74 @@ int count_tcp_packets(struct xdp_md *ctx) {
             (*value)++;
         } else {
             __u64 initial_value = 1;
-            packet_count.update(&info->src_ip, &initial_value);
+            if (packet_count.update(&info->src_ip, &initial_value) < 0)
+                stat_inc(STAT_LOOKUP_FAILURES);
         }
+        stat_inc(STAT_COUNTED);
+#ifdef DEBUG_TRACE
+        // Debug builds only (`debug_trace: true`): bpf_trace_printk
+        // serializes on a global lock
+        bpf_trace_printk("src=%x dport=%u len=%u", bpf_ntohl(info->src_ip),
+                         info->dst_port, info->packet_len);
+#endif
 
-        // Sampling: Use per-CPU counter for consistency
-        __u32 index = 0; // Index for the single entry in sample_counter
-        __u64 *counter = sample_counter.lookup(&index);
-            // Log the first part of the TCP packet details
-
-
-        bpf_trace_printk("SRC IP1: %u",
-            (info->src_ip));
-        bpf_trace_printk("SRC IP2: %u.%u.%u",
-            (info->src_ip & 0xFF),
-            (info->src_ip >> 8) & 0xFF,
-            (info->src_ip >> 16) & 0xFF);
-
-        // Print source IP (last octet)
-        bpf_trace_printk("SRC IP2: %u",
-            (info->src_ip >> 24) & 0xFF,
-            0, 0);  // Padding arguments
-
-        // // Print destination IP (first two octets)
-        // bpf_trace_printk("DST IP1: %u.%u.%u",
-        //     (info->dst_ip & 0xFF),
-        //     (info->dst_ip >> 8) & 0xFF,
-        //     (info->dst_ip >> 16) & 0xFF);
-
-        // // Print destination IP (last octet)
-        // bpf_trace_printk("DST IP2: %u",
-        //     (info->dst_ip >> 24) & 0xFF,
-        //     0, 0);
-        // // Log the second part: ports
-        // bpf_trace_printk("src_port=%d, dst_port=%d\n", info->src_port, info->dst_port);
-
-        // // Log the third part: sequence and acknowledgment numbers
-        // bpf_trace_printk("seq=%u, ack=%u\n", info->seq_num, info->ack_num);
-
-        // // Log the fourth part: flags and length
-        // bpf_trace_printk("flags=0x%x, len=%d\n", info->tcp_flags, info->packet_len);
-        // #pragma unroll
-        // for (int i = 0; i < 1500; i += 3) {
-        //     if (http_data + i + 2 > data_end)
-        //         break;
-                
-        //     unsigned char *chunk = http_data + i;
-        //     if (chunk + 2 <= (unsigned char *)data_end) {
-        //         if (chunk >= (unsigned char *)data && 
-        //             chunk + 2 < (unsigned char *)data_end) {
-        //             bpf_trace_printk("HTTP: %c%c%c",
-        //                 chunk[0],
-        //                 chunk[1],
-        //                 chunk[2]);
-        //         }
-        //     }
-        // }
-        // Send data to user space
-
+#ifdef FLOW_EVENTS
+        // Flow tracking (`flows` configured): connection opens and closes
+        // are sent header only and unsampled, so the daemon sees flow
+        // boundaries even when they carry no payload
+        if (http_data >= data_end && (info->tcp_flags & 0x07)) {
+            info->tcp_flags |= TCP_FLAG_UNSAMPLED;
+            info->http_data_len = 0;
+#ifdef USE_RINGBUF
+            int ret = packet_events.ringbuf_output(info, PACKET_HEADER_LEN, 0);
+#else
+            int ret = packet_events.perf_submit(ctx, info, PACKET_HEADER_LEN);
+#endif
+            stat_inc(ret < 0 ? STAT_SUBMIT_FAILURES : STAT_PACKET_EVENTS);
+            return XDP_PASS;
+        }
+#endif
 
 if (http_data < data_end) {
+    if (filter && (filter->flags & (FILTER_METHODS | FILTER_HOST_PREFIXES)) &&
+        !http_allowed(filter, http_data, data_end)) {
+        stat_inc(STAT_FILTERED);
+        return XDP_PASS;
+    }
+
+    // Sample after counting, so per-source counts stay exact
+    __u32 index = 0;
+    __u32 *rate = sample_control.lookup(&index);
+    __u64 *counter = sample_counter.lookup(&index);
+    if (rate && counter && *rate > 1) {
+        if (*counter > 0) {
+            (*counter)--;
+            stat_inc(STAT_SAMPLED_OUT);
+            return XDP_PASS;
+        }
+        *counter = *rate - 1;
+    }
+#ifdef EXTRACT_COOKIES
+    // Only cookie records carry payload data in this mode, packet events
+    // are header only
+    extract_cookies(ctx, info, http_data, data_end);
+    info->http_data_len = 0;
+#ifdef USE_RINGBUF
+    int ret = packet_events.ringbuf_output(info, PACKET_HEADER_LEN, 0);
+#else
+    int ret = packet_events.perf_submit(ctx, info, PACKET_HEADER_LEN);
+#endif
+    stat_inc(ret < 0 ? STAT_SUBMIT_FAILURES : STAT_PACKET_EVENTS);
+#else
     __u32 data_len = 0;
     // Safely compute the data length
     if (data_end > http_data) {
         
         data_len = data_end - http_data;
-        bpf_trace_printk(" %d", data_len);
-
-        if (data_len > MAX_HTTP_DATA)
+        if (data_len > MAX_HTTP_DATA) {
             data_len = MAX_HTTP_DATA;
+            stat_inc(STAT_TRUNCATED);
+        }
         
         if (data_len > 0) {
             // XDP programs can directly access packet data within bounds
@@ -179,11 +583,19 @@ if (http_data < data_end) {
             }
             
             info->http_data_len = data_len;
-            packet_events.perf_submit(ctx, info, sizeof(*info));
+            __u32 record_len = PACKET_HEADER_LEN + data_len;
+#ifdef USE_RINGBUF
+            int ret = packet_events.ringbuf_output(info, record_len, 0);
+#else
+            int ret = packet_events.perf_submit(ctx, info, record_len);
+#endif
+            stat_inc(ret < 0 ? STAT_SUBMIT_FAILURES : STAT_PACKET_EVENTS);
         }
     }
+#endif // EXTRACT_COOKIES
 }
     }
 
     return XDP_PASS;
-}
\ No newline at end of file
+}
+#endif // BPF_MAPS_ONLY
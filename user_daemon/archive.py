@@ -0,0 +1,547 @@
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from decoder import MAX_HTTP_DATA
+
+# Columns of a segment, each stored contiguously for `capacity` rows.
+# timestamp is the Unix time the batch was decoded; payload_end is the end
+# offset of the row's payload in the segment's .payload file.
+ARCHIVE_COLUMNS = (
+    ("timestamp", np.dtype(np.float64)),
+    ("src_ip", np.dtype(np.uint32)),
+    ("dst_ip", np.dtype(np.uint32)),
+    ("src_port", np.dtype(np.uint16)),
+    ("dst_port", np.dtype(np.uint16)),
+    ("protocol", np.dtype(np.uint8)),
+    ("packet_type", np.dtype(np.uint8)),
+    ("packet_len", np.dtype(np.uint32)),
+    ("seq_num", np.dtype(np.uint32)),
+    ("ack_num", np.dtype(np.uint32)),
+    ("tcp_flags", np.dtype(np.uint8)),
+    ("http_data_len", np.dtype(np.uint32)),
+    ("payload_end", np.dtype(np.uint64)),
+)
+_PACKET_COLUMNS = tuple(name for name, _ in ARCHIVE_COLUMNS if name not in ("timestamp", "payload_end"))
+
+MAGIC = b"EVTARCH1"
+# first_seq and last_seq are the ids of the segments written by the daemon
+# that a segment holds: its own, or those merged into it by compaction
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"),
+    ("sealed", np.uint32),
+    ("index_interval", np.uint32),
+    ("capacity", np.uint64),
+    ("count", np.uint64),
+    ("first_seq", np.uint64),
+    ("last_seq", np.uint64),
+    ("first_time", np.float64),
+    ("last_time", np.float64),
+])
+PAGE_SIZE = 4096
+SEGMENT_SUFFIX = ".evt"
+PAYLOAD_SUFFIX = ".payload"
+
+
+def _align(offset):
+    return -(-offset // PAGE_SIZE) * PAGE_SIZE
+
+
+def segment_layout(capacity, index_interval):
+    """
+    Byte offset of each column and of the timestamp index, and the file
+    size, of a segment. Regions start on page boundaries.
+    """
+    offsets = {}
+    offset = PAGE_SIZE
+    for name, dtype in ARCHIVE_COLUMNS:
+        offsets[name] = offset
+        offset = _align(offset + capacity * dtype.itemsize)
+    offsets["index"] = offset
+    offset = _align(offset + (capacity // index_interval + 1) * 8)
+    return offsets, offset
+
+
+def _segment_name(segment_id):
+    return f"segment-{segment_id:010d}"
+
+
+class Segment:
+    """
+    One segment file mapped into memory: a page of header, then each column
+    for `capacity` rows, then the sparse index holding the timestamp of
+    every `index_interval`th row. Payloads are appended to a .payload file
+    next to it. Rows are never rewritten, and `count` is only raised after
+    they are in place, so readers never see partial rows.
+    """
+
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.payload_path = path[:-len(SEGMENT_SUFFIX)] + PAYLOAD_SUFFIX
+        self.id = int(os.path.basename(path)[len("segment-"):-len(SEGMENT_SUFFIX)])
+        with open(path, "r+b" if writable else "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self._map)
+        if bytes(self.header["magic"]) != MAGIC:
+            raise ValueError(f"{path} is not an event archive segment")
+        self.capacity = int(self.header["capacity"])
+        self.index_interval = int(self.header["index_interval"])
+        offsets, _ = segment_layout(self.capacity, self.index_interval)
+        self.columns = {name: np.ndarray(self.capacity, dtype=dtype, buffer=self._map, offset=offsets[name])
+                        for name, dtype in ARCHIVE_COLUMNS}
+        self.index = np.ndarray(self.capacity // self.index_interval + 1, dtype=np.float64, buffer=self._map,
+                                offset=offsets["index"])
+        self._payloads = None
+
+    @classmethod
+    def create(cls, path, capacity, index_interval, first_seq, last_seq=None):
+        """
+        Create an empty segment file. The file is sparse: column pages are
+        only allocated as rows fill them.
+        """
+        _, size = segment_layout(capacity, index_interval)
+        header = np.zeros((), dtype=HEADER_DTYPE)
+        header["magic"] = MAGIC
+        header["index_interval"] = index_interval
+        header["capacity"] = capacity
+        header["first_seq"] = first_seq
+        header["last_seq"] = first_seq if last_seq is None else last_seq
+        with open(path, "xb") as f:
+            f.write(header.tobytes())
+            f.truncate(size)
+        open(path[:-len(SEGMENT_SUFFIX)] + PAYLOAD_SUFFIX, "ab").close()
+        return cls(path, writable=True)
+
+    @property
+    def count(self):
+        return int(self.header["count"])
+
+    @property
+    def sealed(self):
+        return bool(self.header["sealed"])
+
+    @property
+    def first_time(self):
+        return float(self.header["first_time"])
+
+    @property
+    def last_time(self):
+        return float(self.header["last_time"])
+
+    @property
+    def seq_range(self):
+        return int(self.header["first_seq"]), int(self.header["last_seq"])
+
+    def disk_bytes(self):
+        """
+        Bytes allocated on disk for the segment and its payloads.
+        """
+        return sum(os.stat(path).st_blocks * 512 for path in (self.path, self.payload_path)
+                   if os.path.exists(path))
+
+    def row_range(self, since=None, until=None, count=None):
+        """
+        Rows [start, stop) whose timestamp is in [since, until), found with
+        the sparse index and a search of one index block each.
+        """
+        count = self.count if count is None else count
+        return (self._first_row(since, count) if since is not None else 0,
+                self._first_row(until, count) if until is not None else count)
+
+    def _first_row(self, when, count):
+        interval = self.index_interval
+        entries = self.index[:(count - 1) // interval + 1] if count else self.index[:0]
+        block = int(np.searchsorted(entries, when, side="left"))
+        start = max(0, (block - 1) * interval)
+        stop = min(count, block * interval)
+        return start + int(np.searchsorted(self.columns["timestamp"][start:stop], when, side="left"))
+
+    def payloads(self):
+        """
+        The .payload file mapped read-only, or an empty buffer.
+        """
+        if self._payloads is None or len(self._payloads) < self.payload_size():
+            size = self.payload_size()
+            if not size:
+                return memoryview(b"")
+            with open(self.payload_path, "rb") as f:
+                self._payloads = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._payloads)
+
+    def payload_size(self):
+        count = self.count
+        return int(self.columns["payload_end"][count - 1]) if count else 0
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        # Column views keep the mapping alive until they are dropped
+        self.columns = self.index = self.header = None
+        self._map = self._payloads = None
+
+
+class ArchiveSlice:
+    """
+    Rows [start, stop) of a segment. columns are read-only views of the
+    mapped file, so slicing copies nothing until the arrays are used.
+    """
+
+    def __init__(self, segment, start, stop, columns=None):
+        self.segment = segment
+        self.start = start
+        self.stop = stop
+        names = [name for name, _ in ARCHIVE_COLUMNS] if columns is None else columns
+        self.columns = {name: segment.columns[name][start:stop] for name in names}
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def payload(self, i):
+        """
+        Payload of row i of the slice, as a memoryview of the mapped file.
+        """
+        ends = self.segment.columns["payload_end"]
+        row = self.start + i
+        begin = int(ends[row - 1]) if row else 0
+        return self.segment.payloads()[begin:int(ends[row])]
+
+    def payloads(self):
+        return [bytes(self.payload(i)) for i in range(len(self))]
+
+
+class ArchiveReader:
+    """
+    Reads an archive directory, possibly while the daemon is writing to
+    it. Segments are mapped read-only and rows are seen as of when the
+    segment was opened; open a new reader to see later ones.
+
+        reader = ArchiveReader("/var/lib/ebpf-cookie-filter/archive")
+        for part in reader.read(since=time.time() - 3600):
+            busiest = np.bincount(part.columns["dst_port"]).argmax()
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = list_segments(directory)
+
+    def read(self, since=None, until=None, columns=None):
+        """
+        ArchiveSlices, oldest first, of the rows with since <= timestamp <
+        until, as Unix times.
+        """
+        slices = []
+        for segment in self.segments:
+            count = segment.count
+            if not count:
+                continue
+            if (since is not None and segment.last_time < since) or (until is not None and segment.first_time >= until):
+                continue
+            start, stop = segment.row_range(since, until, count)
+            if stop > start:
+                slices.append(ArchiveSlice(segment, start, stop, columns))
+        return slices
+
+    def count(self, since=None, until=None):
+        return sum(len(part) for part in self.read(since, until, columns=()))
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+def list_segments(directory, writable=False, remove_covered=False):
+    """
+    The segments of an archive, oldest first. While compaction replaces
+    segments with their merge, both may be present for a moment; segments
+    covered by another are left out, and with remove_covered deleted, which
+    only the writer may do.
+    """
+    segments = []
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith("segment-") and name.endswith(SEGMENT_SUFFIX)):
+            continue
+        try:
+            segments.append(Segment(os.path.join(directory, name), writable))
+        except (OSError, ValueError) as e:
+            # Removed by retention or compaction since listing, or not ours
+            logging.debug(f"Skipping archive segment {name}: {e}")
+    segments.sort(key=lambda segment: (segment.seq_range[0], -segment.seq_range[1]))
+    kept = []
+    for segment in segments:
+        if kept and segment.seq_range[1] <= kept[-1].seq_range[1]:
+            segment.close()
+            if remove_covered:
+                os.remove(segment.path)
+                os.remove(segment.payload_path)
+            continue
+        kept.append(segment)
+    return kept
+
+
+def compact_segments(directory, segments, target_events, next_id):
+    """
+    Merge runs of consecutive sealed segments of less than half
+    target_events rows into segments of up to target_events rows, sized to
+    their contents; a segment with room to spare is rewritten even alone.
+    Larger segments are left as they are. next_id() gives ids for the
+    merged segments. Returns the number of segments replaced.
+
+    A run that cannot take in another segment is merged whole, and its
+    merge is too large, or too hemmed in, to be merged again. Only the run
+    at the end of the archive grows from pass to pass, so there a segment
+    merged on an earlier pass is kept out while it holds more than half of
+    the run's rows. Every copy of a row thus at least doubles the segment
+    it lands in, and a long capture of small segments copies each row a
+    logarithmic number of times instead of on every pass.
+    """
+    replaced = 0
+    run = []
+    for segment in segments + [None]:
+        small = segment is not None and segment.sealed and segment.count < target_events // 2
+        if small and sum(s.count for s in run) + segment.count <= target_events:
+            run.append(segment)
+            continue
+        replaced += _compact_run(directory, run, next_id, growing=segment is None)
+        run = [segment] if small else []
+    return replaced
+
+
+def _compact_run(directory, run, next_id, growing=False):
+    """
+    Merge a run of consecutive small segments. In a run that is still
+    growing, the run is split around an already compacted segment holding
+    more than half of its rows, which is left as it is.
+    """
+    if not run:
+        return 0
+    largest = max(range(len(run)), key=lambda i: run[i].count)
+    held = run[largest]
+    if growing and len(run) > 1 and held.capacity == held.count and held.count * 2 > sum(s.count for s in run):
+        return (_compact_run(directory, run[:largest], next_id)
+                + _compact_run(directory, run[largest + 1:], next_id, growing))
+    if len(run) > 1 or run[0].capacity > run[0].count:
+        _merge(directory, run, next_id())
+        return len(run)
+    return 0
+
+
+def _merge(directory, run, segment_id):
+    """
+    Write the rows of a run of segments as one new segment and remove them.
+    The merge is built in a subdirectory and moved in payloads first, so
+    readers only see it complete.
+    """
+    total = sum(segment.count for segment in run)
+    interval = run[0].index_interval
+    building = os.path.join(directory, ".compacting")
+    os.makedirs(building, exist_ok=True)
+    merged_name = _segment_name(segment_id)
+    merged = Segment.create(os.path.join(building, merged_name + SEGMENT_SUFFIX), max(total, 1), interval,
+                            run[0].seq_range[0], run[-1].seq_range[1])
+    with open(merged.payload_path, "wb") as out:
+        for segment in run:
+            out.write(segment.payloads()[:segment.payload_size()])
+    payload_base = 0
+    row = 0
+    for segment in run:
+        count = segment.count
+        for name, _ in ARCHIVE_COLUMNS:
+            merged.columns[name][row:row + count] = segment.columns[name][:count]
+        merged.columns["payload_end"][row:row + count] += np.uint64(payload_base)
+        payload_base += segment.payload_size()
+        row += count
+    merged.index[:(total - 1) // interval + 1 if total else 0] = merged.columns["timestamp"][:total:interval]
+    merged.header["count"] = total
+    merged.header["first_time"] = run[0].first_time
+    merged.header["last_time"] = run[-1].last_time
+    merged.header["sealed"] = 1
+    merged.flush()
+    merged.close()
+    os.replace(os.path.join(building, merged_name + PAYLOAD_SUFFIX),
+               os.path.join(directory, merged_name + PAYLOAD_SUFFIX))
+    os.replace(os.path.join(building, merged_name + SEGMENT_SUFFIX), os.path.join(directory, merged_name + SEGMENT_SUFFIX))
+    for segment in run:
+        segment.close()
+        os.remove(segment.path)
+        os.remove(segment.payload_path)
+
+
+class ArchiveWriter:
+    """
+    Appends decoded packet batches to an archive directory of rotating,
+    memory-mapped segments (see Segment), a new one every `segment_events`
+    rows or `segment_seconds` seconds.
+
+    maintain() runs the housekeeping in a background thread: segments older
+    than `retention` seconds, or the oldest beyond `max_bytes` on disk, are
+    deleted, and sealed segments are compacted: runs of small ones merged
+    (size-tiered, see compact_segments) and each shrunk to its row count.
+    Segments left unsealed by a previous run are sealed on start.
+    """
+
+    def __init__(self, directory, segment_events=1 << 20, segment_seconds=3600.0, index_interval=1024,
+                 payloads=True, retention=7 * 86400.0, max_bytes=None, clock=time.time):
+        self.directory = directory
+        self.segment_events = segment_events
+        self.segment_seconds = segment_seconds
+        self.index_interval = index_interval
+        self.store_payloads = payloads
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.segment = None
+        self.payload_file = None
+        self.events = 0
+        self.bytes_written = 0
+        self.segments_removed = 0
+        self.segments_compacted = 0
+        self.disk_bytes = 0
+        self.segment_count = 0
+        self._id_lock = threading.Lock()
+        self._maintenance = None
+
+        os.makedirs(directory, exist_ok=True)
+        # Merges interrupted by a crash, before their segment was moved in
+        # or before the segments it replaced were removed
+        shutil.rmtree(os.path.join(directory, ".compacting"), ignore_errors=True)
+        existing = list_segments(directory, writable=True, remove_covered=True)
+        # Payloads whose segment was removed just before a crash
+        for name in os.listdir(directory):
+            if (name.startswith("segment-") and name.endswith(PAYLOAD_SUFFIX)
+                    and not os.path.exists(os.path.join(directory, name[:-len(PAYLOAD_SUFFIX)] + SEGMENT_SUFFIX))):
+                os.remove(os.path.join(directory, name))
+        self._next_id = max((segment.id for segment in existing), default=0) + 1
+        for segment in existing:
+            if not segment.sealed:
+                segment.header["sealed"] = 1
+                segment.flush()
+            segment.close()
+
+    def next_id(self):
+        with self._id_lock:
+            segment_id = self._next_id
+            self._next_id += 1
+            return segment_id
+
+    def append(self, raw, now=None):
+        """
+        Archive a batch of PACKET_INFO_DTYPE records (or the compact form
+        workers hand off) decoded at Unix time `now`.
+        """
+        if len(raw) == 0:
+            return
+        now = self.clock() if now is None else now
+        raw = np.ascontiguousarray(raw)
+        start = 0
+        while start < len(raw):
+            if self.segment is None or self.segment.count == self.segment.capacity:
+                self._rotate(now)
+            take = min(len(raw) - start, self.segment.capacity - self.segment.count)
+            self._write(raw[start:start + take], now)
+            start += take
+        self.events += len(raw)
+
+    def _write(self, raw, now):
+        segment = self.segment
+        count = segment.count
+        rows = slice(count, count + len(raw))
+        columns = segment.columns
+        # Timestamps never go backwards within a segment, so the index stays
+        # sorted when the clock steps back
+        now = max(now, segment.last_time)
+        columns["timestamp"][rows] = now
+        for name in _PACKET_COLUMNS:
+            columns[name][rows] = raw[name]
+        width = raw.dtype["http_data"].itemsize
+        lengths = np.minimum(raw["http_data_len"], min(width, MAX_HTTP_DATA)).astype(np.uint64)
+        columns["http_data_len"][rows] = lengths
+        base = np.uint64(columns["payload_end"][count - 1]) if count else np.uint64(0)
+        if self.store_payloads:
+            offset = raw.dtype.fields["http_data"][1]
+            data = raw.view(np.uint8).reshape(len(raw), raw.dtype.itemsize)[:, offset:offset + width]
+            payloads = data[np.arange(width) < lengths[:, None]]
+            self.payload_file.write(payloads.tobytes())
+            self.bytes_written += len(payloads)
+            columns["payload_end"][rows] = base + np.cumsum(lengths)
+        else:
+            columns["payload_end"][rows] = base
+        interval = segment.index_interval
+        first_indexed = -(-count // interval) * interval
+        indexed = np.arange(first_indexed, count + len(raw), interval)
+        segment.index[indexed // interval] = now
+        if not count:
+            segment.header["first_time"] = now
+        segment.header["last_time"] = now
+        segment.header["count"] = count + len(raw)
+
+    def _rotate(self, now):
+        self._seal()
+        segment_id = self.next_id()
+        path = os.path.join(self.directory, _segment_name(segment_id) + SEGMENT_SUFFIX)
+        self.segment = Segment.create(path, self.segment_events, self.index_interval, segment_id)
+        self.payload_file = open(self.segment.payload_path, "ab", buffering=0)
+        self.segment_started = now
+
+    def _seal(self):
+        if self.segment is None:
+            return
+        self.segment.header["sealed"] = 1
+        self.segment.flush()
+        self.segment.close()
+        self.payload_file.close()
+        self.segment = None
+        self.payload_file = None
+
+    def maintain(self, now=None):
+        """
+        Rotate the current segment once it is `segment_seconds` old, and
+        start retention and compaction unless they are still running.
+        """
+        now = self.clock() if now is None else now
+        if self.segment is not None and self.segment.count and now - self.segment_started >= self.segment_seconds:
+            self._seal()
+        if self._maintenance is None or not self._maintenance.is_alive():
+            self._maintenance = threading.Thread(target=self._housekeeping, args=(now,), name="archive",
+                                                 daemon=True)
+            self._maintenance.start()
+
+    def _housekeeping(self, now):
+        try:
+            # Only sealed segments are removed or compacted; the one being
+            # written is not
+            segments = list_segments(self.directory)
+            sealed = [segment for segment in segments if segment.sealed]
+            kept = []
+            total = sum(segment.disk_bytes() for segment in segments)
+            for segment in sealed:
+                expired = self.retention and segment.last_time < now - self.retention
+                if expired or (self.max_bytes and total > self.max_bytes):
+                    total -= segment.disk_bytes()
+                    segment.close()
+                    os.remove(segment.path)
+                    os.remove(segment.payload_path)
+                    self.segments_removed += 1
+                else:
+                    kept.append(segment)
+            self.segments_compacted += compact_segments(self.directory, kept, self.segment_events, self.next_id)
+            for segment in segments:
+                segment.close()
+            segments = list_segments(self.directory)
+            self.segment_count = len(segments)
+            self.disk_bytes = sum(segment.disk_bytes() for segment in segments)
+            for segment in segments:
+                segment.close()
+        except Exception as e:
+            logging.error(f"Error maintaining the event archive: {e}")
+
+    def close(self):
+        if self._maintenance is not None:
+            self._maintenance.join()
+        self._seal()
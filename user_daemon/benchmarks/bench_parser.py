@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the HTTP header parser: the numba kernel against the
+pure-Python fallback, on batches of synthetic requests or a pcap's payloads.
+
+Times parse_packet_headers() on decoded batches read in place, as the
+daemon does without reassembly, and parse_headers() on lists of payloads,
+as it does after reassembly. The kernel's compile (or cache load) time is
+reported separately and excluded from the rates. Both parsers are checked
+to agree before timing.
+
+    python benchmarks/bench_parser.py --events 200000
+    python benchmarks/bench_parser.py --pcap capture.pcap --json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import header_parser  # noqa: E402
+from decoder import PacketBatchDecoder  # noqa: E402
+from event_sources import PcapReplaySource, SyntheticSource  # noqa: E402
+from header_parser import parse_headers, parse_packet_headers  # noqa: E402
+
+_COMPARED = ("method", "line_len", "target_start", "target_len", "host_start", "host_len", "cookie_start",
+             "cookie_len", "cookie_count")
+_COMPARED_PAIRS = ("text", "name_start", "name_len", "value_start", "value_len", "name_hash", "value_hash")
+
+
+def load_batches(args):
+    if args.pcap:
+        source = PcapReplaySource(args.pcap, loop=True, batch_size=args.batch_size)
+    else:
+        source = SyntheticSource(sources=args.sources, payload_size=args.payload_size, batch_size=args.batch_size)
+    decoder = PacketBatchDecoder(args.batch_size)
+    batches = []
+
+    def on_event(cpu, data, size):
+        if decoder.append(data, size):
+            batches.append(decoder.decode())
+
+    source.open(on_event)
+    while sum(map(len, batches)) < args.events:
+        source.poll(100)
+        if getattr(source, "finished", False):
+            break
+    if decoder.count:
+        batches.append(decoder.decode())
+    source.close()
+    return batches
+
+
+def check_agree(batch):
+    """
+    Exit unless both parsers give the same result for a batch.
+    """
+    compiled = parse_packet_headers(batch.raw, jit=True)
+    fallback = parse_packet_headers(batch.raw, jit=False)
+    for name in _COMPARED:
+        if (getattr(compiled, name) != getattr(fallback, name)).any():
+            sys.exit(f"parsers disagree on {name}")
+    for name in _COMPARED_PAIRS:
+        if (getattr(compiled.pairs, name) != getattr(fallback.pairs, name)).any():
+            sys.exit(f"parsers disagree on cookie {name}")
+
+
+def time_parser(name, parse, inputs, events, payload_bytes):
+    start = time.perf_counter()
+    cookies = 0
+    for item in inputs:
+        cookies += len(parse(item).pairs)
+    elapsed = time.perf_counter() - start
+    return {
+        "parser": name,
+        "seconds": elapsed,
+        "events_per_s": events / elapsed if elapsed else 0.0,
+        "us_per_event": elapsed / events * 1e6 if events else 0.0,
+        "mb_per_s": payload_bytes / elapsed / 2 ** 20 if elapsed else 0.0,
+        "cookies": cookies,
+    }
+
+
+def run(args):
+    batches = load_batches(args)
+    events = sum(map(len, batches))
+    payload_bytes = int(sum(batch.raw["http_data_len"].sum() for batch in batches))
+    payload_lists = [batch.payloads() for batch in batches]
+    report = {"events": events, "payload_bytes_per_event": payload_bytes / events if events else 0.0,
+              "numba": header_parser.numba is not None, "results": []}
+
+    cases = [("python/packets", lambda batch: parse_packet_headers(batch.raw, jit=False), batches),
+             ("python/payloads", lambda payloads: parse_headers(payloads, jit=False), payload_lists)]
+    if header_parser.numba is not None:
+        start = time.perf_counter()
+        check_agree(batches[0])
+        parse_headers(payload_lists[0], jit=True)
+        report["compile_s"] = time.perf_counter() - start
+        cases += [("numba/packets", lambda batch: parse_packet_headers(batch.raw, jit=True), batches),
+                  ("numba/payloads", lambda payloads: parse_headers(payloads, jit=True), payload_lists)]
+    for name, parse, inputs in cases:
+        report["results"].append(time_parser(name, parse, inputs, events, payload_bytes))
+    return report
+
+
+def print_report(report):
+    print(f"events: {report['events']} ({report['payload_bytes_per_event']:.0f} payload bytes/event)")
+    if not report["numba"]:
+        print("numba is not installed, timing the fallback only")
+    else:
+        print(f"numba compile or cache load: {report['compile_s']:.2f}s")
+    print(f"{'parser':<16} {'events/s':>12} {'us/event':>9} {'MB/s':>8} {'cookies':>9}")
+    for result in report["results"]:
+        print(f"{result['parser']:<16} {result['events_per_s']:>12,.0f} {result['us_per_event']:>9.3f} "
+              f"{result['mb_per_s']:>8.1f} {result['cookies']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pcap", help="pcap file whose payloads to parse (default: synthetic requests)")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--sources", type=int, default=1024, help="synthetic client addresses")
+    parser.add_argument("--payload-size", type=int, default=512, help="synthetic payload bytes")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the daemon's userspace pipeline.
+
+Feeds events from a pcap replay or the synthetic generator through the same
+decode, aggregation and export code the daemon runs, without BPF, root or
+live traffic, and reports events/sec, per-stage latency, transport and export bytes per
+event and memory.
+
+    python benchmarks/bench_pipeline.py --source synthetic --events 200000
+    python benchmarks/bench_pipeline.py --source pcap --pcap capture.pcap --loop
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture_buffer import CaptureRing  # noqa: E402
+from decoder import PACKET_FIELDS, PACKET_INFO_DTYPE, CookieBatchDecoder, PacketBatchDecoder  # noqa: E402
+from event_sources import PcapReplaySource, SyntheticSource  # noqa: E402
+from sketches import CookieAnalytics  # noqa: E402
+
+
+class StageTimer:
+    """
+    Collects per-batch wall time for one pipeline stage.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.events = 0
+
+    def record(self, seconds, events):
+        self.samples.append(seconds)
+        self.events += events
+
+    def summary(self):
+        samples = sorted(self.samples)
+        total = sum(samples)
+        if not samples:
+            return {"stage": self.name, "batches": 0}
+        return {
+            "stage": self.name,
+            "batches": len(samples),
+            "total_s": total,
+            "p50_ms": samples[len(samples) // 2] * 1e3,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e3,
+            "us_per_event": total / self.events * 1e6 if self.events else 0.0,
+        }
+
+
+def build_source(args):
+    if args.source == "pcap":
+        if not args.pcap:
+            sys.exit("--pcap is required with --source pcap")
+        return PcapReplaySource(args.pcap, loop=args.loop, batch_size=args.batch_size,
+                                extract_cookies=args.extract_cookies)
+    return SyntheticSource(sources=args.sources, payload_size=args.payload_size,
+                           batch_size=args.batch_size, extract_cookies=args.extract_cookies)
+
+
+def run(args):
+    source = build_source(args)
+    decoder = PacketBatchDecoder(args.batch_size)
+    cookie_decoder = CookieBatchDecoder(args.batch_size)
+    ring = CaptureRing(args.ring_size)
+    stages = {name: StageTimer(name) for name in ("copy", "decode", "analytics", "aggregate", "export")}
+    analytics = CookieAnalytics() if args.cookie_analytics else None
+    batches = []
+
+    def on_event(cpu, data, size):
+        if decoder.append(data, size):
+            batches.append(decoder.decode())
+
+    def on_cookie_event(cpu, data, size):
+        if cookie_decoder.append(data, size):
+            flush_cookies()
+
+    def flush_cookies():
+        t0 = time.perf_counter()
+        batch = cookie_decoder.decode()
+        if analytics:
+            analytics.add_cookie_batch(batch)
+        stages["analytics"].record(time.perf_counter() - t0, len(batch))
+
+    source.open(on_event, on_cookie_event)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    processed = 0
+    wire_bytes = 0
+    start = time.perf_counter()
+    while processed < args.events:
+        t0 = time.perf_counter()
+        delivered = source.poll(100)
+        if decoder.count:
+            batches.append(decoder.decode())
+        if cookie_decoder.count:
+            flush_cookies()
+        stages["copy"].record(time.perf_counter() - t0, delivered or 0)
+        if not batches:
+            if getattr(source, "finished", False):
+                break
+            continue
+
+        for batch in batches:
+            t0 = time.perf_counter()
+            rows = list(batch.rows())
+            stages["decode"].record(time.perf_counter() - t0, len(rows))
+
+            if analytics and not args.extract_cookies:
+                t0 = time.perf_counter()
+                analytics.add_payloads(batch.raw["src_ip"], batch.payloads())
+                stages["analytics"].record(time.perf_counter() - t0, len(rows))
+
+            t0 = time.perf_counter()
+            ring.extend(rows)
+            stages["aggregate"].record(time.perf_counter() - t0, len(rows))
+
+            t0 = time.perf_counter()
+            exported = 0
+            while len(ring):
+                _, packets = ring.take(args.export_batch_size)
+                payload = {"columns": {name: [getattr(p, name) for p in packets] for name in PACKET_FIELDS}}
+                body = gzip.compress(json.dumps(payload).encode(), compresslevel=5)
+                ring.ack(packets[-1].seq)
+                wire_bytes += len(body)
+                exported += len(packets)
+            stages["export"].record(time.perf_counter() - t0, exported)
+            processed += len(rows)
+        batches.clear()
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "source": args.source,
+        "events": processed,
+        "elapsed_s": elapsed,
+        "events_per_s": processed / elapsed if elapsed else 0.0,
+        "transport_bytes_per_event": ((decoder.received_bytes + cookie_decoder.received_bytes)
+                                      / decoder.received_records if decoder.received_records else 0.0),
+        "fixed_record_bytes": PACKET_INFO_DTYPE.itemsize,
+        "wire_bytes_per_event": wire_bytes / processed if processed else 0.0,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": [timer.summary() for timer in stages.values()],
+    }
+    if args.tracemalloc:
+        report["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    return report
+
+
+def print_report(report):
+    print(f"source: {report['source']}")
+    print(f"events: {report['events']} in {report['elapsed_s']:.2f}s "
+          f"({report['events_per_s']:,.0f} events/s)")
+    print(f"transport bytes/event: {report['transport_bytes_per_event']:.1f} "
+          f"(fixed-size record: {report['fixed_record_bytes']})")
+    print(f"export bytes/event: {report['wire_bytes_per_event']:.1f}")
+    print(f"max RSS: {report['max_rss_mb']:.1f} MB")
+    if "traced_peak_mb" in report:
+        print(f"traced Python peak: {report['traced_peak_mb']:.1f} MB")
+    print(f"{'stage':<10} {'batches':>8} {'p50 ms':>9} {'p99 ms':>9} {'us/event':>9}")
+    for stage in report["stages"]:
+        if not stage["batches"]:
+            continue
+        print(f"{stage['stage']:<10} {stage['batches']:>8} {stage['p50_ms']:>9.3f} "
+              f"{stage['p99_ms']:>9.3f} {stage['us_per_event']:>9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", choices=("synthetic", "pcap"), default="synthetic")
+    parser.add_argument("--pcap", help="pcap file to replay")
+    parser.add_argument("--loop", action="store_true", help="loop the pcap until --events are processed")
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--ring-size", type=int, default=65536)
+    parser.add_argument("--export-batch-size", type=int, default=5000)
+    parser.add_argument("--sources", type=int, default=1024, help="synthetic client addresses")
+    parser.add_argument("--payload-size", type=int, default=512, help="synthetic payload bytes")
+    parser.add_argument("--extract-cookies", action="store_true",
+                        help="emulate the EXTRACT_COOKIES build: header-only packet events plus cookie records")
+    parser.add_argument("--cookie-analytics", action="store_true", help="also run the cookie sketches")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace Python allocations (slower)")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark for the BPF build cache.
+
+Loads the daemon's XDP program cold (cache evicted first) and then warm from
+the pinned build, without attaching it, and reports the load times. Needs
+root and BCC, and runs from the daemon directory so config.yaml is found.
+
+    sudo python benchmarks/bench_startup.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bpf_cache import DEFAULT_CACHE_DIR, BPFBuildCache  # noqa: E402
+from config import config  # noqa: E402
+from main import bpf_cflags  # noqa: E402
+
+
+def load_seconds(cache, cflags, warm):
+    src_file = config["ebpf_program"]
+    function_name = str(config["function_name"])
+    if not warm:
+        cache.evict(cache.key(src_file, cflags, function_name))
+    loaded = cache.load(src_file, cflags, function_name)
+    loaded.bpf.cleanup()
+    if loaded.warm != warm:
+        sys.exit(f"expected a {'warm' if warm else 'cold'} load, check that bpffs is mounted")
+    return loaded.seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    cache = BPFBuildCache(config.get("bpf_cache_dir", DEFAULT_CACHE_DIR))
+    cflags = bpf_cflags()
+    report = {}
+    for kind, warm in (("cold", False), ("warm", True)):
+        samples = [load_seconds(cache, cflags, warm) for _ in range(args.runs)]
+        report[kind] = {"runs": args.runs, "median_s": statistics.median(samples), "max_s": max(samples)}
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for kind, result in report.items():
+            print(f"{kind}: median {result['median_s']:.3f}s, max {result['max_s']:.3f}s over {result['runs']} runs")
+        print(f"speedup: {report['cold']['median_s'] / report['warm']['median_s']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from collections import namedtuple
+
+import bcc
+from bcc import BPF
+from bcc.libbcc import lib
+
+# bpffs directory holding one subdirectory of pinned objects per cache key
+PIN_ROOT = "/sys/fs/bpf/ebpf_cookie_filter"
+
+# Manifests of the pinned builds, one JSON file per cache key
+DEFAULT_CACHE_DIR = "/var/cache/ebpf-cookie-filter"
+
+# Compiled with this macro the program only declares its maps, see
+# ebpf_module/http_filter.c
+MAPS_ONLY_FLAG = "-DBPF_MAPS_ONLY"
+
+CachedFunction = namedtuple("CachedFunction", ["bpf", "name", "fd"])
+LoadedProgram = namedtuple("LoadedProgram", ["bpf", "fn", "warm", "seconds"])
+
+
+def kernel_cflags(extra=()):
+    """
+    Compiler flags for building the BPF programs against the running
+    kernel's headers.
+    """
+    kernel_headers = f"/lib/modules/{os.uname().release}/build"
+    return [
+        f"-I{kernel_headers}/include",
+        f"-I{kernel_headers}/include/uapi",
+        f"-I{kernel_headers}/arch/{os.uname().machine}/include",
+        "-I/usr/include",            # Include standard include directories
+        "-I/usr/include/bcc",        # Include the directory with BCC's helpers.h
+        "-D__KERNEL__",
+        "-Wno-unused-value",
+        "-Wno-pointer-sign",
+        "-Wno-compare-distinct-pointer-types",
+        *extra,
+    ]
+
+
+class BPFBuildCache:
+    """
+    Cache of loaded BPF programs, keyed by program source, cflags, function,
+    kernel release and BCC version.
+
+    BCC has no way to load a prebuilt object file, so the cache keeps the
+    verified program and its maps pinned in bpffs instead. A cold start
+    compiles and loads the program as usual, then pins it. A warm start
+    fetches the pinned program, and builds BCC table objects by compiling
+    the source with BPF_MAPS_ONLY, which drops the program bodies (and with
+    them the bulk of the clang and verifier work), before pointing each table
+    at its pinned map. The retargeted tables are installed in `bpf.tables`,
+    so look maps up with `bpf[name]`: `get_table()` builds a new table bound
+    to the MAPS_ONLY build's own, unused map. Pinned maps keep their
+    contents across runs. Pins live in memory, so the first start after a
+    reboot is always cold.
+    """
+
+    def __init__(self, cache_dir, pin_root=PIN_ROOT):
+        self.cache_dir = cache_dir
+        self.pin_root = pin_root
+
+    def key(self, src_file, cflags, function_name):
+        digest = hashlib.sha256()
+        with open(src_file, "rb") as f:
+            digest.update(f.read())
+        for part in (*sorted(cflags), function_name, os.uname().release, getattr(bcc, "__version__", "")):
+            digest.update(b"\0" + str(part).encode())
+        return digest.hexdigest()[:32]
+
+    def load(self, src_file, cflags, function_name, prog_type=BPF.XDP):
+        """
+        Return a LoadedProgram, warm from the pins when possible.
+        """
+        start = time.monotonic()
+        key = self.key(src_file, cflags, function_name)
+        manifest = self._read_manifest(key)
+        if manifest is not None:
+            try:
+                bpf, fn = self._load_warm(key, manifest, src_file, cflags, function_name)
+                return LoadedProgram(bpf, fn, True, time.monotonic() - start)
+            except Exception as e:
+                logging.warning(f"Cached BPF program {key} is unusable, rebuilding: {e}")
+                self.evict(key)
+        bpf, fn = self._load_cold(key, src_file, cflags, function_name, prog_type)
+        return LoadedProgram(bpf, fn, False, time.monotonic() - start)
+
+    def prebuild(self, src_file, cflags, function_name, prog_type=BPF.XDP):
+        """
+        Build and pin the program without attaching it, replacing pins from
+        other cache keys.
+        """
+        key = self.key(src_file, cflags, function_name)
+        for entry in self._keys():
+            if entry != key:
+                self.evict(entry)
+        loaded = self.load(src_file, cflags, function_name, prog_type)
+        loaded.bpf.cleanup()
+        return key, loaded
+
+    def evict(self, key):
+        shutil.rmtree(os.path.join(self.pin_root, key), ignore_errors=True)
+        try:
+            os.remove(self._manifest_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _load_cold(self, key, src_file, cflags, function_name, prog_type):
+        bpf = BPF(src_file=src_file, cflags=cflags)
+        fn = bpf.load_func(function_name, prog_type)
+        try:
+            manifest = self._pin(key, bpf, fn)
+            manifest["function"] = function_name
+            self._write_manifest(key, manifest)
+        except OSError as e:
+            logging.warning(f"Could not cache BPF program {key}: {e}")
+            self.evict(key)
+        return bpf, fn
+
+    def _load_warm(self, key, manifest, src_file, cflags, function_name):
+        pin_dir = os.path.join(self.pin_root, key)
+        prog_fd = self._obj_get(os.path.join(pin_dir, "prog"))
+        bpf = BPF(src_file=src_file, cflags=[*cflags, MAPS_ONLY_FLAG])
+        for name, max_entries in manifest["maps"].items():
+            table = bpf.get_table(name)
+            table.map_fd = self._obj_get(os.path.join(pin_dir, f"map_{name}"))
+            table.max_entries = max_entries
+            # bpf[name] returns this table from now on
+            bpf.tables[name] = table
+        return bpf, CachedFunction(bpf, function_name, prog_fd)
+
+    def _pin(self, key, bpf, fn):
+        pin_dir = os.path.join(self.pin_root, key)
+        os.makedirs(pin_dir, exist_ok=True)
+        self._obj_pin(fn.fd, os.path.join(pin_dir, "prog"))
+        maps = {}
+        for i in range(lib.bpf_num_tables(bpf.module)):
+            name = lib.bpf_table_name(bpf.module, i).decode()
+            table = bpf[name]
+            self._obj_pin(table.map_fd, os.path.join(pin_dir, f"map_{name}"))
+            maps[name] = table.max_entries
+        return {"maps": maps, "created": time.time()}
+
+    @staticmethod
+    def _obj_pin(fd, path):
+        if lib.bpf_obj_pin(fd, path.encode()) != 0:
+            raise OSError(f"bpf_obj_pin({path}) failed")
+
+    @staticmethod
+    def _obj_get(path):
+        fd = lib.bpf_obj_get(path.encode())
+        if fd < 0:
+            raise OSError(f"bpf_obj_get({path}) failed")
+        return fd
+
+    def _keys(self):
+        try:
+            return [name[:-5] for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+        except FileNotFoundError:
+            return []
+
+    def _manifest_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_manifest(self, key):
+        if not os.path.isdir(os.path.join(self.pin_root, key)):
+            return None
+        try:
+            with open(self._manifest_path(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_manifest(self, key, manifest):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._manifest_path(key), "w") as f:
+            json.dump(manifest, f)
+
+
+def load_program(settings, src_file, cflags, function_name, prog_type=BPF.XDP):
+    """
+    Load a BPF program through the build cache unless `bpf_cache` is off in
+    the config, logging how long startup took.
+    """
+    if settings.get("bpf_cache", True):
+        cache = BPFBuildCache(settings.get("bpf_cache_dir", DEFAULT_CACHE_DIR))
+        loaded = cache.load(src_file, cflags, function_name, prog_type)
+    else:
+        start = time.monotonic()
+        bpf = BPF(src_file=src_file, cflags=cflags)
+        fn = bpf.load_func(function_name, prog_type)
+        loaded = LoadedProgram(bpf, fn, False, time.monotonic() - start)
+    logging.info(f"BPF program {function_name} ready in {loaded.seconds:.2f}s "
+                 f"({'warm' if loaded.warm else 'cold'} start)")
+    return loaded
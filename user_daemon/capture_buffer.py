@@ -0,0 +1,117 @@
+import threading
+
+from decoder import PACKET_FIELDS
+
+
+class CapturedPacket:
+    """
+    A captured packet plus the sequence number assigned when it entered the
+    capture ring. Uses __slots__ so a full ring costs far less than dicts.
+    """
+
+    __slots__ = ("seq",) + PACKET_FIELDS
+
+    def __init__(self, seq, *values):
+        self.seq = seq
+        for name, value in zip(PACKET_FIELDS, values):
+            setattr(self, name, value)
+
+    def to_dict(self):
+        record = {name: getattr(self, name) for name in PACKET_FIELDS}
+        record["seq"] = self.seq
+        return record
+
+
+class CaptureRing:
+    """
+    Fixed-capacity ring of captured packets.
+
+    Every packet gets a monotonically increasing sequence number. The shipper
+    takes everything after the last submitted sequence number and acks it
+    once the dashboard has stored it; a failed upload rewinds the submit
+    cursor to the ack cursor so the packets are sent again, and bumps
+    `generation` so batches taken before the rewind can be told apart. When
+    producers outrun the shipper the oldest unacknowledged packets are
+    overwritten and counted in overflow_count.
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self.next_seq = 1
+        self.acked_seq = 0
+        self.submitted_seq = 0
+        self.generation = 0
+        self.overflow_count = 0
+        self._cursor_lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Number of packets waiting to be shipped.
+        """
+        return self.next_seq - max(self.acked_seq + 1, self.oldest_seq)
+
+    @property
+    def oldest_seq(self):
+        """
+        Sequence number of the oldest packet still held in the ring.
+        """
+        return max(1, self.next_seq - self.capacity)
+
+    def append(self, row):
+        seq = self.next_seq
+        index = seq % self.capacity
+        evicted = self._slots[index]
+        if evicted is not None and evicted.seq > self.acked_seq:
+            self.overflow_count += 1
+        self._slots[index] = CapturedPacket(seq, *row)
+        self.next_seq = seq + 1
+        return seq
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def latest(self):
+        if self.next_seq == 1:
+            return None
+        return self._slots[(self.next_seq - 1) % self.capacity]
+
+    def pending(self, limit=None):
+        """
+        Return the unacknowledged packets in sequence order, at most `limit`.
+        """
+        start = max(self.acked_seq + 1, self.oldest_seq)
+        end = self.next_seq
+        if limit is not None:
+            end = min(end, start + limit)
+        return [self._slots[seq % self.capacity] for seq in range(start, end)]
+
+    def take(self, limit=None):
+        """
+        Return the current generation and the packets not yet handed to the
+        shipper, at most `limit`, and advance the submit cursor past them.
+        """
+        with self._cursor_lock:
+            start = max(self.submitted_seq + 1, self.acked_seq + 1, self.oldest_seq)
+            end = self.next_seq
+            if limit is not None:
+                end = min(end, start + limit)
+            self.submitted_seq = max(self.submitted_seq, end - 1)
+            return self.generation, [self._slots[seq % self.capacity] for seq in range(start, end)]
+
+    def rewind(self):
+        """
+        Hand every unacknowledged packet to the shipper again. Returns the new
+        generation.
+        """
+        with self._cursor_lock:
+            self.submitted_seq = self.acked_seq
+            self.generation += 1
+            return self.generation
+
+    def ack(self, seq):
+        """
+        Mark every packet up to and including `seq` as shipped.
+        """
+        self.acked_seq = max(self.acked_seq, seq)
@@ -0,0 +1,96 @@
+from decoder import COOKIE_HEADER_SIZE, COOKIE_PAIR_DTYPE, COOKIE_VALUE_PREFIX, MAX_COOKIES
+
+FNV_OFFSET = 0x811C9DC5
+FNV_PRIME = 0x01000193
+
+# Payload bytes searched for the Cookie header, COOKIE_SCAN_LEN in http_filter.c
+COOKIE_SCAN_LEN = 1024
+
+# First four payload bytes of a request -> method code, as http_method in http_filter.c
+REQUEST_METHODS = {b"GET ": 1, b"POST": 2, b"PUT ": 3, b"HEAD": 4, b"DELE": 5, b"PATC": 6, b"OPTI": 7}
+_HEADER = b"cookie:"
+_SCAN_LINE, _SCAN_NAME, _SCAN_VALUE = range(3)
+
+
+def fnv1a32(data, value=FNV_OFFSET):
+    for byte in data:
+        value = ((value ^ byte) * FNV_PRIME) & 0xFFFFFFFF
+    return value
+
+
+def extract_cookies(payload, scan_len=COOKIE_SCAN_LEN):
+    """
+    Userspace port of extract_cookies in http_filter.c, used for replayed
+    and synthetic traffic. Returns (method, [(name_hash, value_hash,
+    value_len, value_prefix), ...]), with method 0 when the payload is not
+    an HTTP request.
+
+    Walks the payload with the kernel's state machine, quirks included, so
+    both produce the same records: the header name is matched with `| 0x20`
+    case folding, names skip leading spaces, and a value cut off by the end
+    of the packet or the scan window is dropped.
+    """
+    method = REQUEST_METHODS.get(bytes(payload[:4]), 0)
+    if not method:
+        return 0, []
+
+    cookies = []
+    state = _SCAN_LINE
+    match = 7
+    line_len = 1
+    name = bytearray()
+    value = bytearray()
+    for c in payload[:scan_len]:
+        if state == _SCAN_LINE:
+            if c == 0x0A:
+                if line_len == 0:
+                    break
+                line_len = 0
+                match = 0
+            elif c != 0x0D:
+                if match < 7 and c | 0x20 == _HEADER[match]:
+                    match += 1
+                    if match == 7:
+                        state = _SCAN_NAME
+                        name.clear()
+                else:
+                    match = 8
+                line_len += 1
+        elif state == _SCAN_NAME:
+            if c in (0x0D, 0x0A):
+                break
+            if c == 0x3D:  # '='
+                state = _SCAN_VALUE
+                value.clear()
+            elif c == 0x3B:  # ';'
+                name.clear()
+            elif c != 0x20 or name:
+                name.append(c)
+        else:
+            if c in (0x3B, 0x0D, 0x0A):
+                cookies.append((fnv1a32(name), fnv1a32(value), min(len(value), 0xFFFF),
+                                bytes(value[:COOKIE_VALUE_PREFIX])))
+                if c != 0x3B or len(cookies) == MAX_COOKIES:
+                    break
+                state = _SCAN_NAME
+                name.clear()
+            else:
+                value.append(c)
+    return method, cookies
+
+
+def cookie_record(record, packet, method, cookies):
+    """
+    Fill a COOKIE_INFO_DTYPE scalar from a PACKET_INFO_DTYPE scalar and the
+    output of extract_cookies, and return its wire form.
+    """
+    for field in ("src_ip", "dst_ip", "src_port", "dst_port", "seq_num"):
+        record[field] = packet[field]
+    record["method"] = method
+    record["cookie_count"] = len(cookies)
+    for pair, (name_hash, value_hash, value_len, prefix) in zip(record["cookies"], cookies):
+        pair["name_hash"] = name_hash
+        pair["value_hash"] = value_hash
+        pair["value_len"] = value_len
+        pair["value"] = prefix
+    return record.tobytes()[:COOKIE_HEADER_SIZE + len(cookies) * COOKIE_PAIR_DTYPE.itemsize]
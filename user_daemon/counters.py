@@ -0,0 +1,98 @@
+import numpy as np
+
+# Slots of the XDP program's per-CPU stats array, in STAT_* order
+KERNEL_STATS = (
+    "packets",
+    "counted",
+    "skipped_acks",
+    "filtered",
+    "sampled_out",
+    "packet_events",
+    "cookie_events",
+    "truncated",
+    "submit_failures",
+    "lookup_failures",
+)
+
+_EMPTY_KEYS = np.zeros(0, dtype=np.uint32)
+_EMPTY_COUNTS = np.zeros(0, dtype=np.uint64)
+
+
+def read_bpf_counts(table):
+    """
+    Read a per-source counter map into (keys, counts) arrays, with keys
+    sorted. Per-CPU values are summed. Uses batch lookups where the kernel
+    and BCC support them, one syscall per chunk instead of one per key.
+    """
+    try:
+        items = list(table.items_lookup_batch())
+    except Exception:
+        items = list(table.items())
+    if not items:
+        return _EMPTY_KEYS, _EMPTY_COUNTS
+
+    keys = np.fromiter((key.value for key, _ in items), dtype=np.uint32, count=len(items))
+    values = np.frombuffer(b"".join(bytes(value) for _, value in items), dtype=np.uint64)
+    counts = values.reshape(len(items), -1).sum(axis=1, dtype=np.uint64)
+    order = np.argsort(keys)
+    return keys[order], counts[order]
+
+
+def read_bpf_stats(table):
+    """
+    Read the per-CPU stats array into a dict keyed by KERNEL_STATS names,
+    with the CPUs summed.
+    """
+    return {name: table.sum(table.Key(index)).value for index, name in enumerate(KERNEL_STATS)}
+
+
+def read_counter_dict(counter):
+    """
+    Same as read_bpf_counts for the dict of counts kept by replay sources.
+    """
+    if not counter:
+        return _EMPTY_KEYS, _EMPTY_COUNTS
+    keys = np.fromiter(counter.keys(), dtype=np.uint32, count=len(counter))
+    counts = np.fromiter(counter.values(), dtype=np.uint64, count=len(counter))
+    order = np.argsort(keys)
+    return keys[order], counts[order]
+
+
+class CounterDeltas:
+    """
+    Turns successive snapshots of a per-source counter map into per-source
+    deltas, keyed by integer IP and computed with sorted-array joins rather
+    than a dict lookup per key.
+
+    The kernel map is LRU, so a source can be evicted and re-inserted with a
+    smaller count; its whole current count is then treated as new.
+    """
+
+    def __init__(self):
+        self.keys = _EMPTY_KEYS
+        self.counts = _EMPTY_COUNTS
+        self.total = 0
+
+    def update(self, keys, counts):
+        """
+        Take a new sorted snapshot and return (keys, deltas) for the sources
+        whose count increased since the previous one.
+        """
+        previous = np.zeros(len(keys), dtype=np.uint64)
+        if len(self.keys):
+            index = np.searchsorted(self.keys, keys)
+            clipped = np.minimum(index, len(self.keys) - 1)
+            known = (index < len(self.keys)) & (self.keys[clipped] == keys)
+            previous[known] = self.counts[clipped[known]]
+
+        reset = counts < previous
+        deltas = np.where(reset, counts, counts - previous)
+        changed = deltas > 0
+
+        self.keys = keys
+        self.counts = counts
+        self.total += int(deltas.sum())
+        return keys[changed], deltas[changed]
+
+    def __len__(self):
+        return len(self.keys)
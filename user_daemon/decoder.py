@@ -0,0 +1,297 @@
+import ctypes
+
+import numpy as np
+
+MAX_HTTP_DATA = 2048
+
+# Mirrors struct packet_info in ebpf_module/http_filter.c. align=True applies
+# the same natural alignment the C compiler uses, so a raw record can be
+# copied straight into a row of this dtype.
+PACKET_INFO_DTYPE = np.dtype([
+    ("src_ip", np.uint32),
+    ("dst_ip", np.uint32),
+    ("src_port", np.uint16),
+    ("dst_port", np.uint16),
+    ("protocol", np.uint8),
+    ("packet_type", np.uint8),
+    ("packet_len", np.uint32),
+    ("seq_num", np.uint32),
+    ("ack_num", np.uint32),
+    ("tcp_flags", np.uint8),
+    ("http_data_len", np.uint32),
+    ("http_data", f"S{MAX_HTTP_DATA}"),
+], align=True)
+
+# Events carry the fixed fields followed by only http_data_len payload bytes,
+# so records are between RECORD_HEADER_SIZE and PACKET_INFO_DTYPE.itemsize
+# bytes long.
+RECORD_HEADER_SIZE = PACKET_INFO_DTYPE.fields["http_data"][1]
+
+# Mirror struct cookie_pair and struct cookie_info, sent on cookie_events
+# when the XDP program is built with EXTRACT_COOKIES. Records are cut after
+# cookie_count pairs.
+MAX_COOKIES = 16
+COOKIE_VALUE_PREFIX = 16
+
+COOKIE_PAIR_DTYPE = np.dtype([
+    ("name_hash", np.uint32),
+    ("value_hash", np.uint32),
+    ("value_len", np.uint16),
+    ("value", f"S{COOKIE_VALUE_PREFIX}"),
+], align=True)
+
+COOKIE_INFO_DTYPE = np.dtype([
+    ("src_ip", np.uint32),
+    ("dst_ip", np.uint32),
+    ("src_port", np.uint16),
+    ("dst_port", np.uint16),
+    ("seq_num", np.uint32),
+    ("method", np.uint8),
+    ("cookie_count", np.uint8),
+    ("cookies", COOKIE_PAIR_DTYPE, (MAX_COOKIES,)),
+], align=True)
+
+COOKIE_HEADER_SIZE = COOKIE_INFO_DTYPE.fields["cookies"][1]
+
+METHOD_NAMES = np.array(["", "GET", "POST", "PUT", "HEAD", "DELETE", "PATCH", "OPTIONS"])
+
+PROTOCOL_NAMES = {0: "TCP", 1: "UDP", 2: "ICMP"}
+_PROTOCOL_LOOKUP = np.array(["TCP", "UDP", "ICMP", "Unknown"])
+
+# Bit layout of packet_info.tcp_flags as built by count_tcp_packets.
+# "unsampled" is not a TCP flag: the FLOW_EVENTS build sets it on the SYN,
+# FIN and RST events it sends past payload sampling.
+TCP_FLAG_BITS = {
+    "fin": 0x01,
+    "syn": 0x02,
+    "rst": 0x04,
+    "psh": 0x08,
+    "ack": 0x10,
+    "urg": 0x20,
+    "unsampled": 0x80,
+}
+
+# Keys of the per-cookie records shipped to the dashboard
+COOKIE_FIELDS = (
+    "src_ip",
+    "src_port",
+    "dst_ip",
+    "dst_port",
+    "method",
+    "name_hash",
+    "value_hash",
+    "value",
+    "value_len",
+)
+
+# Keys of the per-packet records shipped to the dashboard
+PACKET_FIELDS = (
+    "protocol",
+    "src_ip",
+    "src_port",
+    "dst_ip",
+    "dst_port",
+    "packet_len",
+    "seq_num",
+    "ack_num",
+    "packet_type",
+    "tcp_flags",
+    "http_data",
+    "http_data_len",
+    "http_data_ref",
+)
+
+_OCTETS = np.array([str(i) for i in range(256)])
+
+
+def ip_to_str(ips):
+    """
+    Convert an array of IPv4 addresses (network byte order, as read from the
+    kernel) to dotted-quad strings.
+    """
+    octets = np.ascontiguousarray(ips, dtype=np.uint32).view(np.uint8).reshape(-1, 4)
+    dotted = _OCTETS[octets[:, 0]]
+    for i in range(1, 4):
+        dotted = np.char.add(np.char.add(dotted, "."), _OCTETS[octets[:, i]])
+    return dotted
+
+
+def ip_to_int(ips):
+    """
+    Convert an array of IPv4 addresses in network byte order to host-order
+    integers, so that 10.0.0.1 < 10.0.0.2 compares as expected.
+    """
+    ips = np.asarray(ips, dtype=np.uint32)
+    return ips.byteswap() if np.little_endian else ips.copy()
+
+
+def payload_bytes(raw):
+    """
+    The captured payload of every record in `raw`, cut to http_data_len.
+    Sliced from the raw bytes: converting the fixed-width field to bytes
+    objects would strip trailing NULs.
+    """
+    width = raw.dtype["http_data"].itemsize
+    lengths = np.minimum(raw["http_data_len"], min(width, MAX_HTTP_DATA)).tolist()
+    data = raw["http_data"].view((np.uint8, width))
+    return [data[i, :length].tobytes() for i, length in enumerate(lengths)]
+
+
+def protocol_names(packet_types):
+    return _PROTOCOL_LOOKUP[np.minimum(packet_types, len(_PROTOCOL_LOOKUP) - 1)]
+
+
+class PacketBatch:
+    """
+    A decoded batch of packet events. Scalar fields are NumPy columns; the
+    string columns (IPs, protocol names) are converted for the whole batch
+    at once.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.src_ip = ip_to_str(raw["src_ip"])
+        self.dst_ip = ip_to_str(raw["dst_ip"])
+        self.protocol = protocol_names(raw["packet_type"])
+        self.flags = {name: (raw["tcp_flags"] & bit) != 0
+                      for name, bit in TCP_FLAG_BITS.items()}
+
+    def __len__(self):
+        return len(self.raw)
+
+    def payloads(self):
+        """
+        Captured HTTP payload bytes for every event in the batch.
+        """
+        return payload_bytes(self.raw)
+
+    def rows(self, intern=None):
+        """
+        Yield one tuple per packet, with values in PACKET_FIELDS order. With
+        an InternTable, repeated payloads share one string and carry its
+        digest in http_data_ref; otherwise http_data_ref is None.
+        """
+        raw = self.raw
+        if intern is not None:
+            refs, payloads = intern.intern_all(self.payloads())
+        else:
+            payloads = [data.decode("utf-8", "ignore") for data in self.payloads()]
+            refs = [None] * len(payloads)
+        return zip(
+            self.protocol.tolist(),
+            self.src_ip.tolist(),
+            raw["src_port"].tolist(),
+            self.dst_ip.tolist(),
+            raw["dst_port"].tolist(),
+            raw["packet_len"].tolist(),
+            raw["seq_num"].tolist(),
+            raw["ack_num"].tolist(),
+            raw["packet_type"].tolist(),
+            raw["tcp_flags"].tolist(),
+            payloads,
+            np.minimum(raw["http_data_len"], MAX_HTTP_DATA).tolist(),
+            refs,
+        )
+
+    def records(self):
+        """
+        Build the per-packet dicts shipped to the dashboard.
+        """
+        return [dict(zip(PACKET_FIELDS, row)) for row in self.rows()]
+
+
+class CookieBatch:
+    """
+    A decoded batch of cookie records, flattened to one row per cookie.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        counts = np.minimum(raw["cookie_count"], MAX_COOKIES)
+        self.record_index = np.repeat(np.arange(len(raw)), counts)
+        self.pairs = raw["cookies"][np.arange(MAX_COOKIES) < counts[:, None]]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def rows(self, intern=None):
+        """
+        Yield one tuple per cookie, with values in COOKIE_FIELDS order. With
+        an InternTable, repeated values share one string.
+        """
+        raw = self.raw[self.record_index]
+        pairs = self.pairs
+        lengths = np.minimum(pairs["value_len"], COOKIE_VALUE_PREFIX).tolist()
+        values = [value[:length] for value, length in zip(pairs["value"].tolist(), lengths)]
+        if intern is not None:
+            values = intern.intern_all(values)[1]
+        else:
+            values = [value.decode("utf-8", "ignore") for value in values]
+        return zip(
+            ip_to_str(raw["src_ip"]).tolist(),
+            raw["src_port"].tolist(),
+            ip_to_str(raw["dst_ip"]).tolist(),
+            raw["dst_port"].tolist(),
+            METHOD_NAMES[np.minimum(raw["method"], len(METHOD_NAMES) - 1)].tolist(),
+            pairs["name_hash"].tolist(),
+            pairs["value_hash"].tolist(),
+            values,
+            pairs["value_len"].tolist(),
+        )
+
+
+class PacketBatchDecoder:
+    """
+    Copies raw packet_info records into a preallocated structured array and
+    decodes them a batch at a time.
+
+    Records are variable length. Bytes of a slot past the end of a short
+    record are left over from earlier records, which is harmless because
+    payloads are always cut to http_data_len.
+    """
+
+    dtype = PACKET_INFO_DTYPE
+    batch_type = PacketBatch
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=self.dtype)
+        self._address = self.buffer.ctypes.data
+        self.count = 0
+        self.received_records = 0
+        self.received_bytes = 0
+
+    def append(self, data, size):
+        """
+        Copy one raw record into the buffer. Returns True once the buffer is
+        full and must be decoded before the next append.
+        """
+        size = min(size, self.dtype.itemsize)
+        ctypes.memmove(self._address + self.count * self.dtype.itemsize, data, size)
+        self.count += 1
+        self.received_records += 1
+        self.received_bytes += size
+        return self.count >= self.capacity
+
+    def bytes_per_record(self):
+        """
+        Average transport bytes per record received so far.
+        """
+        return self.received_bytes / self.received_records if self.received_records else 0.0
+
+    def decode(self):
+        """
+        Decode every buffered record and reset the buffer.
+        """
+        batch = self.batch_type(self.buffer[:self.count].copy())
+        self.count = 0
+        return batch
+
+
+class CookieBatchDecoder(PacketBatchDecoder):
+    """
+    The same for cookie_info records.
+    """
+
+    dtype = COOKIE_INFO_DTYPE
+    batch_type = CookieBatch
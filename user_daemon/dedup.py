@@ -0,0 +1,135 @@
+import hashlib
+from collections import OrderedDict
+
+# Bytes of the BLAKE2b digest that names a body; references are its hex form
+DIGEST_SIZE = 16
+
+
+def content_digest(text):
+    """
+    Reference of a body: the hex BLAKE2b digest of its UTF-8 encoding, which
+    the dashboard recomputes to check the bodies it is sent.
+    """
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=DIGEST_SIZE).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("digest", "text", "shipped", "keys")
+
+    def __init__(self, digest, text):
+        self.digest = digest
+        self.text = text
+        self.shipped = False  # The dashboard has stored the body
+        self.keys = 0  # Captured byte strings that decode to this text
+
+
+class InternTable:
+    """
+    Bounded, content-addressed table of the HTTP payloads and cookie values
+    the daemon holds and ships.
+
+    intern() maps captured bytes to one shared decoded string and its
+    digest, so the copies of a payload waiting in the capture ring share a
+    single body, and the exporter can send the digest instead of the body
+    once the dashboard has stored it. Entries are looked up by their raw
+    bytes, so a repeated body is neither decoded nor hashed again.
+
+    Memory is bounded by `max_entries` and `max_bytes` of captured bytes,
+    beyond which the least recently used entries are evicted. An evicted
+    body is simply decoded, hashed and shipped again the next time it is
+    seen; packets still holding it keep their copy.
+    """
+
+    def __init__(self, max_entries=65536, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Captured bytes -> _Entry, least recently used first
+        self.by_digest = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_deduplicated = 0  # Captured bytes served from the table
+
+    def __len__(self):
+        return len(self.entries)
+
+    def intern(self, data):
+        """
+        Return the digest and shared decoded text of `data`. Empty data has
+        no digest.
+        """
+        if not data:
+            return None, ""
+        entry = self.entries.get(data)
+        if entry is not None:
+            self.entries.move_to_end(data)
+            self.hits += 1
+            self.bytes_deduplicated += len(data)
+            return entry.digest, entry.text
+        text = data.decode("utf-8", "ignore")
+        digest = content_digest(text)
+        entry = self.by_digest.get(digest)
+        if entry is None:
+            entry = _Entry(digest, text)
+            self.by_digest[digest] = entry
+        entry.keys += 1
+        self.entries[data] = entry
+        self.bytes += len(data)
+        self.misses += 1
+        if self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+            self._evict()
+        return entry.digest, entry.text
+
+    def intern_all(self, payloads):
+        """
+        Intern a list of captured byte strings. Returns their digests and
+        texts as two lists.
+        """
+        digests, texts = [], []
+        for data in payloads:
+            digest, text = self.intern(data)
+            digests.append(digest)
+            texts.append(text)
+        return digests, texts
+
+    def unshipped(self, digests):
+        """
+        The digests, out of `digests`, whose bodies the dashboard may not
+        have stored yet.
+        """
+        by_digest = self.by_digest
+        return {digest for digest in digests
+                if digest is not None and not getattr(by_digest.get(digest), "shipped", False)}
+
+    def mark_shipped(self, digests, shipped=True):
+        """
+        Record that the dashboard stored, or with shipped=False no longer
+        has, the bodies of `digests`.
+        """
+        for digest in digests:
+            entry = self.by_digest.get(digest)
+            if entry is not None:
+                entry.shipped = shipped
+
+    def counters(self):
+        """
+        Cumulative counters and current table size, for metrics.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes_deduplicated": self.bytes_deduplicated,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+    def _evict(self):
+        while self.entries and (self.bytes > self.max_bytes or len(self.entries) > self.max_entries):
+            data, entry = self.entries.popitem(last=False)
+            self.bytes -= len(data)
+            self.evictions += 1
+            entry.keys -= 1
+            if not entry.keys:
+                del self.by_digest[entry.digest]
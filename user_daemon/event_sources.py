@@ -0,0 +1,474 @@
+import abc
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from cookies import cookie_record, extract_cookies
+from decoder import COOKIE_INFO_DTYPE, MAX_HTTP_DATA, PACKET_INFO_DTYPE, RECORD_HEADER_SIZE, TCP_FLAG_BITS
+
+ETH_P_IP = 0x0800
+IPPROTO_TCP = 6
+LINKTYPE_ETHERNET = 1
+
+# TCP header flag bits and the packet_info.tcp_flags bits they map to
+_TCP_FLAG_MAP = ((0x01, 0x01), (0x02, 0x02), (0x04, 0x04),
+                 (0x08, 0x08), (0x10, 0x10), (0x20, 0x20))
+
+
+class EventSource(abc.ABC):
+    """
+    Delivers raw struct packet_info records, cut after the captured payload
+    bytes, to a callback with the perf-buffer signature
+    callback(cpu, data, size).
+
+    Sources that do not read the kernel's packet_count map also track the
+    per-source counts the XDP program would have kept, keyed by the source
+    IP as stored in the record (network byte order).
+
+    With a cookie_callback, struct cookie_info records from the
+    EXTRACT_COOKIES build are delivered to it the same way.
+
+    Only one in `sample_rate` events is delivered; packet_counts stay exact.
+
+    lost_events counts events the kernel dropped because a buffer was full,
+    by CPU (-1 when the source cannot tell which). It is updated from the
+    polling thread; other threads read it through lost_counts().
+    """
+
+    live = False
+
+    def __init__(self):
+        self.callback = None
+        self.cookie_callback = None
+        self.packet_counts = Counter()
+        self.sample_rate = 1
+        self._sample_skip = 0
+        self.lost_events = Counter()
+        self._lost_lock = threading.Lock()
+
+    def open(self, callback, cookie_callback=None):
+        self.callback = callback
+        self.cookie_callback = cookie_callback
+
+    def count_lost(self, cpu, count):
+        with self._lost_lock:
+            self.lost_events[cpu] += count
+
+    def lost_counts(self):
+        """
+        A snapshot of lost_events, safe to take from any thread.
+        """
+        with self._lost_lock:
+            return dict(self.lost_events)
+
+    @abc.abstractmethod
+    def poll(self, timeout_ms):
+        """
+        Deliver pending events, waiting at most timeout_ms for the first one.
+        Returns the number of events delivered.
+        """
+
+    def set_sample_rate(self, rate):
+        self.sample_rate = max(1, int(rate))
+
+    def _sampled(self):
+        """
+        Same countdown as the XDP program: True for one event in sample_rate.
+        """
+        if self.sample_rate <= 1:
+            return True
+        if self._sample_skip > 0:
+            self._sample_skip -= 1
+            return False
+        self._sample_skip = self.sample_rate - 1
+        return True
+
+    def close(self):
+        pass
+
+
+def write_sample_rate(bpf, rate):
+    table = bpf["sample_control"]
+    table[table.Key(0)] = table.Leaf(rate)
+
+
+class PerfBufferSource(EventSource):
+    """
+    Live events from the XDP program's packet_events perf buffer, read from
+    every online CPU's buffer or only from those in `cpus`.
+    """
+
+    live = True
+
+    def __init__(self, bpf, table="packet_events", page_cnt=64, cpus=None):
+        super().__init__()
+        self.bpf = bpf
+        self.table = table
+        self.page_cnt = page_cnt
+        self.cpus = cpus
+
+    def open(self, callback, cookie_callback=None):
+        super().open(callback, cookie_callback)
+        self._open_buffer(self.bpf[self.table], callback)
+        if cookie_callback:
+            self._open_buffer(self.bpf["cookie_events"], cookie_callback)
+
+    def _lost_callback(self, cpu):
+        def lost(count):
+            self.count_lost(cpu, count)
+        return lost
+
+    def _open_buffer(self, table, callback):
+        # open_perf_buffer's lost callback is not told the CPU, so open the
+        # per-CPU buffers one by one where BCC allows it
+        from bcc.utils import get_online_cpus
+        open_cpu = getattr(table, "_open_perf_buffer", None)
+        if open_cpu is not None:
+            try:
+                for cpu in self.cpus if self.cpus is not None else get_online_cpus():
+                    open_cpu(cpu, callback, self.page_cnt, self._lost_callback(cpu), 1)
+                return
+            except TypeError:
+                pass  # Older BCC signature, fails before opening anything
+        if self.cpus is not None:
+            raise RuntimeError("This BCC version cannot open perf buffers for a subset of CPUs")
+        table.open_perf_buffer(callback, page_cnt=self.page_cnt, lost_cb=self._lost_callback(-1))
+
+    def poll(self, timeout_ms):
+        self.bpf.perf_buffer_poll(timeout=timeout_ms)
+        return None
+
+    def set_sample_rate(self, rate):
+        super().set_sample_rate(rate)
+        write_sample_rate(self.bpf, self.sample_rate)
+
+
+class RingBufferSource(EventSource):
+    """
+    Live events from the XDP program built with USE_RINGBUF, where
+    packet_events is a single BPF ring buffer shared by all CPUs.
+    """
+
+    live = True
+
+    def __init__(self, bpf, table="packet_events"):
+        super().__init__()
+        self.bpf = bpf
+        self.table = table
+
+    def open(self, callback, cookie_callback=None):
+        super().open(callback, cookie_callback)
+        # Ring buffer callbacks get (ctx, data, size); ctx stands in for cpu
+        self.bpf[self.table].open_ring_buffer(callback)
+        if cookie_callback:
+            self.bpf["cookie_events"].open_ring_buffer(cookie_callback)
+
+    def poll(self, timeout_ms):
+        self.bpf.ring_buffer_poll(timeout=timeout_ms)
+        return None
+
+    def set_sample_rate(self, rate):
+        super().set_sample_rate(rate)
+        write_sample_rate(self.bpf, self.sample_rate)
+
+
+def record_bytes(record):
+    """
+    The wire form of a PACKET_INFO_DTYPE scalar: the header and only the
+    captured payload bytes, as the XDP program submits it.
+    """
+    return record.tobytes()[:RECORD_HEADER_SIZE + int(record["http_data_len"])]
+
+
+def split_cookies(record, cookie):
+    """
+    What the EXTRACT_COOKIES build submits for the packet in `record`: its
+    header without payload, and the cookie record if the payload is an HTTP
+    request carrying cookies (else None). `cookie` is a COOKIE_INFO_DTYPE
+    scalar used as scratch space.
+    """
+    payload = record.tobytes()[RECORD_HEADER_SIZE:RECORD_HEADER_SIZE + int(record["http_data_len"])]
+    method, cookies = extract_cookies(payload)
+    record["http_data_len"] = 0
+    cookie_data = cookie_record(cookie, record, method, cookies) if cookies else None
+    return record_bytes(record), cookie_data
+
+
+def frame_to_record(frame, record):
+    """
+    Fill `record` (a PACKET_INFO_DTYPE scalar) from an Ethernet frame the way
+    count_tcp_packets does. Returns "counted" for TCP packets the kernel would
+    only count, "event" for those it would also submit, or None.
+    """
+    if len(frame) < 14 + 20 or struct.unpack_from("!H", frame, 12)[0] != ETH_P_IP:
+        return None
+    ip = 14
+    ihl = (frame[ip] & 0x0F) * 4
+    if frame[ip + 9] != IPPROTO_TCP or len(frame) < ip + ihl + 20:
+        return None
+    tcp = ip + ihl
+    doff = (frame[tcp + 12] >> 4) * 4
+    flags = frame[tcp + 13]
+    payload = frame[tcp + doff:]
+
+    # Pure ACKs without payload are skipped before counting
+    if flags & 0x3F == 0x10 and not payload:
+        return None
+
+    record["src_ip"] = int.from_bytes(frame[ip + 12:ip + 16], sys.byteorder)
+    record["dst_ip"] = int.from_bytes(frame[ip + 16:ip + 20], sys.byteorder)
+    record["src_port"], record["dst_port"], record["seq_num"], record["ack_num"] = \
+        struct.unpack_from("!HHII", frame, tcp)
+    record["protocol"] = IPPROTO_TCP
+    record["packet_type"] = 0
+    record["packet_len"] = len(frame)
+    record["tcp_flags"] = sum(bit for tcp_bit, bit in _TCP_FLAG_MAP if flags & tcp_bit)
+    if not payload:
+        return "counted"
+    payload = payload[:MAX_HTTP_DATA]
+    record["http_data"] = payload
+    record["http_data_len"] = len(payload)
+    return "event"
+
+
+def read_pcap(path):
+    """
+    Yield the frames of a classic libpcap file with Ethernet link type.
+    """
+    with open(path, "rb") as f:
+        header = f.read(24)
+        if len(header) < 24:
+            raise ValueError(f"{path} is not a pcap file")
+        magic = header[:4]
+        if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1"):
+            endian = "<"
+        elif magic in (b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+            endian = ">"
+        else:
+            raise ValueError(f"{path} is not a pcap file (pcapng is not supported)")
+        linktype = struct.unpack(endian + "I", header[20:24])[0]
+        if linktype != LINKTYPE_ETHERNET:
+            raise ValueError(f"{path} has link type {linktype}, only Ethernet is supported")
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                return
+            incl_len = struct.unpack(endian + "IIII", record)[2]
+            yield f.read(incl_len)
+
+
+class PcapReplaySource(EventSource):
+    """
+    Replays a pcap file as packet_info records, optionally looping and
+    throttled to `rate` packets per second. With shard=(index, count) only
+    every count-th packet from index on is replayed.
+    """
+
+    def __init__(self, path, rate=None, loop=False, batch_size=1024, extract_cookies=False, flow_events=False,
+                 shard=None):
+        super().__init__()
+        self.path = path
+        self.loop = loop
+        self.batch_size = batch_size
+        self.packets = self._load(path, extract_cookies, flow_events)
+        if shard:
+            index, count = shard
+            self.packets = self.packets[index::count]
+        self._schedule = _RateSchedule(rate)
+        self._position = 0
+        self.finished = False
+        if not self.packets:
+            logging.warning(f"{path} contains no TCP packets")
+
+    @staticmethod
+    def _load(path, cookies=False, flow_events=False):
+        """
+        Return (src_ip, record bytes, cookie record bytes, sampled) for every
+        packet the XDP program would count; records are None for packets it
+        would not submit. With flow_events, SYN, FIN and RST packets without
+        payload are submitted header only, marked unsampled, and bypass
+        sampling, as in the FLOW_EVENTS build.
+        """
+        record = np.zeros(1, dtype=PACKET_INFO_DTYPE)[0]
+        cookie = np.zeros(1, dtype=COOKIE_INFO_DTYPE)[0]
+        packets = []
+        for frame in read_pcap(path):
+            record["http_data"] = b""
+            record["http_data_len"] = 0
+            kind = frame_to_record(frame, record)
+            if kind is None:
+                continue
+            data = cookie_data = None
+            sampled = True
+            if kind == "event":
+                if cookies:
+                    data, cookie_data = split_cookies(record, cookie)
+                else:
+                    data = record_bytes(record)
+            elif flow_events and record["tcp_flags"] & 0x07:
+                record["tcp_flags"] |= TCP_FLAG_BITS["unsampled"]
+                data = record_bytes(record)
+                sampled = False
+            packets.append((int(record["src_ip"]), data, cookie_data, sampled))
+        return packets
+
+    def poll(self, timeout_ms):
+        if self.finished or not self.packets:
+            time.sleep(timeout_ms / 1000)
+            return 0
+        due = self._schedule.due(self.batch_size, timeout_ms)
+        delivered = 0
+        for _ in range(due):
+            if self._position == len(self.packets):
+                if not self.loop:
+                    self.finished = True
+                    break
+                self._position = 0
+            src_ip, data, cookie_data, sampled = self.packets[self._position]
+            self._position += 1
+            self.packet_counts[src_ip] += 1
+            if data is None or (sampled and not self._sampled()):
+                continue
+            self.callback(0, data, len(data))
+            delivered += 1
+            if cookie_data is not None and self.cookie_callback:
+                self.cookie_callback(0, cookie_data, len(cookie_data))
+        self._schedule.consumed(due)
+        return delivered
+
+
+class SyntheticSource(EventSource):
+    """
+    Generates HTTP request events from `sources` client addresses at `rate`
+    events per second (as fast as possible when rate is None).
+    """
+
+    def __init__(self, rate=None, sources=1024, payload_size=512, batch_size=1024, pool_size=4096, seed=0,
+                 extract_cookies=False):
+        super().__init__()
+        self.batch_size = batch_size
+        self._schedule = _RateSchedule(rate)
+        rng = np.random.default_rng(seed)
+
+        pool = np.zeros(pool_size, dtype=PACKET_INFO_DTYPE)
+        src_ips = np.array([struct.unpack("=I", socket.inet_aton(f"10.{(i >> 16) & 0xFF}.{(i >> 8) & 0xFF}.{i & 0xFF}"))[0]
+                            for i in range(1, sources + 1)], dtype=np.uint32)
+        pool["src_ip"] = src_ips[rng.integers(0, sources, pool_size)]
+        pool["dst_ip"] = struct.unpack("=I", socket.inet_aton("192.168.0.1"))[0]
+        pool["src_port"] = rng.integers(1024, 65535, pool_size)
+        pool["dst_port"] = 80
+        pool["protocol"] = IPPROTO_TCP
+        pool["packet_type"] = 0
+        pool["seq_num"] = rng.integers(0, 2 ** 32, pool_size, dtype=np.uint64)
+        pool["ack_num"] = rng.integers(0, 2 ** 32, pool_size, dtype=np.uint64)
+        pool["tcp_flags"] = 0x18  # PSH|ACK
+
+        for i in range(pool_size):
+            payload = self._payload(i, rng, payload_size)
+            pool[i]["http_data"] = payload
+            pool[i]["http_data_len"] = len(payload)
+            pool[i]["packet_len"] = 14 + 20 + 20 + len(payload)
+
+        if extract_cookies:
+            cookie = np.zeros(1, dtype=COOKIE_INFO_DTYPE)[0]
+            self.records, self.cookie_records = zip(*(split_cookies(pool[i], cookie) for i in range(pool_size)))
+        else:
+            self.records = [record_bytes(pool[i]) for i in range(pool_size)]
+            self.cookie_records = [None] * pool_size
+        self.src_ips = pool["src_ip"].tolist()
+        self._position = 0
+
+    @staticmethod
+    def _payload(i, rng, payload_size):
+        cookies = "; ".join(f"c{j}={rng.integers(0, 1 << 32):08x}" for j in range(rng.integers(1, 8)))
+        head = (f"GET /item/{i} HTTP/1.1\r\nHost: shop{i % 16}.example.com\r\n"
+                f"User-Agent: synthetic\r\nCookie: session={i % 97:04d}; {cookies}\r\n")
+        padding = max(0, payload_size - len(head) - 2)
+        return (head + "X-Pad: " + "x" * max(0, padding - 9) + "\r\n\r\n").encode()[:MAX_HTTP_DATA]
+
+    def poll(self, timeout_ms):
+        due = self._schedule.due(self.batch_size, timeout_ms)
+        records = self.records
+        pool_size = len(records)
+        delivered = 0
+        for _ in range(due):
+            index = self._position % pool_size
+            self._position += 1
+            self.packet_counts[self.src_ips[index]] += 1
+            if not self._sampled():
+                continue
+            data = records[index]
+            self.callback(0, data, len(data))
+            delivered += 1
+            cookie_data = self.cookie_records[index]
+            if cookie_data is not None and self.cookie_callback:
+                self.cookie_callback(0, cookie_data, len(cookie_data))
+        self._schedule.consumed(due)
+        return delivered
+
+
+class _RateSchedule:
+    """
+    Works out how many events are due at a fixed rate, sleeping until the
+    next one when none are.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = None
+        self.emitted = 0
+
+    def due(self, limit, timeout_ms):
+        if not self.rate:
+            return limit
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        due = int((now - self.start) * self.rate) - self.emitted
+        if due <= 0:
+            wait = (self.emitted + 1) / self.rate - (now - self.start)
+            time.sleep(min(wait, timeout_ms / 1000))
+            return 0
+        return min(due, limit)
+
+    def consumed(self, count):
+        self.emitted += count
+
+
+def make_event_source(settings, bpf=None, extract_cookies=False, flow_events=False, shard=None, cpus=None):
+    """
+    Build the event source described by the `event_source` config section.
+    extract_cookies and flow_events make the replay sources emulate the
+    EXTRACT_COOKIES and FLOW_EVENTS builds of the XDP program.
+
+    Worker processes each build a share of the source: the perf buffers of
+    `cpus`, or for shard=(index, count) every count-th replayed packet and
+    a count-th of the synthetic rate.
+    """
+    settings = settings or {}
+    kind = settings.get("type", "perf")
+    if kind == "perf":
+        return PerfBufferSource(bpf, page_cnt=settings.get("page_cnt", 64), cpus=cpus)
+    if kind == "ringbuf":
+        if shard:
+            raise ValueError("The ringbuf event source is one buffer for all CPUs and cannot be split "
+                             "between workers")
+        return RingBufferSource(bpf)
+    if kind == "pcap":
+        rate = settings.get("rate")
+        return PcapReplaySource(settings["path"], rate=rate / shard[1] if rate and shard else rate,
+                                loop=settings.get("loop", False), extract_cookies=extract_cookies,
+                                flow_events=flow_events, shard=shard)
+    if kind == "synthetic":
+        rate = settings.get("rate")
+        return SyntheticSource(rate=rate / shard[1] if rate and shard else rate,
+                               sources=settings.get("sources", 1024),
+                               payload_size=settings.get("payload_size", 512),
+                               seed=shard[0] if shard else 0, extract_cookies=extract_cookies)
+    raise ValueError(f"Unknown event source type: {kind}")
@@ -0,0 +1,292 @@
+import gzip
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from decoder import COOKIE_FIELDS, PACKET_FIELDS
+from flows import FLOW_FIELDS
+from instrumentation import LatencyHistogram
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compress_body(body, compression):
+    """
+    Compress a request body. Returns the body and its Content-Encoding.
+    """
+    if compression == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor().compress(body), "zstd"
+    if compression in ("gzip", "zstd"):
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+
+class DashboardExporter(threading.Thread):
+    """
+    Background thread that ships captured packets to the dashboard.
+
+    The capture loop hands packets over with submit(), which never blocks.
+    The exporter merges submissions into one batch and posts it when either
+    max_batch_packets packets are pending or flush_interval seconds have
+    passed, over a single pooled keep-alive connection with a compressed
+    body. Failed posts are retried with exponential backoff; while the queue
+    is full or a batch is being retried, `backpressure` is set so the
+    capture loop can stop submitting and let packets wait in its ring.
+
+    Submissions carry the capture ring's generation. When a batch finally
+    fails, on_failure rewinds the ring and returns the new generation, and
+    everything still queued from the old generation is discarded because it
+    will be taken from the ring again.
+
+    With columnar=True batches are sent as {"columns": {field: [...]}} for
+    the dashboard's bulk ingest endpoint instead of a list of packet dicts.
+    Cookie rows submitted alongside are sent as {"cookies": {field: [...]}},
+    cookie analytics snapshots as {"sketches": [...]} and flow records as
+    {"flows": {field: [...]}}, on a best-effort basis: they are not in the
+    capture ring, so a batch that finally fails drops them. They need the
+    bulk ingest endpoint.
+
+    With an InternTable (columnar batches only), payloads are sent as their
+    digests in an http_data_ref column, and only the bodies the dashboard
+    has not stored yet go along as {"blobs": {digest: body}}. Bodies are
+    marked as stored once a batch is accepted. The dashboard rejects rows
+    whose digest it has no body for, e.g. after its retention removed it,
+    and reports the digest as missing; those rows are sent again at once
+    with their bodies, before the batch is acknowledged.
+    """
+
+    def __init__(self, url, on_ack=None, on_failure=None, compression="gzip", columnar=False,
+                 max_batch_packets=5000, flush_interval=1.0, queue_size=64,
+                 max_retries=5, retry_backoff=0.5, max_backoff=30.0, timeout=10.0, intern=None):
+        super().__init__(name="dashboard-exporter", daemon=True)
+        self.url = url
+        self.on_ack = on_ack
+        self.on_failure = on_failure
+        self.compression = compression
+        self.columnar = columnar
+        self.intern = intern if columnar else None
+        self.max_batch_packets = max_batch_packets
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.backpressure = threading.Event()
+        self._stopping = threading.Event()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.generation = 0
+        self.batches_sent = 0
+        self.batches_failed = 0
+        self.batches_rejected = 0
+        self.bytes_sent = 0
+        self.bytes_uncompressed = 0
+        self.cookies_dropped = 0
+        self.sketches_dropped = 0
+        self.flows_dropped = 0
+        self.blobs_sent = 0
+        self.blob_bytes_sent = 0
+        self.blobs_missing = 0  # Digests sent without a body the dashboard no longer had
+        self.post_latency = LatencyHistogram()  # Per batch, retries included
+
+    def ready(self):
+        """
+        True when a submission will be accepted. The capture loop is the only
+        producer, so a queue that is not full now cannot fill up before its
+        next submit().
+        """
+        if self.queue.full():
+            self.backpressure.set()
+        return not self.backpressure.is_set()
+
+    def submit(self, generation, count, overflow, packets, cookies=(), sketches=(), sample_rate=1, flows=()):
+        """
+        Queue packets, cookie rows in COOKIE_FIELDS order, cookie analytics
+        snapshots and flow rows in FLOW_FIELDS order for export. sample_rate
+        is the 1-in-N rate the packets were sampled at.
+        Returns False, and raises backpressure, when the exporter cannot
+        keep up.
+        """
+        try:
+            self.queue.put_nowait((generation, count, overflow, packets, cookies, sketches, sample_rate, flows))
+        except queue.Full:
+            self.backpressure.set()
+            return False
+        return True
+
+    def stop(self, timeout=5.0):
+        """
+        Flush what is queued and stop the thread.
+        """
+        self._stopping.set()
+        self.join(timeout)
+        self.session.close()
+
+    def run(self):
+        batch = None
+        deadline = None
+        while not (self._stopping.is_set() and batch is None and self.queue.empty()):
+            timeout = self.flush_interval if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                generation, count, overflow, packets, cookies, sketches, sample_rate, flows = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                pass
+            else:
+                if generation != self.generation:
+                    # The packets will be taken from the ring again, the
+                    # cookies, snapshots and flows will not
+                    self.cookies_dropped += len(cookies)
+                    self.sketches_dropped += len(sketches)
+                    self.flows_dropped += len(flows)
+                else:
+                    if batch is None:
+                        batch = {"count": count, "overflow": overflow, "packets": [], "cookies": [],
+                                 "sketches": [], "flows": []}
+                        deadline = time.monotonic() + self.flush_interval
+                    batch["count"] = count
+                    batch["overflow"] = overflow
+                    batch["sample_rate"] = sample_rate
+                    batch["packets"].extend(packets)
+                    batch["cookies"].extend(cookies)
+                    batch["sketches"].extend(sketches)
+                    batch["flows"].extend(flows)
+
+            if batch is not None and (len(batch["packets"]) >= self.max_batch_packets
+                                      or time.monotonic() >= deadline or self._stopping.is_set()):
+                self._flush(batch)
+                batch = None
+                deadline = None
+            # Also after discarding stale submissions, which may be all
+            # that is left in the queue after a failed batch
+            if self.queue.qsize() < self.queue.maxsize // 2:
+                self.backpressure.clear()
+
+    def _flush(self, batch, resend=True):
+        """
+        Post a batch. Returns False when it failed and the ring was rewound.
+        """
+        packets = batch["packets"]
+        cursor = packets[-1].seq if packets else None
+        payload = {
+            "count": batch["count"],
+            "cursor": cursor,
+            "overflow": batch["overflow"],
+            "sample_rate": batch["sample_rate"],
+        }
+        blobs = {}
+        if self.columnar:
+            # Payloads travel either inline or as digests, not both
+            skipped = "http_data" if self.intern is not None else "http_data_ref"
+            payload["columns"] = {name: [getattr(packet, name) for packet in packets]
+                                  for name in PACKET_FIELDS if name != skipped}
+            if self.intern is not None:
+                for packet in packets:
+                    if packet.http_data_ref is not None:
+                        blobs[packet.http_data_ref] = packet.http_data
+                blobs = {digest: blobs[digest] for digest in self.intern.unshipped(blobs)}
+                if blobs:
+                    payload["blobs"] = blobs
+        else:
+            payload["packets"] = [packet.to_dict() for packet in packets]
+        cookies = batch["cookies"]
+        if cookies and self.columnar:
+            payload["cookies"] = {name: list(values) for name, values in zip(COOKIE_FIELDS, zip(*cookies))}
+        if batch["sketches"] and self.columnar:
+            payload["sketches"] = batch["sketches"]
+        flows = batch["flows"]
+        if flows and self.columnar:
+            payload["flows"] = {name: list(values) for name, values in zip(FLOW_FIELDS, zip(*flows))}
+        body = json.dumps(payload).encode("utf-8")
+        compressed, encoding = compress_body(body, self.compression)
+        headers = {"Content-Type": "application/json"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+
+        start = time.perf_counter()
+        status, result = self._post(compressed, headers)
+        self.post_latency.observe(time.perf_counter() - start)
+        if status == 201:
+            self.batches_sent += 1
+            self.bytes_sent += len(compressed)
+            self.bytes_uncompressed += len(body)
+            if self.intern is not None:
+                missing = self._update_shipped(blobs, result)
+                if missing and resend:
+                    # Only the rejected rows, so the counts and the other
+                    # rows are not stored twice
+                    retry = {"count": None, "overflow": batch["overflow"], "sample_rate": batch["sample_rate"],
+                             "packets": [packet for packet in packets if packet.http_data_ref in missing],
+                             "cookies": [], "sketches": [], "flows": []}
+                    if not self._flush(retry, resend=False):
+                        return
+        elif status is not None and 400 <= status < 500:
+            # The dashboard will never accept this batch, so drop it rather
+            # than resending it forever.
+            self.batches_rejected += 1
+        else:
+            self.batches_failed += 1
+            self.cookies_dropped += len(cookies)
+            self.sketches_dropped += len(batch["sketches"])
+            self.flows_dropped += len(flows)
+            if self.on_failure:
+                self.generation = self.on_failure()
+            return False
+        if cursor is not None and self.on_ack:
+            self.on_ack(cursor)
+        return True
+
+    def _update_shipped(self, blobs, result):
+        self.blobs_sent += len(blobs)
+        self.blob_bytes_sent += sum(len(text) for text in blobs.values())
+        self.intern.mark_shipped(blobs)
+        missing = result.get("blobs", {}).get("missing", []) if isinstance(result, dict) else []
+        if missing:
+            self.blobs_missing += len(missing)
+            self.intern.mark_shipped(missing, shipped=False)
+        return set(missing)
+
+    def _post(self, body, headers):
+        """
+        POST a batch, retrying connection errors and server errors. Returns
+        the final status code, or None when the dashboard was unreachable,
+        and the decoded response body of an accepted batch.
+        """
+        status = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.backpressure.set()
+                delay = min(self.max_backoff, self.retry_backoff * 2 ** (attempt - 1))
+                if self._stopping.wait(delay * random.uniform(0.5, 1.0)):
+                    return None, None
+            try:
+                response = self.session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Error connecting to dashboard API: {e}")
+                continue
+            status = response.status_code
+            if status == 201:
+                try:
+                    return status, response.json()
+                except ValueError:
+                    return status, None
+            logging.error(f"Failed to send data to dashboard: {response.text}")
+            # Client errors other than throttling will not succeed on retry
+            if 400 <= status < 500 and status != 429:
+                return status, None
+        # Report exhausted retries on throttling as a failure, not a rejection
+        return (None if status == 429 else status), None
@@ -0,0 +1,228 @@
+import ipaddress
+import logging
+import os
+import sys
+
+import yaml
+
+from decoder import METHOD_NAMES
+
+# Flag bits of struct filter_config in http_filter.c
+FILTER_SRC_CIDRS = 0x01
+FILTER_DST_CIDRS = 0x02
+FILTER_PORTS = 0x04
+FILTER_METHODS = 0x08
+FILTER_HOST_PREFIXES = 0x10
+
+# Map sizes from http_filter.c
+MAX_FILTER_CIDRS = 1024
+MAX_HOST_PREFIXES = 8
+HOST_PREFIX_LEN = 32
+PORT_FILTER_SLOTS = 1024
+
+METHOD_CODES = {name: code for code, name in enumerate(METHOD_NAMES.tolist()) if name}
+
+
+class FilterRules:
+    """
+    Capture rules from the `filters` config section:
+
+        filters:
+          src_cidrs: [10.0.0.0/8]
+          dst_cidrs: [192.168.1.10/32]
+          ports: [80, 8080, "9000-9010"]
+          methods: [GET, POST]
+          host_prefixes: [api.example.com]
+
+    Each rule is enabled by a non-empty list. CIDRs and ports decide
+    whether a packet is counted and captured (a port matches either end of
+    the connection); methods and Host prefixes decide whether a payload is
+    captured, so only HTTP requests pass them. Raises ValueError on rules
+    the XDP program cannot hold.
+    """
+
+    def __init__(self, src_cidrs=(), dst_cidrs=(), ports=(), methods=(), host_prefixes=()):
+        self.src_cidrs = [self._network(cidr) for cidr in src_cidrs]
+        self.dst_cidrs = [self._network(cidr) for cidr in dst_cidrs]
+        for name, cidrs in (("src_cidrs", self.src_cidrs), ("dst_cidrs", self.dst_cidrs)):
+            if len(cidrs) > MAX_FILTER_CIDRS:
+                raise ValueError(f"{name}: at most {MAX_FILTER_CIDRS} entries are supported")
+        self.ports = self._ports(ports)
+        self.methods = set()
+        for method in methods:
+            if str(method).upper() not in METHOD_CODES:
+                raise ValueError(f"methods: unknown HTTP method {method!r}")
+            self.methods.add(str(method).upper())
+        self.host_prefixes = [str(prefix).lower().encode("ascii") for prefix in host_prefixes]
+        if len(self.host_prefixes) > MAX_HOST_PREFIXES:
+            raise ValueError(f"host_prefixes: at most {MAX_HOST_PREFIXES} entries are supported")
+        for prefix in self.host_prefixes:
+            if not 0 < len(prefix) <= HOST_PREFIX_LEN:
+                raise ValueError(f"host_prefixes: {prefix.decode()!r} must be 1 to {HOST_PREFIX_LEN} characters")
+
+    @classmethod
+    def from_config(cls, settings):
+        settings = settings or {}
+        return cls(
+            src_cidrs=settings.get("src_cidrs") or (),
+            dst_cidrs=settings.get("dst_cidrs") or (),
+            ports=settings.get("ports") or (),
+            methods=settings.get("methods") or (),
+            host_prefixes=settings.get("host_prefixes") or (),
+        )
+
+    @staticmethod
+    def _network(cidr):
+        network = ipaddress.ip_network(str(cidr), strict=False)
+        if network.version != 4:
+            raise ValueError(f"{cidr}: only IPv4 networks are supported")
+        return network
+
+    @staticmethod
+    def _ports(ports):
+        result = set()
+        for entry in ports:
+            low, _, high = str(entry).partition("-")
+            low, high = int(low), int(high or low)
+            if not 0 <= low <= high <= 0xFFFF:
+                raise ValueError(f"ports: invalid port or range {entry!r}")
+            result.update(range(low, high + 1))
+        return result
+
+    @property
+    def flags(self):
+        flags = 0
+        if self.src_cidrs:
+            flags |= FILTER_SRC_CIDRS
+        if self.dst_cidrs:
+            flags |= FILTER_DST_CIDRS
+        if self.ports:
+            flags |= FILTER_PORTS
+        if self.methods:
+            flags |= FILTER_METHODS
+        if self.host_prefixes:
+            flags |= FILTER_HOST_PREFIXES
+        return flags
+
+    def method_mask(self):
+        mask = 0
+        for method in self.methods:
+            mask |= 1 << METHOD_CODES[method]
+        return mask
+
+    def port_bitmap(self):
+        words = [0] * PORT_FILTER_SLOTS
+        for port in self.ports:
+            words[port >> 6] |= 1 << (port & 63)
+        return words
+
+    def describe(self):
+        parts = [f"{len(self.src_cidrs)} source CIDRs", f"{len(self.dst_cidrs)} destination CIDRs",
+                 f"{len(self.ports)} ports", f"methods {sorted(self.methods) or 'any'}",
+                 f"{len(self.host_prefixes)} Host prefixes"]
+        return ", ".join(parts)
+
+
+class FilterMaps:
+    """
+    Writes FilterRules into the XDP program's filter maps. The program stays
+    attached: new trie entries and ports are added before the flags are
+    written and stale ones are removed after, so while a reload is in
+    progress the filter briefly passes the union of the old and new rules
+    rather than dropping traffic both would capture.
+    """
+
+    def __init__(self, bpf):
+        self.config = bpf["filter_config"]
+        self.tries = {"src_cidrs": bpf["src_filter"], "dst_cidrs": bpf["dst_filter"]}
+        self.ports = bpf["port_filter"]
+        self.hosts = bpf["host_filter"]
+        # Port words last written; None forces a full write, since pinned
+        # maps keep the previous run's contents
+        self._port_words = None
+
+    def apply(self, rules):
+        wanted = {name: self._add_cidrs(table, getattr(rules, name)) for name, table in self.tries.items()}
+        words = rules.port_bitmap()
+        if self._port_words is not None:
+            self._write_ports([old | new for old, new in zip(self._port_words, words)])
+        for i, prefix in enumerate(rules.host_prefixes):
+            entry = self.hosts.Leaf()
+            entry.len = len(prefix)
+            entry.prefix = prefix
+            self.hosts[self.hosts.Key(i)] = entry
+
+        settings = self.config.Leaf()
+        settings.flags = rules.flags
+        settings.methods = rules.method_mask()
+        settings.host_count = len(rules.host_prefixes)
+        self.config[self.config.Key(0)] = settings
+
+        for name, table in self.tries.items():
+            self._remove_stale(table, wanted[name])
+        self._write_ports(words)
+        logging.info(f"Capture filters applied: {rules.describe()}")
+
+    @staticmethod
+    def _cidr_key(table, network):
+        # The address is stored in network byte order
+        addr = int.from_bytes(network.network_address.packed, sys.byteorder)
+        return table.Key(network.prefixlen, addr)
+
+    def _add_cidrs(self, table, networks):
+        wanted = set()
+        for network in networks:
+            table[self._cidr_key(table, network)] = table.Leaf(1)
+            wanted.add((network.prefixlen, int(network.network_address)))
+        return wanted
+
+    @staticmethod
+    def _remove_stale(table, wanted):
+        stale = []
+        for key in table.keys():
+            addr = int.from_bytes(key.addr.to_bytes(4, sys.byteorder), "big")
+            if (key.prefixlen, addr) not in wanted:
+                stale.append(table.Key(key.prefixlen, key.addr))
+        for key in stale:
+            del table[key]
+
+    def _write_ports(self, words):
+        for slot, word in enumerate(words):
+            if self._port_words is None or self._port_words[slot] != word:
+                self.ports[self.ports.Key(slot)] = self.ports.Leaf(word)
+        self._port_words = words
+
+
+class ConfigWatcher:
+    """
+    Reports changes to the config file, checked by modification time at
+    most once per `interval` seconds. poll() returns the newly parsed
+    config, or None when it is unchanged or does not parse.
+    """
+
+    def __init__(self, path="config.yaml", interval=2.0):
+        self.path = path
+        self.interval = interval
+        self._mtime = self._stat()
+        self._checked = 0.0
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def poll(self, now):
+        if now - self._checked < self.interval:
+            return None
+        self._checked = now
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return None
+        self._mtime = mtime
+        try:
+            with open(self.path) as f:
+                return yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError) as e:
+            logging.error(f"Ignoring unreadable config {self.path}: {e}")
+            return None
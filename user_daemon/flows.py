@@ -0,0 +1,168 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from decoder import ip_to_str
+
+# packet_info.tcp_flags bits
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_UNSAMPLED = 0x80  # Sent past payload sampling, see decoder.TCP_FLAG_BITS
+
+# Flow rows in the order they are shipped
+FLOW_FIELDS = (
+    "src_ip",
+    "dst_ip",
+    "src_port",
+    "dst_port",
+    "protocol",
+    "packets",
+    "bytes",
+    "first_seen",
+    "last_seen",
+    "tcp_flags",
+    "end_reason",
+)
+
+_KEY_DTYPE = np.dtype([("addresses", np.uint64), ("ports", np.uint64)])
+# IP protocol numbers to the names the dashboard stores
+_IP_PROTOCOLS = {6: "TCP", 17: "UDP", 1: "ICMP"}
+
+
+class Flow:
+    __slots__ = ("packets", "bytes", "first_seen", "last_seen", "tcp_flags")
+
+    def __init__(self, now):
+        self.packets = 0
+        self.bytes = 0
+        self.first_seen = now
+        self.last_seen = now
+        self.tcp_flags = 0
+
+
+class FlowTable:
+    """
+    Unidirectional flows keyed by 5-tuple, updated a decoded batch at a
+    time. A batch is first reduced to one entry per flow with numpy, so the
+    per-packet cost stays vectorized and only distinct flows touch the
+    table.
+
+    A flow is ended, and becomes a record for take(), when it sees a FIN or
+    RST, has been idle for `idle_timeout` seconds, or has been open for
+    `active_timeout` seconds (long flows are reported in slices and carry
+    on). Beyond `max_flows` the least recently seen flows are ended early.
+    Times are Unix timestamps of the batches that carried the packets.
+
+    With payload sampling, packet and byte counts are estimates: every
+    sampled event counts sample_rate times. Connection opens and closes
+    without payload are sent unsampled and count once.
+    """
+
+    def __init__(self, idle_timeout=15.0, active_timeout=60.0, max_flows=65536, clock=time.time):
+        self.idle_timeout = idle_timeout
+        self.active_timeout = active_timeout
+        self.max_flows = max_flows
+        self.clock = clock
+        self.flows = OrderedDict()  # Least recently seen first
+        self.ended = []  # (key, flow, reason)
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def update(self, raw, now=None, sample_rate=1):
+        """
+        Account a batch of PACKET_INFO_DTYPE records, captured while the
+        kernel sent one in `sample_rate` payload packets. Events the kernel
+        marked unsampled count once.
+        """
+        if len(raw) == 0:
+            return
+        now = self.clock() if now is None else now
+        keys = np.empty(len(raw), dtype=_KEY_DTYPE)
+        keys["addresses"] = (raw["src_ip"].astype(np.uint64) << np.uint64(32)) | raw["dst_ip"]
+        keys["ports"] = ((raw["src_port"].astype(np.uint64) << np.uint64(24))
+                         | (raw["dst_port"].astype(np.uint64) << np.uint64(8)) | raw["protocol"])
+        unique, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.ravel()
+        if sample_rate > 1:
+            weights = np.where(raw["tcp_flags"] & TCP_UNSAMPLED, 1, sample_rate)
+            packets = np.bincount(inverse, weights=weights, minlength=len(unique)).astype(np.int64)
+            sizes = np.bincount(inverse, weights=raw["packet_len"] * weights, minlength=len(unique))
+        else:
+            packets = np.bincount(inverse, minlength=len(unique))
+            sizes = np.bincount(inverse, weights=raw["packet_len"], minlength=len(unique))
+        flags = np.zeros(len(unique), dtype=np.uint8)
+        np.bitwise_or.at(flags, inverse, raw["tcp_flags"])
+        flags &= np.uint8(~TCP_UNSAMPLED & 0xFF)
+
+        flows = self.flows
+        for key, count, size, flag in zip(unique.tolist(), packets.tolist(), sizes.tolist(), flags.tolist()):
+            flow = flows.get(key)
+            if flow is None:
+                flow = flows[key] = Flow(now)
+            else:
+                flows.move_to_end(key)
+            flow.packets += count
+            flow.bytes += int(size)
+            flow.last_seen = now
+            flow.tcp_flags |= flag
+            if flag & TCP_RST:
+                self._end(key, "rst")
+            elif flag & TCP_FIN:
+                self._end(key, "fin")
+
+        if len(flows) > self.max_flows:
+            self._evict(len(flows) - self.max_flows)
+
+    def expire(self, now=None):
+        """
+        End idle flows and slice flows open longer than the active timeout.
+        """
+        now = self.clock() if now is None else now
+        idle_before = now - self.idle_timeout
+        active_before = now - self.active_timeout
+        for key, flow in list(self.flows.items()):
+            if flow.last_seen <= idle_before:
+                self._end(key, "idle")
+            elif flow.first_seen <= active_before:
+                self._end(key, "active")
+
+    def flush(self):
+        """
+        End every flow, e.g. at shutdown.
+        """
+        for key in list(self.flows):
+            self._end(key, "shutdown")
+
+    def take(self):
+        """
+        Rows, in FLOW_FIELDS order, of the flows ended since the last call.
+        """
+        ended, self.ended = self.ended, []
+        if not ended:
+            return []
+        keys = np.array([key for key, _, _ in ended], dtype=_KEY_DTYPE)
+        src_ips = ip_to_str((keys["addresses"] >> np.uint64(32)).astype(np.uint32)).tolist()
+        dst_ips = ip_to_str((keys["addresses"] & np.uint64(0xFFFFFFFF)).astype(np.uint32)).tolist()
+        ports = keys["ports"]
+        src_ports = (ports >> np.uint64(24)).astype(np.uint16).tolist()
+        dst_ports = ((ports >> np.uint64(8)) & np.uint64(0xFFFF)).astype(np.uint16).tolist()
+        protocols = (ports & np.uint64(0xFF)).tolist()
+        return [
+            (src_ip, dst_ip, src_port, dst_port, _IP_PROTOCOLS.get(protocol, "Unknown"),
+             flow.packets, flow.bytes, flow.first_seen, flow.last_seen, flow.tcp_flags, reason)
+            for src_ip, dst_ip, src_port, dst_port, protocol, (_, flow, reason)
+            in zip(src_ips, dst_ips, src_ports, dst_ports, protocols, ended)
+        ]
+
+    def _end(self, key, reason):
+        self.ended.append((key, self.flows.pop(key), reason))
+
+    def _evict(self, count):
+        for _ in range(count):
+            key, flow = self.flows.popitem(last=False)
+            self.ended.append((key, flow, "evicted"))
+        self.evicted += count
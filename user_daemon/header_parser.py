@@ -0,0 +1,378 @@
+import zlib
+
+import numpy as np
+
+from cookies import REQUEST_METHODS
+from decoder import MAX_HTTP_DATA, PACKET_INFO_DTYPE, payload_bytes
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Request methods by their first four bytes, for the compiled kernel
+_METHOD_PREFIXES = np.frombuffer(b"".join(REQUEST_METHODS), dtype=np.uint8).reshape(-1, 4)
+_METHOD_CODES = np.array(list(REQUEST_METHODS.values()), dtype=np.uint8)
+
+
+def _crc32_table():
+    table = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        table = np.where(table & 1, (table >> np.uint32(1)) ^ np.uint32(0xEDB88320), table >> np.uint32(1))
+    return table.astype(np.uint32)
+
+
+_CRC32_TABLE = _crc32_table()
+
+_SPACE, _TAB, _CR, _LF, _COLON, _SEMICOLON, _EQUALS = b" \t\r\n:;="
+_HOST = np.frombuffer(b"host", dtype=np.uint8)
+_COOKIE = np.frombuffer(b"cookie", dtype=np.uint8)
+
+
+class CookiePairs:
+    """
+    Cookie name=value pairs of a batch, as offsets into `text`, the Cookie
+    header values of the batch's requests back to back. Hashes are CRC-32,
+    as zlib.crc32 computes them.
+    """
+
+    def __init__(self, text, name_start, name_len, value_start, value_len, name_hash, value_hash):
+        self.text = text
+        self.name_start = name_start
+        self.name_len = name_len
+        self.value_start = value_start
+        self.value_len = value_len
+        self.name_hash = name_hash
+        self.value_hash = value_hash
+
+    def __len__(self):
+        return len(self.name_start)
+
+    def name(self, i):
+        start = self.name_start[i]
+        return self.text[start:start + self.name_len[i]].tobytes()
+
+    def value(self, i):
+        start = self.value_start[i]
+        return self.text[start:start + self.value_len[i]].tobytes()
+
+
+class ParsedHeaders:
+    """
+    Request line, Host and Cookie header positions of a batch of HTTP
+    payloads, as offsets from the start of each payload; starts are -1 when
+    a payload has no such part. Pairs of payload i are pairs[offsets[i]:
+    offsets[i + 1]].
+    """
+
+    def __init__(self, method, line_len, target_start, target_len, host_start, host_len, cookie_start,
+                 cookie_len, cookie_count, pairs):
+        self.method = method
+        self.line_len = line_len
+        self.target_start = target_start
+        self.target_len = target_len
+        self.host_start = host_start
+        self.host_len = host_len
+        self.cookie_start = cookie_start
+        self.cookie_len = cookie_len
+        self.cookie_count = cookie_count
+        self.pairs = pairs
+
+    def __len__(self):
+        return len(self.method)
+
+    @property
+    def offsets(self):
+        offsets = np.zeros(len(self.cookie_count) + 1, dtype=np.int64)
+        np.cumsum(self.cookie_count, out=offsets[1:])
+        return offsets
+
+
+def _empty_headers(count):
+    """
+    method, line_len, then (start, len) of the target, Host and Cookie, and
+    cookie_count arrays for `count` payloads.
+    """
+    arrays = [np.zeros(count, dtype=np.uint8), np.zeros(count, dtype=np.int32)]
+    for _ in range(3):
+        arrays += [np.full(count, -1, dtype=np.int32), np.zeros(count, dtype=np.int32)]
+    return arrays + [np.zeros(count, dtype=np.int32)]
+
+
+# Compiled kernel. Written in the subset of Python numba compiles; the
+# scan is one pass over each payload's header section, with the cookie
+# pairs split in a second pass once their number is known.
+
+def _lower_equals(data, at, word):
+    for k in range(len(word)):
+        if data[at + k] | 0x20 != word[k]:
+            return False
+    return True
+
+
+def _split_pairs(data, start, length, out, at, text_base, write):
+    """
+    Split the Cookie value data[start:start + length] at ';', strip each
+    item of spaces and tabs and keep those with a non-empty name before
+    '='. Writes (name_start, name_len, value_start, value_len) rows of out
+    from row at, with starts relative to text_base, when write is set.
+    Returns the number of pairs.
+    """
+    count = 0
+    end = start + length
+    item = start
+    while item <= end:
+        stop = item
+        while stop < end and data[stop] != _SEMICOLON:
+            stop += 1
+        a, b = item, stop
+        while a < b and (data[a] == _SPACE or data[a] == _TAB):
+            a += 1
+        while b > a and (data[b - 1] == _SPACE or data[b - 1] == _TAB):
+            b -= 1
+        eq = a
+        while eq < b and data[eq] != _EQUALS:
+            eq += 1
+        if eq < b and eq > a:
+            if write:
+                out[at + count, 0] = a - text_base
+                out[at + count, 1] = eq - a
+                out[at + count, 2] = eq + 1 - text_base
+                out[at + count, 3] = b - eq - 1
+            count += 1
+        item = stop + 1
+    return count
+
+
+def _scan_headers(data, starts, lengths, prefixes, codes, host, cookie, method, line_len, target_start,
+                  target_len, host_start, host_len, cookie_start, cookie_len, cookie_count):
+    for i in range(len(starts)):
+        base = starts[i]
+        n = lengths[i]
+        if n >= 4:
+            for m in range(prefixes.shape[0]):
+                if (data[base] == prefixes[m, 0] and data[base + 1] == prefixes[m, 1]
+                        and data[base + 2] == prefixes[m, 2] and data[base + 3] == prefixes[m, 3]):
+                    method[i] = codes[m]
+                    break
+
+        eol = 0
+        while eol < n and data[base + eol] != _LF:
+            eol += 1
+        stop = eol
+        if stop > 0 and data[base + stop - 1] == _CR:
+            stop -= 1
+        line_len[i] = stop
+        space = 0
+        while space < stop and data[base + space] != _SPACE:
+            space += 1
+        if space < stop:
+            target = space + 1
+            target_end = target
+            while target_end < stop and data[base + target_end] != _SPACE:
+                target_end += 1
+            target_start[i] = target
+            target_len[i] = target_end - target
+
+        pos = eol + 1
+        while pos < n:
+            eol = pos
+            while eol < n and data[base + eol] != _LF:
+                eol += 1
+            stop = eol
+            if stop > pos and data[base + stop - 1] == _CR:
+                stop -= 1
+            if stop == pos:
+                break
+            colon = pos
+            while colon < stop and data[base + colon] != _COLON:
+                colon += 1
+            if colon < stop:
+                name_len = colon - pos
+                is_host = name_len == 4 and host_start[i] < 0 and _lower_equals(data, base + pos, host)
+                is_cookie = (name_len == 6 and cookie_start[i] < 0
+                             and _lower_equals(data, base + pos, cookie))
+                if is_host or is_cookie:
+                    value = colon + 1
+                    while value < stop and (data[base + value] == _SPACE or data[base + value] == _TAB):
+                        value += 1
+                    if is_host:
+                        value_end = stop
+                        while value_end > value and (data[base + value_end - 1] == _SPACE
+                                                     or data[base + value_end - 1] == _TAB):
+                            value_end -= 1
+                        host_start[i] = value
+                        host_len[i] = value_end - value
+                    else:
+                        cookie_start[i] = value
+                        cookie_len[i] = stop - value
+            pos = eol + 1
+
+        if cookie_start[i] >= 0:
+            cookie_count[i] = _split_pairs(data, base + cookie_start[i], cookie_len[i], np.empty((0, 4), np.int32),
+                                           0, 0, False)
+
+
+def _collect_pairs(data, starts, cookie_start, cookie_len, cookie_count, offsets, text, spans, hashes, table):
+    """
+    Copy the Cookie values of requests with cookies into text, record
+    their pairs' spans in it and CRC-32 the names and values.
+    """
+    text_at = 0
+    for i in range(len(starts)):
+        if cookie_count[i] == 0:
+            continue
+        start = starts[i] + cookie_start[i]
+        length = cookie_len[i]
+        for k in range(length):
+            text[text_at + k] = data[start + k]
+        _split_pairs(text, text_at, length, spans, offsets[i], 0, True)
+        text_at += length
+    for p in range(spans.shape[0]):
+        for column in range(2):
+            crc = np.uint32(0xFFFFFFFF)
+            at = spans[p, 2 * column]
+            for k in range(spans[p, 2 * column + 1]):
+                crc = table[(crc ^ text[at + k]) & 0xFF] ^ (crc >> 8)
+            hashes[p, column] = crc ^ np.uint32(0xFFFFFFFF)
+
+
+if numba is not None:
+    _lower_equals = numba.njit(cache=True, nogil=True)(_lower_equals)
+    _split_pairs = numba.njit(cache=True, nogil=True)(_split_pairs)
+    _scan_headers = numba.njit(cache=True, nogil=True)(_scan_headers)
+    _collect_pairs = numba.njit(cache=True, nogil=True)(_collect_pairs)
+
+
+def _parse_compiled(data, starts, lengths):
+    count = len(starts)
+    method, line_len, target_start, target_len, host_start, host_len, cookie_start, cookie_len, cookie_count = \
+        _empty_headers(count)
+    _scan_headers(data, starts, lengths, _METHOD_PREFIXES, _METHOD_CODES, _HOST, _COOKIE, method, line_len,
+                  target_start, target_len, host_start, host_len, cookie_start, cookie_len, cookie_count)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(cookie_count, out=offsets[1:])
+    text = np.empty(int(cookie_len[cookie_count > 0].sum()), dtype=np.uint8)
+    spans = np.empty((int(offsets[-1]), 4), dtype=np.int32)
+    hashes = np.empty((int(offsets[-1]), 2), dtype=np.uint32)
+    _collect_pairs(data, starts, cookie_start, cookie_len, cookie_count, offsets, text, spans, hashes, _CRC32_TABLE)
+    pairs = CookiePairs(text, spans[:, 0], spans[:, 1], spans[:, 2], spans[:, 3], hashes[:, 0], hashes[:, 1])
+    return ParsedHeaders(method, line_len, target_start, target_len, host_start, host_len, cookie_start, cookie_len,
+                         cookie_count, pairs)
+
+
+def _parse_python(payloads):
+    """
+    The same parse with bytes methods, for when numba is not installed.
+    """
+    count = len(payloads)
+    method, line_len, target_start, target_len, host_start, host_len, cookie_start, cookie_len, cookie_count = \
+        _empty_headers(count)
+    text = bytearray()
+    spans = []
+    for i, payload in enumerate(payloads):
+        n = len(payload)
+        method[i] = REQUEST_METHODS.get(payload[:4], 0)
+        eol = payload.find(b"\n")
+        eol = n if eol < 0 else eol
+        stop = eol - 1 if eol > 0 and payload[eol - 1] == _CR else eol
+        line_len[i] = stop
+        space = payload.find(b" ", 0, stop)
+        if space >= 0:
+            target_end = payload.find(b" ", space + 1, stop)
+            target_start[i] = space + 1
+            target_len[i] = (stop if target_end < 0 else target_end) - space - 1
+
+        pos = eol + 1
+        while pos < n:
+            eol = payload.find(b"\n", pos)
+            eol = n if eol < 0 else eol
+            stop = eol - 1 if eol > pos and payload[eol - 1] == _CR else eol
+            if stop == pos:
+                break
+            colon = payload.find(b":", pos, stop)
+            if colon >= 0:
+                name = payload[pos:colon].lower()
+                if (name == b"host" and host_start[i] < 0) or (name == b"cookie" and cookie_start[i] < 0):
+                    value = payload[colon + 1:stop]
+                    skipped = len(value) - len(value.lstrip(b" \t"))
+                    if name == b"host":
+                        host_start[i] = colon + 1 + skipped
+                        host_len[i] = len(value.strip(b" \t"))
+                    else:
+                        cookie_start[i] = colon + 1 + skipped
+                        cookie_len[i] = len(value) - skipped
+            pos = eol + 1
+
+        if cookie_start[i] < 0:
+            continue
+        value = payload[cookie_start[i]:cookie_start[i] + cookie_len[i]]
+        base = len(text)
+        item = 0
+        found = 0
+        for part in value.split(b";"):
+            stripped = part.lstrip(b" \t")
+            a = item + len(part) - len(stripped)
+            stripped = stripped.rstrip(b" \t")
+            name, sep, _ = stripped.partition(b"=")
+            if sep and name:
+                spans.append((base + a, len(name), base + a + len(name) + 1, len(stripped) - len(name) - 1))
+                found += 1
+            item += len(part) + 1
+        if found:
+            cookie_count[i] = found
+            text += value
+
+    spans = np.array(spans, dtype=np.int32).reshape(-1, 4)
+    text = np.frombuffer(bytes(text), dtype=np.uint8)
+    hashes = np.array([(zlib.crc32(text[n:n + nl]), zlib.crc32(text[v:v + vl])) for n, nl, v, vl in spans.tolist()],
+                      dtype=np.uint32).reshape(-1, 2)
+    pairs = CookiePairs(text, spans[:, 0], spans[:, 1], spans[:, 2], spans[:, 3], hashes[:, 0], hashes[:, 1])
+    return ParsedHeaders(method, line_len, target_start, target_len, host_start, host_len, cookie_start, cookie_len,
+                         cookie_count, pairs)
+
+
+def warm_up():
+    """
+    Compile the kernel, or load it from numba's cache, for both kinds of
+    input so the first batches are not held up by it.
+    """
+    if numba is None:
+        return
+    sample = b"GET / HTTP/1.1\r\nHost: h\r\nCookie: a=b\r\n\r\n"
+    parse_headers([sample])
+    raw = np.zeros(1, dtype=PACKET_INFO_DTYPE)
+    raw["http_data"] = sample
+    raw["http_data_len"] = len(sample)
+    parse_packet_headers(raw)
+
+
+def parse_headers(payloads, jit=None):
+    """
+    Parse a list of HTTP payloads (bytes). Uses the numba kernel when numba
+    is installed, unless jit is False.
+    """
+    if jit is None:
+        jit = numba is not None
+    if not jit:
+        return _parse_python(payloads)
+    lengths = np.fromiter(map(len, payloads), dtype=np.int64, count=len(payloads))
+    starts = np.zeros(len(payloads), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return _parse_compiled(np.frombuffer(b"".join(payloads), dtype=np.uint8), starts, lengths)
+
+
+def parse_packet_headers(raw, jit=None):
+    """
+    Parse the payloads of a batch of PACKET_INFO_DTYPE records in place,
+    without copying them out of the batch.
+    """
+    if jit is None:
+        jit = numba is not None
+    if not jit:
+        return _parse_python(payload_bytes(raw))
+    field_size = raw.dtype["http_data"].itemsize
+    lengths = np.minimum(raw["http_data_len"], min(field_size, MAX_HTTP_DATA)).astype(np.int64)
+    raw = np.ascontiguousarray(raw)
+    starts = np.arange(len(raw), dtype=np.int64) * raw.dtype.itemsize + raw.dtype.fields["http_data"][1]
+    return _parse_compiled(raw.view(np.uint8), starts, lengths)
@@ -0,0 +1,56 @@
+import time
+from bisect import bisect_left
+
+# Bucket upper bounds in seconds: powers of two from about 1us to 16s
+LATENCY_BOUNDS = tuple(2.0 ** exponent for exponent in range(-20, 5))
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram. observe() is a bisect and two adds, cheap
+    enough to call on every loop iteration. Each histogram has a single
+    writer; readers on other threads may see a count one ahead of the sum.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def buckets(self):
+        """
+        Cumulative (upper bound, count) pairs, ending with +Inf.
+        """
+        total = 0
+        result = []
+        for bound, count in zip((*self.bounds, float("inf")), list(self.counts)):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class StageTimer:
+    """
+    Times consecutive stages of a loop: start() marks the beginning of an
+    iteration and lap(stage) records the time since the previous mark in
+    that stage's histogram.
+    """
+
+    def __init__(self, stages, clock=time.perf_counter):
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+        self.clock = clock
+        self._last = clock()
+
+    def start(self):
+        self._last = self.clock()
+
+    def lap(self, stage):
+        now = self.clock()
+        self.histograms[stage].observe(now - self._last)
+        self._last = now
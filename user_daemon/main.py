@@ -1,189 +1,591 @@
 #!/usr/bin/env python3
 
-from bcc import BPF
+import argparse
+import os
+from collections import Counter, deque
 from config import config
 import utils.helper_functions as helpers
-import requests
-import time
 import logging
-import socket
-import struct
-import os
-import ctypes
-from socket import ntohl
-import ctypes as ct
+import numpy as np
+from decoder import PACKET_INFO_DTYPE, CookieBatch, CookieBatchDecoder, PacketBatch, PacketBatchDecoder, ip_to_str
+from counters import CounterDeltas, read_bpf_counts, read_bpf_stats, read_counter_dict
+from capture_buffer import CaptureRing
+from exporter import DashboardExporter
+from event_sources import make_event_source
+from sketches import CookieAnalytics
+from sampling import SamplingController
+from filters import ConfigWatcher, FilterMaps, FilterRules
+from flows import FlowTable
+from reassembly import HeaderReassembler
+import header_parser
+from workers import WorkerPool
+from archive import ArchiveWriter
+from dedup import InternTable
+from metrics import Metric, MetricsServer
+from instrumentation import StageTimer
+from scheduler import Scheduler
+from bpf_cache import DEFAULT_CACHE_DIR, BPFBuildCache, kernel_cflags, load_program
 
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, 
                     format="%(asctime)s [%(levelname)s] %(message)s")
 def clear_terminal():
-    os.system('clear')
+    # ANSI home and erase display, without forking a shell
+    print("\033[H\033[2J", end="", flush=True)
+
+def bpf_cflags():
+    flags = [f"-DPACKET_COUNT_MAX_ENTRIES={int(config.get('packet_count_max_entries', 262144))}"]
+    source_settings = config.get("event_source") or {}
+    if source_settings.get("type", "perf") == "ringbuf":
+        flags += ["-DUSE_RINGBUF", f"-DRINGBUF_PAGES={int(source_settings.get('pages', 256))}"]
+    if config.get("extract_cookies", False):
+        flags.append("-DEXTRACT_COOKIES")
+    if config.get("flows"):
+        flags.append("-DFLOW_EVENTS")
+    if config.get("debug_trace", False):
+        flags.append("-DDEBUG_TRACE")
+    return kernel_cflags(flags)
+
+def flow_table_options():
+    """
+    FlowTable arguments from the `flows` section, or None when flows are off.
+    """
+    settings = config.get("flows")
+    if not settings:
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    return {
+        "idle_timeout": settings.get("idle_timeout", 15.0),
+        "active_timeout": settings.get("active_timeout", 60.0),
+        "max_flows": settings.get("max_flows", 65536),
+    }
+
+def reassembly_options():
+    """
+    HeaderReassembler arguments from the `reassembly` section, or None when
+    it is turned off.
+
+    The XDP program samples and filters each payload packet on its own, and
+    the segments that continue a request neither start with a method nor
+    carry the Host header. With payload sampling or method/Host filters on,
+    those segments rarely reach the daemon, so reassembly is turned off.
+    """
+    settings = config.get("reassembly", {})
+    if settings is False:
+        return None
+    filters = config.get("filters") or {}
+    reasons = []
+    if config.get("sample_rate", 1) > 1 or config.get("sampling"):
+        reasons.append("payload sampling")
+    if filters.get("methods") or filters.get("host_prefixes"):
+        reasons.append("method or Host filters")
+    if reasons:
+        logging.warning(f"Header reassembly is off: {' and '.join(reasons)} drop the segments that "
+                        f"continue a request")
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    return {
+        "max_header_bytes": settings.get("max_header_bytes", 16384),
+        "max_bytes": settings.get("max_bytes", 16 * 1024 * 1024),
+        "max_streams": settings.get("max_streams", 4096),
+        "timeout": settings.get("timeout", 10.0),
+    }
+
+def dedup_options():
+    """
+    InternTable arguments from the `dedup` section, or None when it is
+    turned off.
+    """
+    settings = config.get("dedup", {})
+    if settings is False:
+        return None
+    settings = settings if isinstance(settings, dict) else {}
+    return {
+        "max_entries": settings.get("max_entries", 65536),
+        "max_bytes": settings.get("max_bytes", 64 * 1024 * 1024),
+    }
+
+_KERNEL_STAT_HELP = {
+    "packets": "Packets seen by the XDP program",
+    "counted": "TCP packets counted per source",
+    "skipped_acks": "Pure ACKs skipped before counting",
+    "filtered": "Packets or payloads rejected by the capture filters",
+    "sampled_out": "Payload packets skipped by sampling",
+    "packet_events": "Packet events submitted to userspace",
+    "cookie_events": "Cookie records submitted to userspace",
+    "truncated": "Payloads truncated to the capture size",
+    "submit_failures": "Events dropped because the perf or ring buffer was full",
+    "lookup_failures": "Failed BPF map lookups and insertions",
+}
+
+_REASSEMBLY_METRICS = {
+    "completed": ("reassembly_headers_total", "counter", "HTTP header blocks passed to cookie analytics"),
+    "reassembled": ("reassembly_reassembled_total", "counter", "Header blocks stitched from several segments"),
+    "gaps": ("reassembly_gaps_total", "counter", "Header blocks abandoned because a segment never arrived"),
+    "evictions": ("reassembly_evictions_total", "counter", "Streams evicted to stay within the memory caps"),
+    "timeouts": ("reassembly_timeouts_total", "counter", "Streams dropped for not completing in time"),
+    "oversized": ("reassembly_oversized_total", "counter", "Streams dropped for exceeding max_header_bytes"),
+    "streams": ("reassembly_streams", "gauge", "Streams waiting for the rest of their headers"),
+    "buffered_bytes": ("reassembly_buffered_bytes", "gauge", "Payload bytes held by the reassembler"),
+}
+
+_DEDUP_METRICS = {
+    "hits": ("dedup_hits_total", "counter", "Payloads and cookie values found in the intern table"),
+    "misses": ("dedup_misses_total", "counter", "Payloads and cookie values added to the intern table"),
+    "evictions": ("dedup_evictions_total", "counter", "Entries evicted to stay within the intern table caps"),
+    "bytes_deduplicated": ("dedup_bytes_saved_total", "counter", "Captured bytes shared with an interned copy"),
+    "entries": ("dedup_entries", "gauge", "Entries in the intern table"),
+    "bytes": ("dedup_bytes", "gauge", "Captured bytes held by the intern table"),
+}
+
+DEFAULT_ARCHIVE_DIR = "/var/lib/ebpf-cookie-filter/archive"
+
+# Event polling and the scheduler's timers, timed by PacketAnalyzer.stages
+LOOP_STAGES = ("poll", "decode", "config", "deltas", "flows", "archive", "export", "log")
 
 class PacketAnalyzer:
     def __init__(self):
         self.function_name = config["function_name"]
         self.interface = config["network_interface"]
         self.packet_count_map = None
-        self.local_packet_cache = {}  # Local cache for cumulative counts
+        self.stats_map = None
+        self.stages = StageTimer(LOOP_STAGES)
+        self.source_counts = CounterDeltas()  # Last per-source snapshot and cumulative total
         self.total_packet_count = 0
-        self.captured_packets = []
+        self.capture_ring = CaptureRing(config.get("capture_buffer_size", 65536))
         self.latest_packet = None
-
-
-        # struct packet_info {
-        #     __u32 src_ip;     // Source IP address
-        #     __u32 dst_ip;     // Destination IP address
-        #     __u16 src_port;   // Source port
-        #     __u16 dst_port;   // Destination port
-        #     __u8 protocol;    // IP protocol (TCP/UDP/ICMP etc)
-        #     __u8 packet_type; // 0: TCP, 1: UDP, 2: ICMP, etc.
-        #     __u32 packet_len; // Total packet length
-        #     __u32 seq_num;    // Sequence number
-        #     __u32 ack_num;    // Acknowledgment number
-        #     __u8 tcp_flags;   // TCP flags
-        # };
-
-        # Define the packet info structure using ctypes
-        class PacketInfo(ctypes.Structure):
-            _fields_ = [
-                ("src_ip", ctypes.c_uint32),
-                ("dst_ip", ctypes.c_uint32),
-                ("src_port", ctypes.c_uint16),
-                ("dst_port", ctypes.c_uint16),
-                ("protocol", ctypes.c_uint8),
-                ("packet_type", ctypes.c_uint8),
-                ("packet_len", ctypes.c_uint32),
-                ("seq_num", ctypes.c_uint32),
-                ("ack_num", ctypes.c_uint32),
-                ("tcp_flags", ctypes.c_uint8),
-                ("http_data", ct.c_char * 2048),  # MAX_HTTP_DATA = 256
-                ("http_data_len", ct.c_uint32)
-            ]
-
-        self.PacketInfo = PacketInfo
-
-        # Kernel headers discovery
-        kernel_headers = f"/lib/modules/{os.uname().release}/build"
-        cflags = [
-            f"-I{kernel_headers}/include",
-            f"-I{kernel_headers}/include/uapi",
-            f"-I{kernel_headers}/arch/{os.uname().machine}/include",
-            "-I/usr/include",
-            "-I/usr/include/bcc",
-            "-D__KERNEL__",
-            "-Wno-unused-value",
-            "-Wno-pointer-sign",
-            "-Wno-compare-distinct-pointer-types",
-        ]
-
-        # Load BPF program
-        self.bpf = BPF(src_file=config["ebpf_program"], cflags=cflags)
-
-        # Attach the event type to the perf buffer
-        self.bpf["packet_events"].event_type = self.PacketInfo
+        self.print_packets = config.get("print_packets", False)
+        self.decoder = PacketBatchDecoder(config.get("decode_batch_size", 4096))
+        self.extract_cookies = config.get("extract_cookies", False)
+        self.cookie_decoder = CookieBatchDecoder(config.get("decode_batch_size", 4096))
+        self.pending_cookies = deque(maxlen=config.get("cookie_buffer_size", 65536))
+        self.cookies_dropped = 0
+        self.analytics = None
+        if config.get("cookie_analytics", True):
+            self.analytics = CookieAnalytics(
+                sources=config.get("cookie_analytics_sources", 1024),
+                top_k=config.get("cookie_analytics_top_k", 100),
+                interval=config.get("cookie_analytics_interval", 10.0),
+            )
+        self.pending_sketches = []
+        # Payloads are parsed for cookie analytics here, after cookie headers
+        # split across segments are stitched together; the EXTRACT_COOKIES
+        # build parses per packet in the kernel instead
+        self.parse_cookies = self.analytics is not None and not self.extract_cookies
+        flow_options = flow_table_options()
+        reassembly = reassembly_options() if self.parse_cookies else None
+        self.reassembly_enabled = reassembly is not None
+        if self.parse_cookies:
+            header_parser.warm_up()
+        self.export_packets = config.get("export_packets", True)
+        # Payloads and cookie values waiting to be shipped share one copy
+        # each, and are shipped by digest once the dashboard has them
+        dedup = dedup_options()
+        self.intern = InternTable(**dedup) if dedup is not None else None
+        self.pending_flows = deque(maxlen=config.get("flow_buffer_size", 65536))
+        self.flows_dropped = 0
+        self.archive = None
+        archive = config.get("archive")
+        if archive:
+            archive = archive if isinstance(archive, dict) else {}
+            self.archive_interval = archive.get("maintain_interval", 10.0)
+            retention_days = archive.get("retention_days", 7)
+            self.archive = ArchiveWriter(
+                archive.get("directory", DEFAULT_ARCHIVE_DIR),
+                segment_events=archive.get("segment_events", 1 << 20),
+                segment_seconds=archive.get("segment_seconds", 3600.0),
+                index_interval=archive.get("index_interval", 1024),
+                payloads=archive.get("payloads", True),
+                retention=retention_days * 86400.0 if retention_days else None,
+                max_bytes=archive.get("max_bytes"),
+            )
+
+        # Load BPF program, from the build cache when it is warm. Replay and
+        # synthetic sources run without it.
+        source_settings = config.get("event_source") or {}
+        self.bpf = None
+        self.fn = None
+        if source_settings.get("type", "perf") in ("perf", "ringbuf"):
+            loaded = load_program(config, config["ebpf_program"], bpf_cflags(), str(self.function_name))
+            self.bpf, self.fn = loaded.bpf, loaded.fn
+            if loaded.warm:
+                # The pinned counters still hold the previous run's totals,
+                # which would be reported as new packets
+                self.bpf["packet_count"].clear()
+                self.bpf["stats"].clear()
+        self.filter_maps = FilterMaps(self.bpf) if self.bpf else None
+
+        # With workers, decoding, flow tracking and cookie parsing move to
+        # worker processes and this one reduces their results
+        self.workers = None
+        self.flows = None
+        self.reassembler = None
+        worker_settings = config.get("workers") or {}
+        worker_count = worker_settings.get("count", 0)
+        if worker_count == "auto":
+            worker_count = len(os.sched_getaffinity(0))
+        if worker_count:
+            self.workers = WorkerPool(
+                int(worker_count), source_settings, self.bpf,
+                options={
+                    "extract_cookies": self.extract_cookies,
+                    "flows": flow_options,
+                    "reassembly": reassembly,
+                    "parse_cookies": self.parse_cookies,
+                    # Packets come back from workers to be shipped or archived
+                    "export_packets": self.export_packets or self.archive is not None,
+                    "decode_batch_size": config.get("decode_batch_size", 4096),
+                },
+                cpus=worker_settings.get("cpus"),
+                slots=worker_settings.get("slots", 4),
+                slot_bytes=worker_settings.get("slot_bytes", 4 * 1024 * 1024),
+                pin=worker_settings.get("pin", True),
+            )
+            self.source = self.workers
+            self.parse_cookies = False
+        else:
+            if flow_options is not None:
+                self.flows = FlowTable(**flow_options)
+            if reassembly is not None:
+                self.reassembler = HeaderReassembler(**reassembly)
+            self.source = make_event_source(source_settings, self.bpf, self.extract_cookies, flow_options is not None)
 
 
 
     def attach(self):
-        function_name = str(self.function_name)
-        fn = self.bpf.load_func(function_name, BPF.XDP)
-        self.bpf.attach_xdp(self.interface, fn, 0)
-        self.packet_count_map = self.bpf.get_table("packet_count")
-
-
-        # Set up perf buffer callback
-        def print_packet_event(cpu, data, size):
-            try:
-                event = ctypes.cast(data, ctypes.POINTER(self.PacketInfo)).contents
-                print("=== Full TCP/IP Packet ===")
-
-                # Ethernet
-                print("\n[Ethernet Header]")
-                print(f"Packet Length: {event.packet_len} bytes")
-
-                # IP 
-                print("\n[IP Header]")
-                src_ip = socket.inet_ntoa(struct.pack('!I', ntohl(event.src_ip)))  # Add ntohl()
-                dst_ip = socket.inet_ntoa(struct.pack('!I', ntohl(event.dst_ip)))
-                print(f"Source IP: {src_ip}")
-                print(f"Dest IP: {dst_ip}")
-                print(f"Protocol: {event.protocol}")
-
-                # TCP
-                print("\n[TCP Header]") 
-                print(f"Source Port: {event.src_port}")
-                print(f"Dest Port: {event.dst_port}")
-                print(f"Seq Number: {event.seq_num}")
-                print(f"Ack Number: {event.ack_num}")
-                print(f"TCP Flags: {event.tcp_flags:08b}")
-
-
-                if event.http_data_len > 0:
-                    http_data = event.http_data[:event.http_data_len].decode('utf-8', 'ignore')
-                    print("\n[HTTP Data]")
-                    print(f"HTTP Data Length: {event.http_data_len}")
-                    print(f"HTTP Content:\n{http_data}")
-                
-                protocol_names = {0: "TCP", 1: "UDP", 2: "ICMP"}
-                protocol_name = protocol_names.get(event.packet_type, "Unknown")
-                
-                self.latest_packet = {
-                    "protocol": protocol_name,
-                    "src_ip": src_ip,
-                    "src_port": event.src_port,
-                    "dst_ip": dst_ip,
-                    "dst_port": event.dst_port,
-                    "packet_len": event.packet_len,
-                    "seq_num": event.seq_num,
-                    "ack_num": event.ack_num,
-                    "packet_type": event.packet_type,
-                    "tcp_flags": event.tcp_flags,
-                    "http_data": event.http_data[:event.http_data_len].decode('utf-8', 'ignore') if event.http_data_len > 0 else "",
-                    "http_data_len": event.http_data_len
-                }
-                
-                self.total_packet_count += 1
-                self.captured_packets.append(self.latest_packet)
-            except Exception as e:
-                logging.error(f"Error processing packet event: {e}")
-        # Open perf buffer with the callback
-        self.bpf["packet_events"].open_perf_buffer(print_packet_event)
-
-    def get_packet_deltas(self):
+        if self.bpf:
+            # Pinned filter maps may hold the previous run's rules, so write
+            # the current ones before the program sees traffic
+            self.filter_maps.apply(FilterRules.from_config(config.get("filters")))
+            self.bpf.attach_xdp(self.interface, self.fn, 0)
+            self.packet_count_map = self.bpf["packet_count"]
+            self.stats_map = self.bpf["stats"]
+        elif config.get("filters"):
+            logging.warning("Capture filters only apply to the perf and ringbuf event sources")
+
+
+        # Set up the event callback. Records are only copied into the
+        # decoder's buffer here; decoding happens a batch at a time.
+        def handle_packet_event(cpu, data, size):
+            if self.decoder.append(data, size):
+                self.flush_packet_events()
+
+        def handle_cookie_event(cpu, data, size):
+            if self.cookie_decoder.append(data, size):
+                self.flush_cookie_events()
+
+        if self.workers is not None:
+            self.workers.open(
+                lambda raw: self.process_packet_batch(PacketBatch(raw)),
+                on_cookies=lambda raw: self.process_cookie_batch(CookieBatch(raw)),
+                on_parsed=self.analytics.add_parsed if self.analytics else None,
+                on_flows=self.queue_flows,
+                on_stats=self.handle_worker_stats,
+            )
+        else:
+            self.source.open(handle_packet_event, handle_cookie_event if self.extract_cookies else None)
+
+        # Sampling: a fixed 1-in-N rate, or one adjusted to the event budget
+        self.source.set_sample_rate(config.get("sample_rate", 1))
+        self.sampler = None
+        sampling = config.get("sampling")
+        if sampling:
+            sampler_options = {}
+            if self.workers is not None:
+                # Decoding runs in the workers, so their CPU time counts too
+                sampler_options["cpu_clock"] = self.workers.process_time
+            self.sampler = SamplingController(
+                self.source,
+                lambda: self.decoder.received_records,
+                target_events_per_sec=sampling.get("target_events_per_sec", 20000),
+                cpu_budget=sampling.get("cpu_budget", 0.5),
+                max_rate=sampling.get("max_rate", 1024),
+                interval=sampling.get("interval", 1.0),
+                **sampler_options,
+            )
+
+    def apply_filters(self, settings):
         """
-        Compute packet count deltas since the last poll.
+        Compile the `filters` config section into the XDP program's filter
+        maps. Invalid rules are logged and leave the current ones in place.
+        Returns whether the rules were applied.
         """
-        
-        deltas = {}
-        for key, value in self.packet_count_map.items():
-            # src_ip = socket.inet_ntoa(struct.pack("!I", key.value))
-            src_ip = socket.inet_ntoa(struct.pack('!I', ntohl(key.value)))  # Add ntohl()
+        if not self.filter_maps:
+            return False
+        try:
+            rules = FilterRules.from_config(settings)
+        except ValueError as e:
+            logging.error(f"Invalid capture filters, keeping the current ones: {e}")
+            return False
+        if self.reassembly_enabled and (rules.methods or rules.host_prefixes):
+            logging.warning("Method and Host filters drop the segments that continue a request; "
+                            "restart the daemon to turn header reassembly off")
+        self.filter_maps.apply(rules)
+        return True
+
+    def poll(self, timeout_ms):
+        """
+        Wait up to timeout_ms for packet events and decode what arrived.
+        """
+        self.source.poll(timeout_ms)
+        self.stages.lap("poll")
+        self.flush_packet_events()
+        self.flush_cookie_events()
+        if self.reassembler is not None:
+            self.reassembler.expire()
+        if self.sampler:
+            self.sampler.update()
+        self.stages.lap("decode")
+
+    def flush_packet_events(self):
+        """
+        Decode the buffered event records and process them.
+        """
+        if self.decoder.count == 0:
+            return
+        self.process_packet_batch(self.decoder.decode())
 
-            current_count = value.value
-            logging.info(f"Current count for {src_ip}: {current_count}")
+    def process_packet_batch(self, batch):
+        """
+        Append a decoded batch to the capture ring and feed it to flow
+        tracking and cookie analytics.
+        """
+        try:
+            if self.print_packets:
+                self.print_packet_batch(batch.records())
+            if self.flows is not None:
+                self.flows.update(batch.raw, sample_rate=self.source.sample_rate)
+            if self.export_packets:
+                self.capture_ring.extend(batch.rows(self.intern))
+                self.latest_packet = self.capture_ring.latest().to_dict()
+            else:
+                self.latest_packet = PacketBatch(batch.raw[-1:]).records()[0]
+            if self.archive is not None:
+                self.archive.append(batch.raw)
+            if self.parse_cookies:
+                if self.reassembler is not None:
+                    self.analytics.add_payloads(*self.reassembler.add(batch.raw, batch.payloads()))
+                else:
+                    self.analytics.add_packets(batch.raw)
+        except Exception as e:
+            logging.error(f"Error processing packet events: {e}")
+            return
+
+        self.total_packet_count += len(batch)
+
+    def flush_cookie_events(self):
+        """
+        Decode the buffered cookie records into rows waiting to be shipped.
+        When the daemon cannot keep up, the oldest rows are dropped.
+        """
+        if self.cookie_decoder.count == 0:
+            return
+        self.process_cookie_batch(self.cookie_decoder.decode())
 
-            # Compute delta
-            previous_count = self.local_packet_cache.get(src_ip, 0)
-            delta = current_count - previous_count
-            deltas[src_ip] = delta
+    def process_cookie_batch(self, batch):
+        try:
+            if self.analytics:
+                self.analytics.add_cookie_batch(batch)
+            rows = list(batch.rows(self.intern))
+        except Exception as e:
+            logging.error(f"Error processing cookie events: {e}")
+            return
+        pending = self.pending_cookies
+        self.cookies_dropped += max(0, len(pending) + len(rows) - pending.maxlen)
+        pending.extend(rows)
+
+    def take_sketches(self):
+        """
+        Close the cookie analytics window when it is due and return the
+        snapshots waiting to be shipped.
+        """
+        if self.analytics:
+            snapshot = self.analytics.maybe_snapshot()
+            if snapshot:
+                self.pending_sketches.append(snapshot)
+        sketches = self.pending_sketches
+        self.pending_sketches = []
+        return sketches
+
+    def expire_flows(self, final=False):
+        """
+        End idle and long-running flows and move the ended ones to the rows
+        waiting to be shipped. final ends every flow. When the daemon cannot
+        keep up, the oldest rows are dropped.
+        """
+        if final and self.workers is not None:
+            # Workers end their own flows as they stop
+            self.workers.stop()
+        if self.flows is None:
+            return
+        if final:
+            self.flows.flush()
+        else:
+            self.flows.expire()
+        self.queue_flows(self.flows.take())
+
+    def queue_flows(self, rows):
+        pending = self.pending_flows
+        self.flows_dropped += max(0, len(pending) + len(rows) - pending.maxlen)
+        pending.extend(rows)
+
+    def handle_worker_stats(self, stats, previous):
+        """
+        Count a worker's events as received here, so metrics and the
+        sampler see the whole pool.
+        """
+        self.decoder.received_records += stats["events"] - previous.get("events", 0)
+        self.decoder.received_bytes += stats["event_bytes"] - previous.get("event_bytes", 0)
+        self.cookie_decoder.received_records += stats["cookie_events"] - previous.get("cookie_events", 0)
+        self.cookie_decoder.received_bytes += stats["cookie_event_bytes"] - previous.get("cookie_event_bytes", 0)
+        if not self.export_packets and stats["latest"] is not None:
+            self.latest_packet = PacketBatch(stats["latest"]).records()[0]
+
+    def take_flows(self):
+        flows = list(self.pending_flows)
+        self.pending_flows.clear()
+        return flows
+
+    def take_cookies(self):
+        cookies = list(self.pending_cookies)
+        self.pending_cookies.clear()
+        return cookies
+
+    def transport_bytes_per_event(self):
+        """
+        Average bytes of packet and cookie records per packet event.
+        """
+        records = self.decoder.received_records
+        if not records:
+            return 0.0
+        return (self.decoder.received_bytes + self.cookie_decoder.received_bytes) / records
+
+    def print_packet_batch(self, records):
+        for p in records:
+            print("=== Full TCP/IP Packet ===")
+            print(f"Packet Length: {p['packet_len']} bytes")
+            print(f"Source IP: {p['src_ip']}:{p['src_port']}")
+            print(f"Dest IP: {p['dst_ip']}:{p['dst_port']}")
+            print(f"Protocol: {p['protocol']}")
+            print(f"Seq Number: {p['seq_num']}, Ack Number: {p['ack_num']}")
+            print(f"TCP Flags: {p['tcp_flags']:08b}")
+            if p["http_data_len"] > 0:
+                print(f"HTTP Content ({p['http_data_len']} bytes):\n{p['http_data']}")
 
-            # Update the local cache
-            self.local_packet_cache[src_ip] = current_count
+    def get_packet_deltas(self):
+        """
+        Compute packet count deltas since the last poll, for the sources
+        whose count changed.
+        """
+        if self.packet_count_map is not None:
+            keys, counts = read_bpf_counts(self.packet_count_map)
+        else:
+            keys, counts = read_counter_dict(self.source.packet_counts)
 
-        return deltas
+        keys, deltas = self.source_counts.update(keys, counts)
+        return dict(zip(ip_to_str(keys).tolist(), deltas.tolist()))
 
-    def log_packet_statistics(self):
+    def log_packet_statistics(self, top=10):
         """
-        Log cumulative packet statistics.
+        Log cumulative packet statistics for the busiest sources.
         """
-        logging.info("Cumulative Packet Counts:")
-        for ip, count in self.local_packet_cache.items():
+        counts = self.source_counts
+        logging.info(f"Cumulative Packet Counts ({len(counts)} sources tracked):")
+        busiest = np.argsort(counts.counts)[::-1][:top]
+        for ip, count in zip(ip_to_str(counts.keys[busiest]).tolist(), counts.counts[busiest].tolist()):
             logging.info(f"  {ip}: {count} packets")
 
+    def collect_metrics(self):
+        """
+        Kernel program counters, summed over CPUs, and the capture
+        pipeline's own counters.
+        """
+        metrics = []
+        if self.stats_map is not None:
+            for name, value in read_bpf_stats(self.stats_map).items():
+                metrics.append(Metric(f"xdp_{name}_total", "counter", _KERNEL_STAT_HELP[name], value))
+        metrics += [
+            Metric("source_packets_total", "counter", "Packets counted per source, summed", self.source_counts.total),
+            Metric("sources_tracked", "gauge", "Sources in the last packet count snapshot", len(self.source_counts)),
+            Metric("events_received_total", "counter", "Packet events received from the kernel",
+                   self.decoder.received_records),
+            Metric("event_bytes_received_total", "counter", "Bytes of packet events received",
+                   self.decoder.received_bytes),
+            Metric("cookie_events_received_total", "counter", "Cookie records received",
+                   self.cookie_decoder.received_records),
+            Metric("capture_ring_overflow_total", "counter", "Packets dropped from the capture ring before shipping",
+                   self.capture_ring.overflow_count),
+            Metric("cookies_dropped_total", "counter", "Cookie rows dropped before shipping", self.cookies_dropped),
+            Metric("flows_dropped_total", "counter", "Flow records dropped before shipping", self.flows_dropped),
+            Metric("sample_rate", "gauge", "Payload packets sent to userspace are 1 in this many",
+                   self.source.sample_rate),
+            Metric("perf_lost_events_total", "counter", "Events lost to full perf buffers, by CPU (-1: unknown)",
+                   {(("cpu", cpu),): count for cpu, count in sorted(self.source.lost_counts().items())}),
+            Metric("loop_stage_seconds", "histogram", "Time spent in each stage of the main loop",
+                   {(("stage", stage),): histogram for stage, histogram in self.stages.histograms.items()}),
+        ]
+        workers = self.workers
+        reassembly = None
+        if self.reassembler is not None:
+            reassembly = self.reassembler.counters()
+        elif workers is not None and any("reassembly" in stats for stats in workers.stats):
+            reassembly = Counter()
+            for stats in workers.stats:
+                reassembly.update(stats.get("reassembly", {}))
+        if reassembly is not None:
+            for name, (metric, kind, help_text) in _REASSEMBLY_METRICS.items():
+                metrics.append(Metric(metric, kind, help_text, reassembly[name]))
+        if self.intern is not None:
+            dedup = self.intern.counters()
+            for name, (metric, kind, help_text) in _DEDUP_METRICS.items():
+                metrics.append(Metric(metric, kind, help_text, dedup[name]))
+        if self.flows is not None:
+            metrics += [
+                Metric("flows_active", "gauge", "Flows open in the flow table", len(self.flows)),
+                Metric("flows_evicted_total", "counter", "Flows ended early because the flow table was full",
+                       self.flows.evicted),
+            ]
+        elif workers is not None and workers.options.get("flows") is not None:
+            metrics += [
+                Metric("flows_active", "gauge", "Flows open in the flow tables", workers.total("flows_active")),
+                Metric("flows_evicted_total", "counter", "Flows ended early because a flow table was full",
+                       workers.total("flows_evicted")),
+            ]
+        if self.archive is not None:
+            archive = self.archive
+            metrics += [
+                Metric("archive_events_total", "counter", "Packet events written to the archive", archive.events),
+                Metric("archive_payload_bytes_total", "counter", "Payload bytes written to the archive",
+                       archive.bytes_written),
+                Metric("archive_segments", "gauge", "Segments in the archive", archive.segment_count),
+                Metric("archive_disk_bytes", "gauge", "Disk space used by the archive", archive.disk_bytes),
+                Metric("archive_segments_removed_total", "counter", "Segments deleted by archive retention",
+                       archive.segments_removed),
+                Metric("archive_segments_compacted_total", "counter", "Segments merged or shrunk by compaction",
+                       archive.segments_compacted),
+            ]
+        if workers is not None:
+            def per_worker(name):
+                return {(("worker", str(index)),): stats.get(name, 0) for index, stats in enumerate(workers.stats)}
+            metrics += [
+                Metric("worker_events_total", "counter", "Packet events drained by each worker",
+                       per_worker("events")),
+                Metric("worker_event_bytes_total", "counter", "Bytes of packet events drained by each worker",
+                       per_worker("event_bytes")),
+                Metric("worker_handoff_dropped_total", "counter",
+                       "Packets a worker dropped because its shared memory slots were full",
+                       per_worker("handoff_dropped")),
+            ]
+        return metrics
+
     def cleanup(self):
-        self.bpf.remove_xdp(self.interface, 0)
-        self.bpf.cleanup()
+        self.source.close()
+        if self.archive is not None:
+            self.archive.close()
+        if self.bpf:
+            self.bpf.remove_xdp(self.interface, 0)
+            self.bpf.cleanup()
     def print_trace_log(self):
         try:
             trace_pipe = open("/sys/kernel/debug/tracing/trace_pipe", "rb")
@@ -194,59 +596,183 @@ class PacketAnalyzer:
         except KeyboardInterrupt:
             trace_pipe.close()
 
+def exporter_metrics(exporter):
+   return [
+       Metric("export_batches_sent_total", "counter", "Batches accepted by the dashboard", exporter.batches_sent),
+       Metric("export_batches_failed_total", "counter", "Batches that failed after all retries",
+              exporter.batches_failed),
+       Metric("export_batches_rejected_total", "counter", "Batches the dashboard rejected",
+              exporter.batches_rejected),
+       Metric("export_bytes_sent_total", "counter", "Request bytes posted to the dashboard", exporter.bytes_sent),
+       Metric("export_flows_dropped_total", "counter", "Flow records dropped with failed batches",
+              exporter.flows_dropped),
+       Metric("export_blobs_sent_total", "counter", "Payload bodies sent along with their digests",
+              exporter.blobs_sent),
+       Metric("export_blob_bytes_sent_total", "counter", "Characters of payload bodies sent",
+              exporter.blob_bytes_sent),
+       Metric("export_blobs_missing_total", "counter", "Digests the dashboard had no body for",
+              exporter.blobs_missing),
+       Metric("export_queue_depth", "gauge", "Submissions waiting for the exporter thread", exporter.queue.qsize()),
+       Metric("export_post_seconds", "histogram", "Time to post one batch, retries included",
+              exporter.post_latency),
+   ]
+
+def prebuild():
+   """
+   Compile, verify and pin the XDP program so the next daemon start is warm.
+   """
+   cache = BPFBuildCache(config.get("bpf_cache_dir", DEFAULT_CACHE_DIR))
+   key, loaded = cache.prebuild(config["ebpf_program"], bpf_cflags(), str(config["function_name"]))
+   state = "already cached" if loaded.warm else "built"
+   logging.info(f"BPF program {key} {state} in {loaded.seconds:.2f}s")
+
 def main():
+   parser = argparse.ArgumentParser(description="eBPF cookie filtering daemon")
+   parser.add_argument("command", nargs="?", choices=("run", "prebuild"), default="run",
+                       help="run the daemon (default) or only populate the BPF build cache")
+   args = parser.parse_args()
+   if args.command == "prebuild":
+       prebuild()
+       return
+
    analyzer = PacketAnalyzer()
    analyzer.attach()
-   api_url = config["dashboard_api_url"]
+   export_batch_size = config.get("export_batch_size", 5000)
+   # Prefer the bulk ingest endpoint when the dashboard exposes one
+   ingest_url = config.get("dashboard_ingest_url")
+   exporter = DashboardExporter(
+       ingest_url or config["dashboard_api_url"],
+       on_ack=analyzer.capture_ring.ack,
+       on_failure=analyzer.capture_ring.rewind,
+       compression=config.get("export_compression", "gzip"),
+       columnar=ingest_url is not None,
+       max_batch_packets=export_batch_size,
+       flush_interval=config.get("export_flush_interval", 1.0),
+       queue_size=config.get("export_queue_size", 64),
+       max_retries=config.get("export_max_retries", 5),
+       intern=analyzer.intern,
+   )
+   exporter.start()
+   # Only the capture filters are reloaded when config.yaml changes; other
+   # settings need a restart
+   config_watcher = ConfigWatcher(interval=config.get("config_reload_interval", 2.0))
    
+   metrics_server = None
+   if config.get("metrics_port"):
+       metrics_server = MetricsServer(lambda: analyzer.collect_metrics() + exporter_metrics(exporter),
+                                      host=config.get("metrics_host", "0.0.0.0"),
+                                      port=int(config["metrics_port"]))
+       metrics_server.start()
+
+   # The trace pipe only carries output from DEBUG_TRACE builds
    from threading import Thread
-   trace_thread = Thread(target=analyzer.print_trace_log, daemon=True)
-   trace_thread.start()
-   try:
-       while True:
+   if analyzer.source.live and config.get("debug_trace", False):
+       trace_thread = Thread(target=analyzer.print_trace_log, daemon=True)
+       trace_thread.start()
+   recent_deltas = Counter()
+   exported_total = None
+
+   def reload_config(now):
+       reloaded = config_watcher.poll(now)
+       if reloaded is not None:
+           analyzer.apply_filters(reloaded.get("filters"))
+
+   def poll_maps(now):
+       # Per-source deltas accumulate until the next stats log
+       recent_deltas.update(analyzer.get_packet_deltas())
+
+   def log_stats(now):
+       if terminal_ui:
            clear_terminal()
-           analyzer.bpf.perf_buffer_poll(timeout=100)
-           
-           if analyzer.latest_packet:
-               p = analyzer.latest_packet
-               logging.info("Packet Details:")
-               logging.info(f"  Protocol: {p['protocol']}")
-               logging.info(f"  Source IP: {p['src_ip']}")
-               logging.info(f"  Destination IP: {p['dst_ip']}")
-               logging.info(f"  Source Port: {p['src_port']}")
-               logging.info(f"  Destination Port: {p['dst_port']}")
-               logging.info(f"  Packet Length: {p['packet_len']} bytes")
-               if p['packet_type'] == 0:
-                   logging.info(f"  Seq Num: {p['seq_num']}, Ack Num: {p['ack_num']}")
-                   logging.info(f"  TCP Flags: {p['tcp_flags']}")
-
-               logging.info("\n[HTTP Data]")
-               logging.info(f"HTTP Data Length: {p['http_data_len']}")
-               logging.info(f"HTTP Content:{p['http_data']}")
-               logging.info("---")
-
-           deltas = analyzer.get_packet_deltas()
-           for ip, delta in deltas.items():
-               if delta > 0:
-                   logging.info(f"IP: {ip}, New Packets: {delta}")
-
-           total_packets = sum(analyzer.local_packet_cache.values())
-           if total_packets > 0:
-               formatted_count = helpers.format_packet_count(total_packets)
-               logging.info(f"Total Packets: {formatted_count}")
-
-               data = {"count": total_packets, "packets": analyzer.captured_packets}
-               try:
-                   response = requests.post(api_url, json=data)
-                   if response.status_code != 201:
-                       logging.error(f"Failed to send data to dashboard: {response.text}")
-               except requests.exceptions.RequestException as e:
-                   logging.error(f"Error connecting to dashboard API: {e}")
-
-           time.sleep(100)
+       if analyzer.latest_packet:
+           p = analyzer.latest_packet
+           logging.info("Packet Details:")
+           logging.info(f"  Protocol: {p['protocol']}")
+           logging.info(f"  Source IP: {p['src_ip']}")
+           logging.info(f"  Destination IP: {p['dst_ip']}")
+           logging.info(f"  Source Port: {p['src_port']}")
+           logging.info(f"  Destination Port: {p['dst_port']}")
+           logging.info(f"  Packet Length: {p['packet_len']} bytes")
+           if p['packet_type'] == 0:
+               logging.info(f"  Seq Num: {p['seq_num']}, Ack Num: {p['ack_num']}")
+               logging.info(f"  TCP Flags: {p['tcp_flags']}")
+
+           logging.info("\n[HTTP Data]")
+           logging.info(f"HTTP Data Length: {p['http_data_len']}")
+           logging.info(f"HTTP Content:{p['http_data']}")
+           logging.info("---")
+
+       if recent_deltas:
+           logging.info(f"{len(recent_deltas)} sources sent new packets")
+       for ip, delta in recent_deltas.most_common(10):
+           logging.info(f"IP: {ip}, New Packets: {delta}")
+       recent_deltas.clear()
+
+       total_packets = analyzer.source_counts.total
+       if total_packets > 0:
+           formatted_count = helpers.format_packet_count(total_packets)
+           logging.info(f"Total Packets: {formatted_count}")
+           if analyzer.decoder.received_records:
+               logging.info(f"Transport: {analyzer.transport_bytes_per_event():.0f} bytes/event "
+                            f"({PACKET_INFO_DTYPE.itemsize} for a full-size record)")
+       ring = analyzer.capture_ring
+       if ring.overflow_count:
+           logging.warning(f"Capture ring overflowed, {ring.overflow_count} packets dropped before shipping")
+       if analyzer.cookies_dropped:
+           logging.warning(f"{analyzer.cookies_dropped} cookie records dropped before shipping")
+       if analyzer.flows_dropped:
+           logging.warning(f"{analyzer.flows_dropped} flow records dropped before shipping")
+       if analyzer.workers is not None:
+           rates = analyzer.workers.rates(now)
+           logging.info("Worker events/sec: " + ", ".join(f"{index}: {rate:.0f}" for index, rate in enumerate(rates)))
+           dropped = analyzer.workers.total("handoff_dropped")
+           if dropped:
+               logging.warning(f"{dropped} packets dropped in the hand-off from workers")
+       lost = sum(analyzer.source.lost_counts().values())
+       if lost:
+           logging.warning(f"{lost} events lost to full perf buffers")
+
+   def export(now):
+       # Hand only new packets to the exporter thread; while it is backed
+       # up they wait in the capture ring instead.
+       nonlocal exported_total
+       if not exporter.ready():
+           return
+       total_packets = analyzer.source_counts.total
+       ring = analyzer.capture_ring
+       generation, pending = ring.take(export_batch_size)
+       cookies, sketches, flows = analyzer.take_cookies(), analyzer.take_sketches(), analyzer.take_flows()
+       if pending or cookies or sketches or flows or total_packets != exported_total:
+           exporter.submit(generation, total_packets, ring.overflow_count, pending, cookies, sketches,
+                           sample_rate=analyzer.source.sample_rate, flows=flows)
+           exported_total = total_packets
+
+   # Events are drained as they arrive; everything else runs on its own timer
+   terminal_ui = config.get("terminal_ui", False)
+   scheduler = Scheduler(analyzer.poll, analyzer.stages, max_wait=config.get("poll_timeout_ms", 100) / 1000)
+   scheduler.every("config", config.get("config_reload_interval", 2.0), reload_config)
+   scheduler.every("deltas", config.get("map_poll_interval", 1.0), poll_maps)
+   if analyzer.flows is not None:
+       scheduler.every("flows", 1.0, lambda now: analyzer.expire_flows())
+   if analyzer.archive is not None:
+       # Rotation by age, retention and compaction; the latter two run in
+       # the background
+       scheduler.every("archive", analyzer.archive_interval, lambda now: analyzer.archive.maintain(), start=0)
+   scheduler.every("export", config.get("export_interval", 0.5), export)
+   scheduler.every("log", config.get("stats_interval", 5.0), log_stats)
+   try:
+       scheduler.run()
    except KeyboardInterrupt:
        logging.info("Stopping packet analyzer daemon.")
    finally:
+       if metrics_server:
+           metrics_server.stop()
+       # Ship the flows still open as records ended by the shutdown
+       analyzer.expire_flows(final=True)
+       if analyzer.pending_flows:
+           exporter.submit(exporter.generation, analyzer.source_counts.total, analyzer.capture_ring.overflow_count,
+                           [], sample_rate=analyzer.source.sample_rate, flows=analyzer.take_flows())
+       exporter.stop()
        analyzer.cleanup()
 
 
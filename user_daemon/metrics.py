@@ -0,0 +1,88 @@
+import logging
+import threading
+from collections import namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "cookie_filter_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# kind is "counter", "gauge" or "histogram". value is a number, or a
+# LatencyHistogram for histograms, or a dict of either keyed by label
+# dicts given as tuples of (label, value) pairs.
+Metric = namedtuple("Metric", ["name", "kind", "help", "value"])
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in pairs) + "}"
+
+
+def render(metrics):
+    """
+    Format metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in metrics:
+        name = PREFIX + metric.name
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        series = metric.value if isinstance(metric.value, dict) else {(): metric.value}
+        for labels, value in series.items():
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            for bound, count in value.buckets():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels((*labels, ('le', le)))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {value.sum}")
+            lines.append(f"{name}_count{_labels(labels)} {value.count}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves `collect()` on /metrics from a background thread. collect is
+    called on that thread for every scrape, so it should only read
+    counters, not change them.
+    """
+
+    def __init__(self, collect, host="0.0.0.0", port=9101):
+        self.collect = collect
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+
+    def _handler(self):
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(collect()).encode()
+                except Exception as e:
+                    logging.error(f"Error collecting metrics: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
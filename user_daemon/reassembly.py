@@ -0,0 +1,196 @@
+import time
+from collections import OrderedDict
+
+from cookies import REQUEST_METHODS
+
+HEADER_END = b"\r\n\r\n"
+
+# TCP sequence numbers wrap at 2**32
+_SEQ_MASK = 0xFFFFFFFF
+_SEQ_HALF = 1 << 31
+
+
+class _Stream:
+    __slots__ = ("next_seq", "data", "pending", "pending_bytes", "last_seen")
+
+    def __init__(self, next_seq, data, now):
+        self.next_seq = next_seq
+        self.data = data  # bytearray, in sequence order up to next_seq
+        self.pending = {}  # seq -> payload of segments after a hole
+        self.pending_bytes = 0
+        self.last_seen = now
+
+    @property
+    def size(self):
+        return len(self.data) + self.pending_bytes
+
+
+class HeaderReassembler:
+    """
+    Stitches HTTP request headers that span several TCP segments back
+    together, per (src_ip, dst_ip, src_port, dst_port) flow.
+
+    A stream starts at a segment that begins with a request method and
+    collects payload in sequence order, holding out-of-order segments until
+    the hole before them is filled, until the blank line that ends the
+    headers; the header block is then emitted and the stream dropped.
+    Requests whose headers fit in one segment are emitted without being
+    buffered. Segments of flows without an open stream (request bodies,
+    responses) are ignored.
+
+    Memory is bounded per stream by `max_header_bytes`, beyond which the
+    stream is dropped as oversized, and overall by `max_bytes` and
+    `max_streams`, beyond which the least recently updated streams are
+    evicted. Streams not updated for `timeout` seconds are dropped by
+    expire(); those still waiting on a hole are counted as gaps.
+    """
+
+    def __init__(self, max_header_bytes=16384, max_bytes=16 * 1024 * 1024, max_streams=4096, timeout=10.0,
+                 clock=time.monotonic):
+        self.max_header_bytes = max_header_bytes
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.timeout = timeout
+        self.clock = clock
+        self.streams = OrderedDict()  # Least recently updated first
+        self.buffered_bytes = 0
+        self.completed = 0
+        self.reassembled = 0  # Completed blocks that spanned several segments
+        self.gaps = 0
+        self.evictions = 0
+        self.timeouts = 0
+        self.oversized = 0
+
+    def __len__(self):
+        return len(self.streams)
+
+    def add(self, raw, payloads, now=None):
+        """
+        Feed a batch of PACKET_INFO_DTYPE records and their payloads.
+        Returns the source addresses and header blocks completed by it.
+        """
+        now = self.clock() if now is None else now
+        src_ips, blocks = [], []
+        columns = (raw["src_ip"].tolist(), raw["dst_ip"].tolist(), raw["src_port"].tolist(),
+                   raw["dst_port"].tolist(), raw["seq_num"].tolist())
+        for src_ip, dst_ip, src_port, dst_port, seq, payload in zip(*columns, payloads):
+            if not payload:
+                continue
+            block = self.add_segment((src_ip, dst_ip, src_port, dst_port), src_ip, seq, payload, now)
+            if block is not None:
+                src_ips.append(src_ip)
+                blocks.append(block)
+        if self.buffered_bytes > self.max_bytes or len(self.streams) > self.max_streams:
+            self._evict()
+        return src_ips, blocks
+
+    def add_segment(self, key, src_ip, seq, payload, now):
+        """
+        Add one segment's payload. Returns the header block it completes, if
+        any.
+        """
+        stream = self.streams.get(key)
+        if stream is None:
+            if payload[:4] not in REQUEST_METHODS:
+                return None
+            end = payload.find(HEADER_END)
+            if end >= 0:
+                self.completed += 1
+                return payload[:end + len(HEADER_END)]
+            stream = _Stream((seq + len(payload)) & _SEQ_MASK, bytearray(payload), now)
+            self.streams[key] = stream
+            self.buffered_bytes += len(payload)
+            return self._check_size(key, stream)
+
+        stream.last_seen = now
+        self.streams.move_to_end(key)
+        offset = (seq - stream.next_seq) & _SEQ_MASK
+        if offset >= _SEQ_HALF:
+            # Starts before next_seq: a retransmission, keep any new tail
+            offset = _SEQ_MASK + 1 - offset
+            if offset >= len(payload):
+                return None
+            payload = payload[offset:]
+        elif offset > 0:
+            if payload[:4] in REQUEST_METHODS:
+                # The next request on the connection: the rest of this one
+                # was lost
+                self.gaps += 1
+                self._drop(key)
+                return self.add_segment(key, src_ip, seq, payload, now)
+            if seq not in stream.pending:
+                stream.pending[seq] = payload
+                stream.pending_bytes += len(payload)
+                self.buffered_bytes += len(payload)
+            return self._check_size(key, stream)
+
+        scan_from = max(0, len(stream.data) - len(HEADER_END) + 1)
+        self._append(stream, payload)
+        while stream.pending:
+            following = stream.pending.pop(stream.next_seq, None)
+            if following is None:
+                break
+            stream.pending_bytes -= len(following)
+            self.buffered_bytes -= len(following)
+            self._append(stream, following)
+
+        end = stream.data.find(HEADER_END, scan_from)
+        if end >= 0:
+            self._drop(key)
+            self.completed += 1
+            self.reassembled += 1
+            return bytes(stream.data[:end + len(HEADER_END)])
+        return self._check_size(key, stream)
+
+    def expire(self, now=None):
+        """
+        Drop the streams not updated for `timeout` seconds.
+        """
+        now = self.clock() if now is None else now
+        cutoff = now - self.timeout
+        while self.streams:
+            key, stream = next(iter(self.streams.items()))
+            if stream.last_seen > cutoff:
+                break
+            self.timeouts += 1
+            if stream.pending:
+                self.gaps += 1
+            self._drop(key)
+
+    def counters(self):
+        """
+        Cumulative counters and current buffer use, for metrics.
+        """
+        return {
+            "completed": self.completed,
+            "reassembled": self.reassembled,
+            "gaps": self.gaps,
+            "evictions": self.evictions,
+            "timeouts": self.timeouts,
+            "oversized": self.oversized,
+            "streams": len(self.streams),
+            "buffered_bytes": self.buffered_bytes,
+        }
+
+    def _append(self, stream, payload):
+        stream.data += payload
+        stream.next_seq = (stream.next_seq + len(payload)) & _SEQ_MASK
+        self.buffered_bytes += len(payload)
+
+    def _check_size(self, key, stream):
+        if stream.size > self.max_header_bytes:
+            self.oversized += 1
+            self._drop(key)
+        return None
+
+    def _evict(self):
+        while self.streams and (self.buffered_bytes > self.max_bytes or len(self.streams) > self.max_streams):
+            key, stream = next(iter(self.streams.items()))
+            self.evictions += 1
+            if stream.pending:
+                self.gaps += 1
+            self._drop(key)
+
+    def _drop(self, key):
+        stream = self.streams.pop(key)
+        self.buffered_bytes -= stream.size
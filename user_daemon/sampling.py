@@ -0,0 +1,64 @@
+import logging
+import math
+import time
+
+
+class SamplingController:
+    """
+    Adjusts the XDP program's 1-in-N sampling rate so that the daemon
+    receives at most `target_events_per_sec` events and spends at most
+    `cpu_budget` of one core.
+
+    Every `interval` seconds it estimates the offered event rate (events
+    received times the current N) and the CPU cost per received event, and
+    picks the smallest N that satisfies both budgets. N rises immediately
+    when over budget but at most halves per interval, so short lulls do not
+    flood the pipeline.
+
+    `events` is a callable returning the cumulative number of events
+    received, and `cpu_clock` the CPU seconds spent on them, this process's
+    by default; the rate is applied with source.set_sample_rate().
+    """
+
+    def __init__(self, source, events, target_events_per_sec=20000, cpu_budget=0.5,
+                 max_rate=1024, interval=1.0, clock=time.monotonic, cpu_clock=time.process_time):
+        self.source = source
+        self.events = events
+        self.target_events_per_sec = target_events_per_sec
+        self.cpu_budget = cpu_budget
+        self.max_rate = max_rate
+        self.interval = interval
+        self.clock = clock
+        self.cpu_clock = cpu_clock
+        self.rate = source.sample_rate
+        self._last = (clock(), cpu_clock(), events())
+
+    def update(self):
+        """
+        Re-evaluate the rate once per interval. Returns the current rate.
+        """
+        now, cpu, events = self.clock(), self.cpu_clock(), self.events()
+        last_now, last_cpu, last_events = self._last
+        elapsed = now - last_now
+        if elapsed < self.interval:
+            return self.rate
+        self._last = (now, cpu, events)
+
+        received = events - last_events
+        if received <= 0:
+            wanted = 1
+        else:
+            offered = received * self.rate / elapsed
+            cpu_per_event = (cpu - last_cpu) / received
+            affordable = self.target_events_per_sec
+            if self.cpu_budget and cpu_per_event > 0:
+                affordable = min(affordable, self.cpu_budget / cpu_per_event)
+            wanted = math.ceil(offered / affordable) if affordable > 0 else self.max_rate
+
+        rate = max(wanted, math.ceil(self.rate / 2))
+        rate = min(max(rate, 1), self.max_rate)
+        if rate != self.rate:
+            logging.info(f"Sampling 1 in {rate} payload packets (was 1 in {self.rate})")
+            self.rate = rate
+            self.source.set_sample_rate(rate)
+        return self.rate
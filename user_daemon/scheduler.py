@@ -0,0 +1,73 @@
+import logging
+import time
+
+
+class Timer:
+    __slots__ = ("name", "interval", "callback", "due")
+
+    def __init__(self, name, interval, callback, due):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.due = due
+
+
+class Scheduler:
+    """
+    Drives the daemon: waits on the event source, which epolls the perf or
+    ring buffer fds, for as long as the next timer allows, so events are
+    drained as they arrive, then runs the timers that are due.
+
+    Timers run on the polling thread between polls, so they never overlap
+    each other or event handling; a slow timer delays the next drain rather
+    than racing it. A timer that falls behind runs once and is rescheduled
+    from the current time instead of catching up. Each poll and timer is
+    timed in `stages` (a StageTimer) under its name.
+    """
+
+    def __init__(self, poll, stages, max_wait=0.1, clock=time.monotonic):
+        self.poll = poll
+        self.stages = stages
+        self.max_wait = max_wait
+        self.clock = clock
+        self.timers = []
+        self._running = False
+
+    def every(self, name, interval, callback, start=None):
+        """
+        Run callback(now) every `interval` seconds, first at `start` (after
+        one interval by default).
+        """
+        if interval <= 0:
+            raise ValueError(f"{name} interval must be positive, got {interval}")
+        start = self.clock() + interval if start is None else start
+        self.timers.append(Timer(name, interval, callback, start))
+
+    def run_once(self):
+        now = self.clock()
+        wait = self.max_wait
+        for timer in self.timers:
+            wait = min(wait, timer.due - now)
+        self.stages.start()
+        self.poll(max(0, int(wait * 1000)))
+
+        now = self.clock()
+        for timer in self.timers:
+            if now < timer.due:
+                continue
+            timer.due += timer.interval
+            if timer.due <= now:
+                timer.due = now + timer.interval
+            try:
+                timer.callback(now)
+            except Exception as e:
+                logging.error(f"Error in {timer.name} timer: {e}")
+            self.stages.lap(timer.name)
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
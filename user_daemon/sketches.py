@@ -0,0 +1,366 @@
+import time
+
+import numpy as np
+
+from decoder import COOKIE_VALUE_PREFIX, ip_to_str
+from header_parser import parse_headers, parse_packet_headers
+
+_LABEL_LEN = 64
+
+# Odd multipliers for the multiply-shift hashes of the Count-Min rows
+_CMS_SEEDS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+                       0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+                       0x94D049BB133111EB, 0xBF58476D1CE4E5B9], dtype=np.uint64)
+
+
+def mix64(values):
+    """
+    Finalizer of splitmix64, spreading 64-bit ids over all bits so their
+    leading bits can index sketch registers.
+    """
+    x = np.asarray(values, dtype=np.uint64).copy()
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+
+def _hll_estimate(registers):
+    """
+    HyperLogLog estimate for each row of a (rows, m) register matrix, with
+    linear counting for small cardinalities.
+    """
+    m = registers.shape[-1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m * m / np.exp2(-registers.astype(np.float64)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class HyperLogLog:
+    """
+    Distinct counts for `rows` independent sets at once, in rows * 2**precision
+    bytes.
+    """
+
+    def __init__(self, precision=12, rows=1):
+        self.precision = precision
+        self.registers = np.zeros((rows, 1 << precision), dtype=np.uint8)
+
+    def add(self, hashes, rows=0):
+        """
+        Add 64-bit hashes (already mixed) to the sets given by `rows`.
+        """
+        if not len(hashes):
+            return
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - p)) - 1)
+        # Rank of the leftmost 1-bit in the remaining 64 - p bits
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        rank = (64 - p + 1 - bit_length).astype(np.uint8)
+        np.maximum.at(self.registers, (rows, index), rank)
+
+    def estimate(self, rows=None):
+        registers = self.registers if rows is None else self.registers[rows]
+        return _hll_estimate(registers)
+
+    def reset(self, rows=None):
+        if rows is None:
+            self.registers[:] = 0
+        else:
+            self.registers[rows] = 0
+
+
+class CountMinSketch:
+    """
+    Frequency estimates for 64-bit ids in depth * width counters. Estimates
+    never undercount.
+    """
+
+    def __init__(self, width=4096, depth=4):
+        if width & (width - 1) or not 0 < depth <= len(_CMS_SEEDS):
+            raise ValueError("width must be a power of two and depth at most 8")
+        self.shift = np.uint64(64 - width.bit_length() + 1)
+        self.seeds = _CMS_SEEDS[:depth]
+        self.table = np.zeros((depth, width), dtype=np.uint64)
+
+    def _columns(self, ids):
+        return ((ids[None, :] * self.seeds[:, None]) >> self.shift).astype(np.intp)
+
+    def add(self, ids, counts=None):
+        if not len(ids):
+            return
+        counts = np.ones(len(ids), dtype=np.uint64) if counts is None else counts.astype(np.uint64)
+        for row, columns in zip(self.table, self._columns(ids)):
+            np.add.at(row, columns, counts)
+
+    def estimate(self, ids):
+        columns = self._columns(np.asarray(ids, dtype=np.uint64))
+        return np.take_along_axis(self.table, columns, axis=1).min(axis=0)
+
+    def reset(self):
+        self.table[:] = 0
+
+
+class SpaceSaving:
+    """
+    Space-saving top-k: tracks at most `capacity` ids with an upper bound on
+    their count.
+
+    Batches are merged as summaries rather than one id at a time: ids not
+    yet tracked enter with their batch count plus the smallest tracked
+    count (as error), and the `capacity` largest entries of the union are
+    kept. Estimates stay upper bounds, as in the one-at-a-time algorithm.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.ids = np.zeros(capacity, dtype=np.uint64)
+        self.counts = np.zeros(capacity, dtype=np.uint64)
+        self.errors = np.zeros(capacity, dtype=np.uint64)
+        self.labels = [None] * capacity
+        self.size = 0
+
+    def update(self, ids, label_of=None):
+        """
+        Count a batch of ids. label_of(i) names ids[i] and is only called for
+        ids that enter the table. Returns (unique ids, their slots or -1 for
+        ids left out, slots recycled for new ids).
+        """
+        unique, first, counts = np.unique(ids, return_index=True, return_counts=True)
+        counts = counts.astype(np.uint64)
+        slots = np.full(len(unique), -1, dtype=np.intp)
+
+        size = self.size
+        order = np.argsort(self.ids[:size])
+        position = np.minimum(np.searchsorted(self.ids[:size], unique, sorter=order), max(size - 1, 0))
+        known = (self.ids[order[position]] == unique) if size else np.zeros(len(unique), dtype=bool)
+        slots[known] = order[position[known]]
+        self.counts[slots[known]] += counts[known]
+
+        new = np.flatnonzero(~known)
+        if not len(new):
+            return unique, slots, []
+        overflow = size + len(new) > self.capacity
+        floor = self.counts[:size].min() if overflow and size else np.uint64(0)
+
+        # Keep the `capacity` largest of the tracked entries and newcomers,
+        # preferring tracked ones on ties
+        union = np.concatenate([self.counts[:size], counts[new] + floor])
+        kept = np.sort(np.argsort(-union.astype(np.int64), kind="stable")[:self.capacity])
+        entering = new[kept[kept >= size] - size]
+        recycled = np.setdiff1d(np.arange(size), kept[kept < size]).tolist()
+        targets = list(range(size, self.capacity))[:len(entering)]
+        targets += recycled[:len(entering) - len(targets)]
+
+        for j, slot in zip(entering.tolist(), targets):
+            self.ids[slot] = unique[j]
+            self.counts[slot] = counts[j] + floor
+            self.errors[slot] = floor
+            self.labels[slot] = label_of(int(first[j])) if label_of else None
+            slots[j] = slot
+        self.size = max(size, max(targets, default=-1) + 1)
+        return unique, slots, recycled
+
+    def top(self, k):
+        """
+        Slots of the k largest entries, largest first.
+        """
+        order = np.argsort(self.counts[:self.size])[::-1]
+        return order[:k]
+
+    def reset(self):
+        self.counts[:] = 0
+        self.errors[:] = 0
+        self.labels = [None] * self.capacity
+        self.size = 0
+
+
+def _cookie_requests(src_ips, headers):
+    has_cookies = headers.cookie_count > 0
+    if not has_cookies.any():
+        return None
+    return np.asarray(src_ips, dtype=np.uint32)[has_cookies], headers.cookie_count[has_cookies], headers.pairs
+
+
+def parse_payloads(src_ips, payloads):
+    """
+    Parse the Cookie headers of a batch of HTTP payloads. Returns the source
+    address of each request that had cookies, its number of cookies and the
+    header_parser.CookiePairs of them all, or None when there were none.
+    """
+    return _cookie_requests(src_ips, parse_headers(payloads))
+
+
+def parse_packets(raw):
+    """
+    parse_payloads() for the payloads of PACKET_INFO_DTYPE records, read in
+    place.
+    """
+    return _cookie_requests(raw["src_ip"], parse_packet_headers(raw))
+
+
+class CookieAnalytics:
+    """
+    Streaming cookie statistics in fixed memory, reset every snapshot:
+
+    - distinct cookies (name=value pairs) overall, and per source for the
+      busiest `sources` sources, with HyperLogLog
+    - cookie name and name=value frequencies with a Count-Min sketch
+    - the `top_k` most frequent names and name=value pairs with
+      space-saving, whose counts are tightened with the Count-Min estimate
+
+    The busiest sources are themselves tracked with space-saving; a source
+    that is evicted gives its distinct-count registers to the newcomer.
+
+    Fed either from raw payloads, whose Cookie header is parsed here, or
+    from the cookie records of the EXTRACT_COOKIES build, which only carry
+    hashes and a value prefix; labels then show the name hash.
+    """
+
+    def __init__(self, sources=1024, top_k=100, precision=12, source_precision=8,
+                 cms_width=1 << 14, cms_depth=4, interval=10.0):
+        self.interval = interval
+        self.top_k = top_k
+        self.sources = SpaceSaving(sources)
+        self.source_distinct = HyperLogLog(source_precision, rows=sources)
+        self.distinct = HyperLogLog(precision)
+        self.frequencies = CountMinSketch(cms_width, cms_depth)
+        self.names = SpaceSaving(top_k * 2)
+        self.values = SpaceSaving(top_k * 2)
+        self.requests = 0
+        self.cookies = 0
+        self.window_start = time.time()
+
+    def add_payloads(self, src_ips, payloads):
+        """
+        Add the cookies of a batch of HTTP payloads, src_ips being the
+        packet_info source addresses of the same packets.
+        """
+        self.add_parsed(parse_payloads(src_ips, payloads))
+
+    def add_packets(self, raw):
+        """
+        Add the cookies of a batch of PACKET_INFO_DTYPE records.
+        """
+        self.add_parsed(parse_packets(raw))
+
+    def add_parsed(self, parsed):
+        """
+        Add cookies returned by parse_payloads(), possibly parsed in another
+        process.
+        """
+        if parsed is None:
+            return
+        request_src, counts, pairs = parsed
+        self.cookies += len(pairs)
+        name_hashes = pairs.name_hash.astype(np.uint64)
+        value_hashes = pairs.value_hash.astype(np.uint64)
+
+        def name_label(i):
+            return pairs.name(i)[:_LABEL_LEN].decode("utf-8", "replace")
+
+        def value_label(i):
+            return f"{name_label(i)}={pairs.value(i)[:_LABEL_LEN].decode('utf-8', 'replace')}"
+
+        self._add(request_src, np.repeat(np.arange(len(request_src)), counts),
+                  name_hashes, value_hashes, name_label, value_label)
+
+    def add_cookie_batch(self, batch):
+        """
+        Add a decoder.CookieBatch.
+        """
+        if not len(batch):
+            return
+        pairs = batch.pairs
+        self.cookies += len(pairs)
+        name_hashes = pairs["name_hash"].astype(np.uint64)
+        value_hashes = pairs["value_hash"].astype(np.uint64)
+
+        def name_label(i):
+            return f"#{int(name_hashes[i]):08x}"
+
+        def value_label(i):
+            pair = pairs[i]
+            value = pair["value"][:min(int(pair["value_len"]), COOKIE_VALUE_PREFIX)].decode("utf-8", "replace")
+            truncated = "..." if pair["value_len"] > COOKIE_VALUE_PREFIX else ""
+            return f"{name_label(i)}={value}{truncated}"
+
+        self._add(batch.raw["src_ip"], batch.record_index, name_hashes, value_hashes, name_label, value_label)
+
+    def _add(self, request_src, cookie_request, name_hashes, value_hashes, name_label, value_label):
+        self.requests += len(request_src)
+        pair_ids = (name_hashes << np.uint64(32)) | value_hashes
+        mixed = mix64(pair_ids)
+        self.distinct.add(mixed)
+
+        unique, slots, recycled = self.sources.update(request_src)
+        if recycled:
+            self.source_distinct.reset(recycled)
+        cookie_slots = slots[np.searchsorted(unique, request_src[cookie_request])]
+        kept = cookie_slots >= 0
+        self.source_distinct.add(mixed[kept], cookie_slots[kept])
+
+        name_ids = mix64(name_hashes)
+        self.frequencies.add(name_ids)
+        self.frequencies.add(mixed)
+        self.names.update(name_ids, name_label)
+        self.values.update(mixed, value_label)
+
+    def _top(self, tracker, key):
+        slots = tracker.top(self.top_k)
+        if not len(slots):
+            return []
+        counts = np.minimum(tracker.counts[slots], self.frequencies.estimate(tracker.ids[slots]))
+        order = np.argsort(counts, kind="stable")[::-1]
+        return [{key: tracker.labels[slot], "count": int(count)}
+                for slot, count in zip(slots[order].tolist(), counts[order].tolist())]
+
+    def snapshot(self, top_sources=20):
+        """
+        Summarize the current window.
+        """
+        source_slots = self.sources.top(top_sources)
+        src_ips = self.sources.ids[source_slots].astype(np.uint32)
+        distinct = self.source_distinct.estimate(source_slots) if len(source_slots) else []
+        return {
+            "window_start": self.window_start,
+            "window_end": time.time(),
+            "requests": self.requests,
+            "cookies": self.cookies,
+            "distinct_cookies": int(round(self.distinct.estimate()[0])),
+            "sources": [
+                {"src_ip": ip, "requests": int(requests), "distinct_cookies": int(round(estimate))}
+                for ip, requests, estimate in zip(ip_to_str(src_ips).tolist(),
+                                                  self.sources.counts[source_slots].tolist(), distinct)
+            ],
+            "top_names": self._top(self.names, "name"),
+            "top_values": self._top(self.values, "value"),
+        }
+
+    def reset(self):
+        self.sources.reset()
+        self.source_distinct.reset()
+        self.distinct.reset()
+        self.frequencies.reset()
+        self.names.reset()
+        self.values.reset()
+        self.requests = 0
+        self.cookies = 0
+        self.window_start = time.time()
+
+    def maybe_snapshot(self):
+        """
+        Return the snapshot of the window and start a new one once
+        `interval` seconds have passed, else None.
+        """
+        if time.time() - self.window_start < self.interval:
+            return None
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
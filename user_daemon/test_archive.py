@@ -0,0 +1,248 @@
+"""
+Tests for the event archive: segment layout, time lookups through the sparse
+index, payload offsets across compaction, retention and crash recovery.
+
+    cd user_daemon && python -m unittest test_archive
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import archive
+from archive import (PAGE_SIZE, PAYLOAD_SUFFIX, SEGMENT_SUFFIX, ArchiveReader, ArchiveWriter, Segment,
+                     list_segments, segment_layout)
+from decoder import PACKET_INFO_DTYPE
+
+
+def packets(count, first=0):
+    """
+    `count` packet events whose payload names their dst_port, first + i,
+    with every fifth one empty.
+    """
+    raw = np.zeros(count, dtype=PACKET_INFO_DTYPE)
+    raw["dst_port"] = np.arange(first, first + count)
+    for i in range(count):
+        if (first + i) % 5:
+            body = b"GET /%d HTTP/1.1\r\n\r\n" % (first + i)
+            raw[i]["http_data"] = body
+            raw[i]["http_data_len"] = len(body)
+    return raw
+
+
+def expected_payload(port):
+    return b"GET /%d HTTP/1.1\r\n\r\n" % port if port % 5 else b""
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="archive-test-")
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_segments(self, counts, written=0, start=1000.0):
+        """
+        Write one sealed segment per entry of `counts`, a second of
+        timestamps apart, numbering rows on from `written`. Returns the
+        number of rows in the archive.
+        """
+        for i, count in enumerate(counts):
+            writer = ArchiveWriter(self.directory, segment_events=100, index_interval=4, retention=0)
+            writer.append(packets(count, written), now=start + i)
+            writer.close()
+            written += count
+        return written
+
+    def housekeeping(self, now, retention=0, **options):
+        writer = ArchiveWriter(self.directory, segment_events=100, index_interval=4, retention=retention, **options)
+        writer.maintain(now)
+        writer.close()
+        return writer
+
+    def counts(self):
+        segments = list_segments(self.directory)
+        counts = [segment.count for segment in segments]
+        for segment in segments:
+            segment.close()
+        return counts
+
+    def assert_rows(self, written):
+        reader = ArchiveReader(self.directory)
+        self.addCleanup(reader.close)
+        parts = reader.read()
+        ports = np.concatenate([part.columns["dst_port"] for part in parts])
+        np.testing.assert_array_equal(ports, np.arange(written))
+        payloads = [payload for part in parts for payload in part.payloads()]
+        self.assertEqual(payloads, [expected_payload(port) for port in range(written)])
+        timestamps = np.concatenate([part.columns["timestamp"] for part in parts])
+        self.assertTrue((np.diff(timestamps) >= 0).all())
+
+
+class SegmentLayoutTest(ArchiveTestCase):
+
+    def test_columns_are_page_aligned(self):
+        offsets, size = segment_layout(1000, 16)
+        self.assertEqual(offsets["timestamp"], PAGE_SIZE)
+        for offset in offsets.values():
+            self.assertEqual(offset % PAGE_SIZE, 0)
+        self.assertEqual(size % PAGE_SIZE, 0)
+        self.assertGreaterEqual(size, offsets["index"] + (1000 // 16 + 1) * 8)
+
+    def test_create_and_reopen(self):
+        path = os.path.join(self.directory, "segment-0000000007" + SEGMENT_SUFFIX)
+        segment = Segment.create(path, 64, 8, 7)
+        self.assertEqual((segment.id, segment.capacity, segment.count, segment.sealed), (7, 64, 0, False))
+        self.assertEqual(segment.seq_range, (7, 7))
+        self.assertEqual(os.path.getsize(path), segment_layout(64, 8)[1])
+        self.assertTrue(os.path.exists(path[:-len(SEGMENT_SUFFIX)] + PAYLOAD_SUFFIX))
+        segment.close()
+        with open(os.path.join(self.directory, "segment-0000000008" + SEGMENT_SUFFIX), "wb") as f:
+            f.write(b"\0" * PAGE_SIZE)
+        self.assertEqual([segment.id for segment in list_segments(self.directory)], [7])
+
+    def test_rotation_and_payloads(self):
+        writer = ArchiveWriter(self.directory, segment_events=10, index_interval=4, retention=0)
+        writer.append(packets(25), now=1000.0)
+        writer.close()
+        self.assertEqual(self.counts(), [10, 10, 5])
+        self.assert_rows(25)
+
+
+class RowRangeTest(ArchiveTestCase):
+
+    def test_sparse_index_matches_full_search(self):
+        writer = ArchiveWriter(self.directory, segment_events=1000, index_interval=8, retention=0)
+        rng = np.random.default_rng(1)
+        times = 1000.0 + np.cumsum(rng.integers(0, 3, size=100))
+        for i, when in enumerate(times):
+            writer.append(packets(7, 7 * i), now=float(when))
+        writer.close()
+        segment, = list_segments(self.directory)
+        self.addCleanup(segment.close)
+        timestamps = segment.columns["timestamp"][:segment.count]
+        for since in np.arange(times[0] - 1, times[-1] + 2, 0.5):
+            for until in (since, since + 1, since + 7.5, None):
+                start, stop = segment.row_range(since, until)
+                self.assertEqual(start, np.searchsorted(timestamps, since, side="left"))
+                expected = segment.count if until is None else np.searchsorted(timestamps, until, side="left")
+                self.assertEqual(stop, expected)
+
+    def test_clock_stepping_back(self):
+        writer = ArchiveWriter(self.directory, segment_events=100, index_interval=4, retention=0)
+        writer.append(packets(10), now=1000.0)
+        writer.append(packets(10, 10), now=990.0)
+        writer.close()
+        reader = ArchiveReader(self.directory)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.count(since=1000.0), 20)
+        self.assertEqual(reader.count(until=1000.0), 0)
+
+
+class CompactionTest(ArchiveTestCase):
+
+    def test_payload_offsets_across_merges(self):
+        written = self.write_segments([10, 3, 20, 7, 1])
+        self.housekeeping(2000.0)
+        self.assertEqual(self.counts(), [41])
+        self.assert_rows(written)
+        written = self.write_segments([15, 4], written, start=1100.0)
+        self.housekeeping(2000.0)
+        self.assertEqual(sum(self.counts()), written)
+        self.assert_rows(written)
+
+    def test_unequal_neighbours_are_merged(self):
+        written = self.write_segments([40, 45, 42, 44, 41, 43])
+        for _ in range(3):
+            self.housekeeping(2000.0)
+        self.assertEqual(self.counts(), [85, 86, 84])
+        self.assert_rows(written)
+
+    def test_large_segments_are_left_alone(self):
+        self.write_segments([100, 60, 100])
+        self.housekeeping(2000.0)
+        self.assertEqual(self.counts(), [100, 60, 100])
+
+    def test_rows_are_copied_a_logarithmic_number_of_times(self):
+        copied = []
+        merge = archive._merge
+
+        def counting_merge(directory, run, segment_id):
+            copied.append(sum(segment.count for segment in run))
+            merge(directory, run, segment_id)
+
+        archive._merge = counting_merge
+        self.addCleanup(setattr, archive, "_merge", merge)
+        writer = ArchiveWriter(self.directory, segment_events=5000, segment_seconds=1.0, index_interval=4,
+                               retention=0)
+        written = 0
+        for i in range(400):
+            writer.append(packets(10, written), now=1000.0 + i)
+            written += 10
+            writer.maintain(1001.0 + i)
+            writer._maintenance.join()
+        writer.close()
+        self.assertLess(sum(copied), 6 * written)
+        self.assertLessEqual(len(self.counts()), 12)
+        self.assert_rows(written)
+
+
+class RetentionTest(ArchiveTestCase):
+
+    def test_expired_segments_are_removed(self):
+        self.write_segments([60, 60, 60], start=1000.0)
+        writer = self.housekeeping(1001.5 + 86400.0, retention=86400.0)
+        self.assertEqual(self.counts(), [60])
+        self.assertEqual(writer.segments_removed, 2)
+
+    def test_oldest_segments_are_removed_over_max_bytes(self):
+        self.write_segments([60, 60, 60])
+        segments = list_segments(self.directory)
+        size = segments[-1].disk_bytes()
+        for segment in segments:
+            segment.close()
+        self.housekeeping(2000.0, max_bytes=size)
+        reader = ArchiveReader(self.directory)
+        self.addCleanup(reader.close)
+        np.testing.assert_array_equal(reader.read()[0].columns["dst_port"], np.arange(120, 180))
+
+
+class RecoveryTest(ArchiveTestCase):
+
+    def test_segments_covered_by_a_merge_are_removed_on_start(self):
+        written = self.write_segments([10, 20])
+        saved = os.path.join(self.directory, "saved")
+        os.mkdir(saved)
+        names = [name for name in os.listdir(self.directory) if name.startswith("segment-")]
+        for name in names:
+            shutil.copy(os.path.join(self.directory, name), saved)
+        self.housekeeping(2000.0)
+        self.assertEqual(self.counts(), [30])
+        # A crash after the merge was moved in, before the segments it
+        # replaced were removed, the last one only half way
+        last = max(name for name in names if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            if name != last:
+                shutil.copy(os.path.join(saved, name), self.directory)
+        shutil.rmtree(saved)
+        ArchiveWriter(self.directory, segment_events=100, retention=0).close()
+        remaining = sorted(os.listdir(self.directory))
+        self.assertEqual(len(remaining), 2)
+        self.assertEqual(self.counts(), [30])
+        self.assert_rows(written)
+
+    def test_interrupted_merge_is_discarded(self):
+        written = self.write_segments([10, 20])
+        os.mkdir(os.path.join(self.directory, ".compacting"))
+        open(os.path.join(self.directory, ".compacting", "segment-0000000009" + SEGMENT_SUFFIX), "wb").close()
+        writer = ArchiveWriter(self.directory, segment_events=100, retention=0)
+        writer.close()
+        self.assertFalse(os.path.exists(os.path.join(self.directory, ".compacting")))
+        self.assertEqual(self.counts(), [10, 20])
+        self.assert_rows(written)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,386 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from collections import Counter
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from decoder import MAX_HTTP_DATA, PACKET_INFO_DTYPE, CookieBatchDecoder, PacketBatchDecoder
+from event_sources import make_event_source
+from flows import FlowTable
+from reassembly import HeaderReassembler
+from sketches import parse_packets, parse_payloads
+
+# Seconds between the stats, and flow expiry, of each worker
+STATS_INTERVAL = 1.0
+# Longest a worker holds events before sending them on; batching keeps
+# the per-message cost of the reducer off the per-packet path
+FLUSH_INTERVAL = 0.05
+# Messages handled per poll() once the first one has arrived
+MAX_MESSAGES_PER_POLL = 256
+
+_HEADER_FIELDS = tuple(name for name in PACKET_INFO_DTYPE.names if name != "http_data")
+
+
+def compact_dtype(payload_len):
+    """
+    Packed packet_info layout with http_data cut to payload_len bytes, the
+    form packet batches take in shared memory.
+    """
+    return np.dtype([(name, PACKET_INFO_DTYPE.fields[name][0]) for name in _HEADER_FIELDS]
+                    + [("http_data", f"S{max(1, payload_len)}")])
+
+
+def worker_cpus(count, cpus):
+    """
+    Split `cpus` between `count` workers, round robin.
+    """
+    return [cpus[index::count] for index in range(count)]
+
+
+class _Worker:
+    """
+    The pipeline of one worker process: drains its share of the event
+    source, decodes, tracks flows and parses cookies, and sends the results
+    to the reducer. Packet batches go through the worker's slots of shared
+    memory, everything else through the channel.
+    """
+
+    def __init__(self, index, count, cpus, options, bpf, channel, free_slots, shm, slots, slot_bytes,
+                 sample_rate, stopping):
+        self.index = index
+        self.count = count
+        self.cpus = cpus
+        self.options = options
+        self.bpf = bpf
+        self.channel = channel
+        self.free_slots = free_slots
+        self.shm = shm
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.sample_rate = sample_rate
+        self.stopping = stopping
+        self.next_slot = 0
+        self.handoff_dropped = 0
+        self.latest = None
+
+        batch_size = options.get("decode_batch_size", 4096)
+        self.decoder = PacketBatchDecoder(batch_size)
+        self.cookie_decoder = CookieBatchDecoder(batch_size)
+        self.flows = FlowTable(**options["flows"]) if options.get("flows") is not None else None
+        self.reassembler = None
+        if options.get("parse_cookies") and options.get("reassembly") is not None:
+            self.reassembler = HeaderReassembler(**options["reassembly"])
+
+    def run(self):
+        # Ctrl+C reaches the whole process group; the parent stops workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.cpus and self.options.get("pin", True):
+            os.sched_setaffinity(0, self.cpus)
+        options = self.options
+        self.source = make_event_source(options.get("source"), self.bpf, options.get("extract_cookies", False),
+                                        options.get("flows") is not None, shard=(self.index, self.count),
+                                        cpus=self.cpus)
+
+        def handle_packet_event(cpu, data, size):
+            if self.decoder.append(data, size):
+                self.flush_packet_events()
+
+        def handle_cookie_event(cpu, data, size):
+            if self.cookie_decoder.append(data, size):
+                self.flush_cookie_events()
+
+        self.source.open(handle_packet_event, handle_cookie_event if options.get("extract_cookies") else None)
+        next_flush = time.monotonic() + FLUSH_INTERVAL
+        next_stats = time.monotonic() + STATS_INTERVAL
+        try:
+            while not self.stopping.is_set():
+                rate = self.sample_rate.value
+                if rate != self.source.sample_rate:
+                    self.source.set_sample_rate(rate)
+                self.source.poll(int(FLUSH_INTERVAL * 1000))
+                now = time.monotonic()
+                if now >= next_flush:
+                    next_flush = now + FLUSH_INTERVAL
+                    self.flush_packet_events()
+                    self.flush_cookie_events()
+                if now >= next_stats:
+                    next_stats = now + STATS_INTERVAL
+                    if self.reassembler is not None:
+                        self.reassembler.expire()
+                    if self.flows is not None:
+                        self.flows.expire()
+                        self.send_flows()
+                    self.send_stats()
+        finally:
+            self.flush_packet_events()
+            self.flush_cookie_events()
+            if self.flows is not None:
+                self.flows.flush()
+                self.send_flows()
+            self.send_stats(done=True)
+            self.source.close()
+
+    def flush_packet_events(self):
+        if self.decoder.count == 0:
+            return
+        batch = self.decoder.decode()
+        raw = batch.raw
+        self.latest = raw[-1:]
+        if self.flows is not None:
+            self.flows.update(raw, sample_rate=self.source.sample_rate)
+        if self.options.get("parse_cookies"):
+            if self.reassembler is not None:
+                parsed = parse_payloads(*self.reassembler.add(raw, batch.payloads()))
+            else:
+                parsed = parse_packets(raw)
+            if parsed is not None:
+                self.channel.put(("parsed", self.index, parsed))
+        if self.options.get("export_packets", True):
+            self.hand_off(raw)
+
+    def flush_cookie_events(self):
+        if self.cookie_decoder.count == 0:
+            return
+        self.channel.put(("cookies", self.index, self.cookie_decoder.decode().raw))
+
+    def hand_off(self, raw):
+        """
+        Copy a batch into free shared memory slots, with payloads cut to the
+        longest one in the batch. Rows that find no free slot are dropped
+        and counted, so a slow reducer never stalls draining.
+        """
+        payload_len = min(int(raw["http_data_len"].max()), MAX_HTTP_DATA)
+        dtype = compact_dtype(payload_len)
+        per_slot = self.slot_bytes // dtype.itemsize
+        for start in range(0, len(raw), per_slot):
+            chunk = raw[start:start + per_slot]
+            if not self.free_slots.acquire(block=False):
+                self.handoff_dropped += len(raw) - start
+                return
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.slots
+            offset = (self.index * self.slots + slot) * self.slot_bytes
+            view = np.ndarray(len(chunk), dtype=dtype, buffer=self.shm.buf, offset=offset)
+            for name in dtype.names:
+                view[name] = chunk[name]
+            del view
+            self.channel.put(("packets", self.index, slot, len(chunk), payload_len))
+
+    def send_flows(self):
+        rows = self.flows.take()
+        if rows:
+            self.channel.put(("flows", self.index, rows))
+
+    def send_stats(self, done=False):
+        # Counts of sources without a kernel packet_count map are sent as
+        # deltas; everything else is cumulative
+        packet_counts = dict(self.source.packet_counts)
+        self.source.packet_counts.clear()
+        stats = {
+            "events": self.decoder.received_records,
+            "event_bytes": self.decoder.received_bytes,
+            "cookie_events": self.cookie_decoder.received_records,
+            "cookie_event_bytes": self.cookie_decoder.received_bytes,
+            "lost_events": self.source.lost_counts(),
+            "packet_counts": packet_counts,
+            "handoff_dropped": self.handoff_dropped,
+            "cpu_seconds": time.process_time(),
+            "latest": self.latest,
+            "done": done,
+        }
+        if self.flows is not None:
+            stats["flows_active"] = len(self.flows)
+            stats["flows_evicted"] = self.flows.evicted
+        if self.reassembler is not None:
+            stats["reassembly"] = self.reassembler.counters()
+        self.channel.put(("stats", self.index, stats))
+
+
+def _run_worker(*args):
+    _Worker(*args).run()
+
+
+class WorkerPool:
+    """
+    Drains the event source with `count` worker processes and reduces their
+    results in the calling process. Stands in for the event source: poll()
+    waits for and dispatches worker messages, and packet_counts,
+    lost_events and sample_rate merge or fan out to the workers.
+
+    Perf buffers are split by CPU, so with RSS each worker sees whole flows
+    of its NIC queues and flow tables need no merging; replay sources are
+    split by packet. Workers are forked after the XDP program is loaded and
+    inherit its maps.
+
+    The callbacks receive packet batches (compact PACKET_INFO_DTYPE-like
+    arrays), raw cookie_info arrays, parse_payloads() results, flow rows
+    and per-worker stats.
+    """
+
+    live = False
+
+    def __init__(self, count, source_settings, bpf=None, options=None, cpus=None, slots=4,
+                 slot_bytes=4 * 1024 * 1024, pin=True):
+        source_settings = source_settings or {}
+        kind = source_settings.get("type", "perf")
+        if kind == "ringbuf":
+            raise ValueError("workers need per-CPU perf buffers; the ringbuf event source cannot be split")
+        if slot_bytes < compact_dtype(MAX_HTTP_DATA).itemsize:
+            raise ValueError(f"workers.slot_bytes must hold at least one full record "
+                             f"({compact_dtype(MAX_HTTP_DATA).itemsize} bytes)")
+        self.live = kind == "perf"
+        if self.live and cpus is None:
+            from bcc.utils import get_online_cpus
+            cpus = get_online_cpus()
+        self.count = min(count, len(cpus)) if cpus else count
+        self.cpus = worker_cpus(self.count, cpus) if cpus else [None] * self.count
+        self.source_settings = source_settings
+        self.bpf = bpf
+        self.options = {**(options or {}), "source": source_settings, "pin": pin}
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+
+        self.packet_counts = Counter()
+        self.lost_events = Counter()
+        self.sample_rate = 1
+        self.stats = [{} for _ in range(self.count)]
+        self.processes = []
+        self.shm = None
+        self._rates = (time.monotonic(), [0] * self.count)
+        self._context = multiprocessing.get_context("fork")
+        self._shared_rate = self._context.Value("I", 1, lock=False)
+        self._stopping = self._context.Event()
+        self._closed = False
+
+    def open(self, on_packets, on_cookies=None, on_parsed=None, on_flows=None, on_stats=None):
+        self.on_packets = on_packets
+        self.on_cookies = on_cookies
+        self.on_parsed = on_parsed
+        self.on_flows = on_flows
+        self.on_stats = on_stats
+        context = self._context
+        self.channel = context.Queue()
+        self.free_slots = [context.Semaphore(self.slots) for _ in range(self.count)]
+        self.shm = shared_memory.SharedMemory(create=True, size=self.count * self.slots * self.slot_bytes)
+        for index in range(self.count):
+            process = context.Process(
+                target=_run_worker, name=f"worker-{index}", daemon=True,
+                args=(index, self.count, self.cpus[index], self.options, self.bpf, self.channel,
+                      self.free_slots[index], self.shm, self.slots, self.slot_bytes, self._shared_rate,
+                      self._stopping))
+            process.start()
+            self.processes.append(process)
+        cpus = "" if self.cpus[0] is None else " over CPUs " + "; ".join(
+            ",".join(map(str, cpus)) for cpus in self.cpus)
+        logging.info(f"Started {self.count} worker processes{cpus}")
+
+    def set_sample_rate(self, rate):
+        self.sample_rate = max(1, int(rate))
+        self._shared_rate.value = self.sample_rate
+
+    def poll(self, timeout_ms):
+        """
+        Wait up to timeout_ms for worker messages and handle those that
+        have arrived. Returns the number handled.
+        """
+        try:
+            message = self.channel.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            return 0
+        self._handle(message)
+        handled = 1
+        while handled < MAX_MESSAGES_PER_POLL:
+            try:
+                message = self.channel.get_nowait()
+            except queue.Empty:
+                break
+            self._handle(message)
+            handled += 1
+        return handled
+
+    def _handle(self, message):
+        kind, index = message[0], message[1]
+        if kind == "packets":
+            slot, count, payload_len = message[2:]
+            offset = (index * self.slots + slot) * self.slot_bytes
+            raw = np.ndarray(count, dtype=compact_dtype(payload_len), buffer=self.shm.buf, offset=offset).copy()
+            self.free_slots[index].release()
+            self.on_packets(raw)
+        elif kind == "cookies":
+            if self.on_cookies:
+                self.on_cookies(message[2])
+        elif kind == "parsed":
+            if self.on_parsed:
+                self.on_parsed(message[2])
+        elif kind == "flows":
+            if self.on_flows:
+                self.on_flows(message[2])
+        elif kind == "stats":
+            stats = message[2]
+            previous = self.stats[index]
+            self.stats[index] = stats
+            self.packet_counts.update(stats.pop("packet_counts"))
+            # Replaced rather than updated, so lost_counts() needs no lock
+            self.lost_events = sum((Counter(worker.get("lost_events", {})) for worker in self.stats), Counter())
+            if self.on_stats:
+                self.on_stats(stats, previous)
+
+    def lost_counts(self):
+        return dict(self.lost_events)
+
+    def total(self, name):
+        """
+        A stats counter summed over the workers.
+        """
+        return sum(stats.get(name, 0) for stats in self.stats)
+
+    def process_time(self):
+        """
+        CPU seconds used by this process and, as of their latest stats, by
+        the workers.
+        """
+        return time.process_time() + self.total("cpu_seconds")
+
+    def rates(self, now=None):
+        """
+        Events per second of each worker since the previous call.
+        """
+        now = time.monotonic() if now is None else now
+        last_time, last_events = self._rates
+        events = [stats.get("events", 0) for stats in self.stats]
+        elapsed = max(now - last_time, 1e-9)
+        self._rates = (now, events)
+        return [(current - last) / elapsed for current, last in zip(events, last_events)]
+
+    def stop(self, timeout=5.0):
+        """
+        Stop the workers, handling what they send until each has finished:
+        its last batches, its open flows and final stats.
+        """
+        if self._closed or not self.processes:
+            return
+        self._stopping.set()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and not all(stats.get("done") for stats in self.stats):
+            if not any(process.is_alive() for process in self.processes) and self.channel.empty():
+                break
+            self.poll(100)
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f"{process.name} did not stop, terminating it")
+                process.terminate()
+
+    def close(self):
+        if self._closed:
+            return
+        self.stop()
+        self._closed = True
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()